@@ -4,18 +4,45 @@
 import asyncio
 import base64
 import hashlib
+import json
 import time
+from contextlib import AsyncExitStack
 from logging_config import get_logger
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Callable, List
 import aiohttp
 import aiofiles
 from telegram import Update
 from telegram.ext import ContextTypes
-from config import API_KEYS, BASE_URL, API_TIMEOUT, MAX_API_RETRIES, MAX_IMAGE_SIZE, MAX_AUDIO_SIZE, OPENAI_MODEL, OPENAI_VISION_MODEL
-from performance_optimizations import rate_limiter
+from config import API_KEYS, BASE_URL, API_TIMEOUT, MAX_IMAGE_SIZE, MAX_AUDIO_SIZE, OPENAI_MODEL, OPENAI_VISION_MODEL, PHOTO_HASH_MAX_DISTANCE
+from config import VISION_IMAGE_DETAIL, VISION_JPEG_QUALITY, VISION_LOW_DETAIL_EDGE_THRESHOLD, ANALYSIS_OUTPUT_FORMAT, AI_REQUEST_DEADLINE
+from performance_optimizations import ai_rate_limiter, ai_admission, AIOverloadedError, PRIORITY_DEFAULT
+from resilience import circuit_breakers, retry_policy, call_with_retries, error_for_status, CircuitOpenError, Deadline
+from resilience import vision_hedger
+from utils import image_hash, image_preprocessing
+from cache_manager import CacheManager, TwoTierCache, shared_cache_backend
+from models.analysis import AnalysisResult
+from prompts import prompt_registry
 
 logger = get_logger(__name__)
 
+def estimate_request_tokens(payload: Optional[Dict[str, Any]]) -> int:
+    """Грубая оценка токенов запроса для TPM-лимита: ~4 символа на токен плюс лимит ответа"""
+    if not payload:
+        return 0
+    tokens = payload.get('max_tokens', 0)
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                tokens += len(part.get('text', '')) // 4
+            elif part.get('type') == 'image_url':
+                # Изображение в режиме high/auto - до нескольких сотен токенов
+                tokens += 85 if part['image_url'].get('detail') == 'low' else 765
+    return tokens
+
 class APIClient:
     """Асинхронный клиент для работы с API"""
     
@@ -26,125 +53,305 @@ class APIClient:
         self.vision_model = OPENAI_VISION_MODEL
         self.timeout = aiohttp.ClientTimeout(total=API_TIMEOUT)
         self.session: Optional[aiohttp.ClientSession] = None
-        self.cache: Dict[str, Tuple[Any, float]] = {}  # Кэш для результатов
+        self._session_lock = asyncio.Lock()
         self.cache_ttl = 300  # TTL кэша в секундах (5 минут)
         self.max_cache_size = 1000  # Максимальный размер кэша
+        # Кэш результатов: локальный L1 и общий для реплик L2 (если настроен CACHE_BACKEND).
+        # Здесь же хранятся ссылки Telegram file_unique_id -> ключ кэша по содержимому
+        self.cache = TwoTierCache(
+            'api',
+            CacheManager(default_ttl=self.cache_ttl, max_size=self.max_cache_size),
+            shared_cache_backend
+        )
+        # Индекс перцептивных хэшей для почти одинаковых фото (пересжатие, повторный снимок)
+        self.photo_hash_index = image_hash.PerceptualHashIndex(
+            max_distance=PHOTO_HASH_MAX_DISTANCE,
+            max_size=self.max_cache_size
+        )
+        # Суммарный эффект подготовки фото перед отправкой в vision-модель
+        self.image_stats = {'requests': 0, 'original_bytes': 0, 'sent_bytes': 0,
+                            'original_tokens': 0, 'estimated_tokens': 0}
+    
+    async def start(self):
+        """Создает общую HTTP-сессию на время жизни приложения (вызывается из post_init)"""
+        async with self._session_lock:
+            if self.session and not self.session.closed:
+                return
+            try:
+                import ssl
+                # Создаем SSL контекст с более мягкими настройками для macOS
+                ssl_context = ssl.create_default_context()
+                ssl_context.check_hostname = False  # Отключаем проверку hostname для API
+                ssl_context.verify_mode = ssl.CERT_NONE  # Временно отключаем проверку сертификатов
+                
+                # Ограничиваем протоколы для безопасности
+                ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+                ssl_context.maximum_version = ssl.TLSVersion.TLSv1_3
+                
+                # Пул соединений переиспользуется всеми запросами: keep-alive и кэш DNS
+                # избавляют от повторных TCP/TLS рукопожатий
+                connector = aiohttp.TCPConnector(
+                    ssl=ssl_context, 
+                    limit=100, 
+                    limit_per_host=30,
+                    keepalive_timeout=60,
+                    use_dns_cache=True,
+                    ttl_dns_cache=300,
+                    enable_cleanup_closed=True
+                )
+                self.session = aiohttp.ClientSession(
+                    timeout=self.timeout, 
+                    connector=connector,
+                    headers={'User-Agent': 'CalorigramBot/1.0'}
+                )
+                logger.info("APIClient session created successfully")
+            except Exception as e:
+                logger.error(f"Failed to create APIClient session: {e}")
+                raise
+    
+    async def close(self):
+        """Закрывает общую HTTP-сессию (вызывается при остановке приложения)"""
+        async with self._session_lock:
+            try:
+                if self.session and not self.session.closed:
+                    await self.session.close()
+                    logger.info("APIClient session closed successfully")
+            except Exception as e:
+                logger.error(f"Error closing APIClient session: {e}")
+            finally:
+                self.session = None
     
     async def __aenter__(self):
-        """Async context manager entry"""
-        try:
-            import ssl
-            # Создаем SSL контекст с более мягкими настройками для macOS
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False  # Отключаем проверку hostname для API
-            ssl_context.verify_mode = ssl.CERT_NONE  # Временно отключаем проверку сертификатов
-            
-            # Ограничиваем протоколы для безопасности
-            ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-            ssl_context.maximum_version = ssl.TLSVersion.TLSv1_3
-            
-            connector = aiohttp.TCPConnector(
-                ssl=ssl_context, 
-                limit=100, 
-                limit_per_host=30,
-                keepalive_timeout=30,
-                enable_cleanup_closed=True
-            )
-            self.session = aiohttp.ClientSession(
-                timeout=self.timeout, 
-                connector=connector,
-                headers={'User-Agent': 'CalorigramBot/1.0'}
-            )
-            logger.info("APIClient session created successfully")
-            return self
-        except Exception as e:
-            logger.error(f"Failed to create APIClient session: {e}")
-            raise
+        """Async context manager entry: гарантирует наличие общей сессии"""
+        await self.start()
+        return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Async context manager exit"""
-        try:
-            if self.session:
-                await self.session.close()
-                logger.info("APIClient session closed successfully")
-        except Exception as e:
-            logger.error(f"Error closing APIClient session: {e}")
-        finally:
-            # Очищаем кэш при выходе
-            self.cache.clear()
+        """Async context manager exit: сессия общая для параллельных запросов и здесь не закрывается"""
+        return False
     
-    def _get_cache_key(self, data: bytes) -> str:
-        """Генерирует ключ кэша на основе данных"""
-        return hashlib.md5(data).hexdigest()
+    def _get_cache_key(self, data: bytes, prompt_tag: str = "") -> str:
+        """Генерирует ключ кэша на основе данных и версии промпта"""
+        digest = hashlib.md5(data).hexdigest()
+        return f"{digest}:{prompt_tag}" if prompt_tag else digest
     
     def _get_from_cache(self, cache_key: str) -> Optional[Any]:
-        """Получает данные из кэша"""
-        if cache_key in self.cache:
-            result, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < self.cache_ttl:
-                logger.info(f"Cache hit for key: {cache_key[:8]}...")
-                return result
-            else:
-                # Удаляем устаревший кэш
-                del self.cache[cache_key]
-        return None
+        """Получает данные из локального кэша"""
+        result = self.cache.get(cache_key)
+        if result is not None:
+            logger.info(f"Cache hit for key: {cache_key[:8]}...")
+        return result
+    
+    async def _aget_from_cache(self, cache_key: str) -> Optional[Any]:
+        """Получает данные из локального кэша, а при промахе - из общего"""
+        result = await self.cache.aget(cache_key)
+        if result is not None:
+            logger.info(f"Cache hit for key: {cache_key[:8]}...")
+        return result
     
     def _set_cache(self, cache_key: str, result: Any):
         """Сохраняет данные в кэш"""
-        # Очищаем кэш если он превышает максимальный размер
-        if len(self.cache) >= self.max_cache_size:
-            # Удаляем самые старые записи
-            oldest_keys = sorted(self.cache.keys(), key=lambda k: self.cache[k][1])[:100]
-            for key in oldest_keys:
-                del self.cache[key]
-        
-        self.cache[cache_key] = (result, time.time())
+        self.cache.set(cache_key, result)
         logger.info(f"Cache set for key: {cache_key[:8]}...")
     
-    async def _make_request(self, method: str, url: str, **kwargs) -> Optional[Dict[str, Any]]:
-        """Выполняет HTTP запрос с повторными попытками"""
-        if not self.session:
-            raise RuntimeError("APIClient не инициализирован. Используйте async with")
+    @staticmethod
+    def _analysis_from_cache(entry: Any) -> Optional[AnalysisResult]:
+        """Анализ хранится в кэше словарем - его можно сериализовать в общий L2"""
+        if isinstance(entry, dict):
+            return AnalysisResult.from_dict(entry)
+        # Запись прежнего формата (текст) - анализ делается заново
+        return None
+    
+    def remember_file_id(self, file_unique_id: str, cache_key: str):
+        """Связывает file_unique_id из Telegram с ключом кэша по содержимому"""
+        self.cache.set(f"file:{file_unique_id}", cache_key)
+    
+    async def get_cached_by_file_id(self, file_unique_id: Optional[str]) -> Optional[AnalysisResult]:
+        """Возвращает закэшированный результат по file_unique_id без скачивания файла"""
+        if not file_unique_id:
+            return None
+        cache_key = await self.cache.aget(f"file:{file_unique_id}")
+        # Анализ, сделанный прежней версией промпта, не используем
+        if cache_key is None or not cache_key.endswith(prompt_registry.analysis('image', ANALYSIS_OUTPUT_FORMAT).cache_tag):
+            return None
+        return self._analysis_from_cache(await self._aget_from_cache(cache_key))
+    
+    def _is_cached(self, cache_key: str) -> bool:
+        """Проверяет, что запись есть в локальном кэше и не устарела"""
+        return self.cache.get(cache_key) is not None
+    
+    async def _find_similar_photo(self, image_data: bytes, prompt_tag: str = "") -> Tuple[Optional[int], Optional[str]]:
+        """Ищет анализ почти такого же фото текущей версии промпта; возвращает (перцептивный хэш, ключ кэша)"""
+        if PHOTO_HASH_MAX_DISTANCE <= 0 or not image_hash.is_available():
+            return None, None
+        # Декодирование изображения нагружает CPU - не блокируем event loop
+        photo_hash = await asyncio.to_thread(image_hash.compute_dhash, image_data)
+        match = self.photo_hash_index.find(
+            photo_hash, is_alive=lambda key: key.endswith(prompt_tag) and self._is_cached(key)
+        )
+        if match is None:
+            return photo_hash, None
+        distance, cache_key = match
+        logger.info(f"Similar photo found in cache (distance {distance}): {cache_key[:8]}...")
+        return photo_hash, cache_key
+    
+    def _record_image_metrics(self, prepared: Dict[str, Any], request_time: float,
+                              usage: Optional[Dict[str, Any]] = None):
+        """Логирует экономию байтов и токенов на подготовке фото для одного запроса"""
+        stats = self.image_stats
+        stats['requests'] += 1
+        stats['original_bytes'] += prepared['original_bytes']
+        stats['sent_bytes'] += prepared['bytes']
+        stats['original_tokens'] += prepared['original_tokens'] or 0
+        stats['estimated_tokens'] += prepared['tokens'] or 0
+        
+        saved = prepared['original_bytes'] - prepared['bytes']
+        logger.info(
+            f"Vision image: {prepared['original_size']} -> {prepared['size']}, "
+            f"{prepared['original_bytes']} -> {prepared['bytes']} bytes (saved {saved}), "
+            f"detail={prepared['detail']}, image tokens ~{prepared['original_tokens']} -> ~{prepared['tokens']}, "
+            f"prompt tokens {usage.get('prompt_tokens') if usage else 'n/a'}, "
+            f"preprocess {prepared['elapsed'] * 1000:.0f}ms, request {request_time:.2f}s"
+        )
+    
+    def get_image_preprocessing_stats(self) -> Dict[str, Any]:
+        """Возвращает суммарную экономию на подготовке фото"""
+        stats = dict(self.image_stats)
+        if stats['original_bytes']:
+            stats['bytes_saved_fraction'] = 1 - stats['sent_bytes'] / stats['original_bytes']
+        return stats
+    
+    def get_photo_cache_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику кэша фото по похожести"""
+        return self.photo_hash_index.get_stats()
+    
+    async def _make_request(self, method: str, url: str, endpoint: str = 'chat',
+                            user_id: Optional[int] = None, priority: int = PRIORITY_DEFAULT,
+                            on_queue_position: Optional[Callable[[int], Any]] = None,
+                            on_partial_text: Optional[Callable[[str], Any]] = None,
+                            **kwargs) -> Optional[Dict[str, Any]]:
+        """
+        Выполняет HTTP запрос через очередь модели и лимиты запросов
+        
+        На весь запрос пользователя (ожидание в очередях, попытки и паузы между ними)
+        отводится AI_REQUEST_DEADLINE секунд. Если circuit breaker эндпоинта разомкнут,
+        бросает CircuitOpenError без постановки в очередь.
+        
+        Если передан on_partial_text, ответ запрашивается потоком (stream=true) и callback
+        получает накопленный текст по мере прихода; результат имеет тот же вид, что и обычный ответ.
+        """
+        if not self.session or self.session.closed:
+            await self.start()
+        
+        breaker = circuit_breakers.get(endpoint)
+        if breaker.is_open():
+            raise CircuitOpenError(f"Circuit '{endpoint}' is open")
+        
+        deadline = Deadline(AI_REQUEST_DEADLINE)
+        payload = kwargs.get('json') or {}
+        async with AsyncExitStack() as stack:
+            # Таймаут ожидания относится только к лимитам и очереди модели: таймауты самих
+            # попыток обрабатывает _send_with_retries
+            try:
+                async with asyncio.timeout(deadline.remaining()):
+                    # Сначала ждем своей очереди в лимитах пользователя и эндпоинта (RPM/TPM):
+                    # приторможенный лимитом запрос не должен занимать слот модели
+                    await ai_rate_limiter.acquire(endpoint, estimate_request_tokens(payload), user_id)
+                    # Bulkhead: не больше N одновременных запросов к модели, остальные ждут по приоритету
+                    await stack.enter_async_context(
+                        ai_admission.slot(payload.get('model', endpoint), priority, on_queue_position)
+                    )
+            except TimeoutError:
+                raise AIOverloadedError(f"Request deadline exceeded while waiting for '{endpoint}' capacity")
+            return await self._send_with_retries(method, url, endpoint, deadline,
+                                                 on_partial_text=on_partial_text, **kwargs)
+    
+    async def _send_with_retries(self, method: str, url: str, endpoint: str, deadline: Deadline,
+                                 on_partial_text: Optional[Callable[[str], Any]] = None,
+                                 **kwargs) -> Optional[Dict[str, Any]]:
+        """Выполняет HTTP запрос с повторами (джиттер, Retry-After) через circuit breaker эндпоинта"""
+        if on_partial_text is not None and kwargs.get('json'):
+            # include_usage: последний фрагмент потока содержит расход токенов
+            kwargs['json'] = {**kwargs['json'], 'stream': True, 'stream_options': {'include_usage': True}}
+        
+        async def attempt(timeout: float) -> Optional[Dict[str, Any]]:
+            request_timeout = aiohttp.ClientTimeout(total=min(API_TIMEOUT, timeout))
+            async with self.session.request(method, url, timeout=request_timeout, **kwargs) as response:
+                logger.info(f"Response status: {response.status}")
+                if response.status == 200 and on_partial_text is not None:
+                    result = await self._read_stream(response, on_partial_text)
+                    if result is None:
+                        logger.error("Streamed response contained no content")
+                    return result
+                elif response.status == 200:
+                    result = await response.json()
+                    logger.info(f"Response received successfully, size: {len(str(result))}")
+                    return result
+                error = error_for_status(response.status, response.headers)
+                if error is not None:
+                    raise error
+                error_text = await response.text()
+                logger.error(f"API request failed with status {response.status}: {error_text}")
+                return None
         
-        # Проверяем rate limiting
-        if not rate_limiter.is_allowed():
-            wait_time = rate_limiter.get_wait_time()
-            logger.warning(f"Rate limit exceeded, waiting {wait_time:.1f}s")
-            await asyncio.sleep(wait_time)
+        # Потоковый ответ не хеджируется: два потока правили бы одно сообщение.
+        # Второй запрос списывает RPM/TPM эндпоинта, а без свободных токенов не отправляется
+        if endpoint == 'vision' and on_partial_text is None:
+            tokens = estimate_request_tokens(kwargs.get('json'))
+            attempt = vision_hedger.wrap(attempt, admit=lambda: ai_rate_limiter.try_acquire(endpoint, tokens))
         
-        for attempt in range(MAX_API_RETRIES):
+        return await call_with_retries(attempt, circuit_breakers.get(endpoint), retry_policy, deadline,
+                                       f"Request to {url}")
+    
+    async def _read_stream(self, response: aiohttp.ClientResponse,
+                           on_partial_text: Callable[[str], Any]) -> Optional[Dict[str, Any]]:
+        """Собирает ответ из SSE-потока chat/completions, передавая накопленный текст в callback"""
+        text = ""
+        usage = None
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+            # Пустые строки разделяют события, строки с ":" - комментарии keep-alive
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            usage = chunk.get('usage') or usage
+            choices = chunk.get('choices') or []
+            delta = (choices[0].get('delta') or {}).get('content') if choices else None
+            if not delta:
+                continue
+            text += delta
             try:
-                logger.info(f"Making request attempt {attempt + 1}/{MAX_API_RETRIES} to {url}")
-                async with self.session.request(method, url, **kwargs) as response:
-                    logger.info(f"Response status: {response.status}")
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"Response received successfully, size: {len(str(result))}")
-                        return result
-                    elif response.status == 429:  # Rate limit
-                        wait_time = 2 ** attempt
-                        logger.warning(f"Rate limit hit, waiting {wait_time}s")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"API request failed with status {response.status}: {error_text}")
-                        return None
-            except asyncio.TimeoutError:
-                logger.warning(f"Request timeout (attempt {attempt + 1}/{MAX_API_RETRIES})")
-                if attempt < MAX_API_RETRIES - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
+                on_partial_text(text)
             except Exception as e:
-                logger.error(f"Request error: {e}")
-                if attempt < MAX_API_RETRIES - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
+                logger.warning(f"Partial text callback failed: {e}")
         
-        return None
+        if not text:
+            return None
+        logger.info(f"Streamed response received successfully, length: {len(text)}")
+        result = {"choices": [{"message": {"content": text}}]}
+        if usage:
+            result['usage'] = usage
+        return result
+    
+    def _parse_analysis_content(self, content: str, structured: bool) -> Optional[AnalysisResult]:
+        """Разбирает ответ ИИ один раз: JSON - по схеме, текст - однопроходным парсером"""
+        if not structured:
+            from services.analysis_parser import parse_analysis
+            return parse_analysis(content)
+        try:
+            return AnalysisResult.from_json(content)
+        except ValueError as e:
+            logger.error(f"Failed to parse structured analysis: {e}")
+            return None
     
-    async def analyze_image(self, image_data: bytes) -> Optional[str]:
-        """Анализирует изображение еды"""
+    async def analyze_image(self, image_data: bytes, file_unique_id: Optional[str] = None,
+                            user_id: Optional[int] = None, priority: int = PRIORITY_DEFAULT,
+                            on_queue_position: Optional[Callable[[int], Any]] = None,
+                            on_partial_text: Optional[Callable[[str], Any]] = None) -> Optional[AnalysisResult]:
+        """Анализирует изображение еды (on_partial_text получает текст ответа по мере генерации)"""
         try:
             # Валидация размера файла
             if not image_data:
@@ -160,93 +367,66 @@ class APIClient:
                 logger.error("Image too small, might be corrupted")
                 return None
             
-            # Проверяем кэш
-            cache_key = self._get_cache_key(image_data)
-            cached_result = self._get_from_cache(cache_key)
+            # Проверяем кэш (ключ включает версию промпта - после его изменения анализ делается заново)
+            template = prompt_registry.analysis('image', ANALYSIS_OUTPUT_FORMAT)
+            cache_key = self._get_cache_key(image_data, template.cache_tag)
+            if file_unique_id:
+                self.remember_file_id(file_unique_id, cache_key)
+            cached_result = self._analysis_from_cache(await self._aget_from_cache(cache_key))
             if cached_result:
                 return cached_result
             
+            # Байты отличаются, но фото может быть почти таким же
+            photo_hash, similar_key = await self._find_similar_photo(image_data, template.cache_tag)
+            if similar_key:
+                cached_result = self._analysis_from_cache(self._get_from_cache(similar_key))
+                if cached_result:
+                    self._set_cache(cache_key, cached_result.to_dict())
+                    return cached_result
+            
+            # Уменьшаем до полезного модели разрешения и пересжимаем без метаданных
+            # в пуле потоков, чтобы декодирование не блокировало event loop
+            prepared = await asyncio.to_thread(
+                image_preprocessing.prepare_image_for_vision,
+                image_data, VISION_IMAGE_DETAIL, VISION_JPEG_QUALITY, VISION_LOW_DETAIL_EDGE_THRESHOLD
+            )
+            
             # Кодируем изображение в base64
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+            image_base64 = base64.b64encode(prepared['data']).decode('utf-8')
             
             headers = {
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             }
             
-            payload = {
-                "model": self.vision_model,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": """Ты эксперт по анализу еды и подсчету калорий. 
-                        Проанализируй изображение еды и предоставь информацию в следующем формате:
-                        
-                        🍽️ Анализ блюда:
-
-                        Название: [название блюда]
-                        Вес: [общий вес блюда]г
-                        Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
-
-                        📊 БЖУ на 100г:
-                        • Белки: [количество]г
-                        • Жиры: [количество]г  
-                        • Углеводы: [количество]г
-
-                        📈 Общее БЖУ в блюде:
-                        • Белки: [общее количество]г
-                        • Жиры: [общее количество]г
-                        • Углеводы: [общее количество]г
-                        
-                        ВАЖНО - СТАНДАРТНЫЕ ДАННЫЕ ДЛЯ ПОПУЛЯРНЫХ БЛЮД (на 100г):
-                        
-                        Плов классический:
-                        • Калорийность: 170-180 ккал/100г
-                        • Белки: 7-8г/100г
-                        • Жиры: 8-10г/100г
-                        • Углеводы: 25-30г/100г
-                        
-                        Гречка с мясом:
-                        • Калорийность: 150-160 ккал/100г
-                        • Белки: 8-10г/100г
-                        • Жиры: 6-8г/100г
-                        • Углеводы: 20-25г/100г
-                        
-                        Борщ с мясом:
-                        • Калорийность: 60-80 ккал/100г
-                        • Белки: 4-5г/100г
-                        • Жиры: 3-4г/100г
-                        • Углеводы: 6-8г/100г
-                        
-                        Используй эти стандартные данные как основу для расчета!
-                        
-                        ВАЖНО: Рассчитай калорийность для ВСЕГО видимого количества еды на фото, а не только для 100г!
-                        НЕ добавляй никаких дополнительных пояснений, расчетов или объяснений!"""
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Проанализируй это изображение еды и определи калорийность."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_base64}"
-                                }
-                            }
-                        ]
+            payload = template.build_payload(self.vision_model, [
+                {
+                    "type": "text",
+                    "text": "Проанализируй это изображение еды и определи калорийность."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{prepared['mime_type']};base64,{image_base64}",
+                        "detail": prepared['detail']
                     }
-                ],
-                "max_tokens": 500,
-                "temperature": 0.3
-            }
+                }
+            ])
+            # В режиме JSON ответ короткий и показывать его по частям незачем
+            structured = template.structured
+            if structured:
+                on_partial_text = None
             
             logger.info(f"Making API request to {self.base_url}chat/completions")
+            request_started = time.perf_counter()
             response = await self._make_request(
                 "POST",
                 f"{self.base_url}chat/completions",
+                endpoint='vision',
+                user_id=user_id,
+                priority=priority,
+                on_queue_position=on_queue_position,
+                on_partial_text=on_partial_text,
                 headers=headers,
                 json=payload
             )
@@ -254,139 +434,229 @@ class APIClient:
             logger.info(f"API response received: {response is not None}")
             if response:
                 logger.info(f"Response keys: {list(response.keys()) if isinstance(response, dict) else 'Not a dict'}")
+                self._record_image_metrics(prepared, time.perf_counter() - request_started, response.get('usage'))
+                template.record_usage(response.get('usage'))
             
             if response and "choices" in response:
-                result = response["choices"][0]["message"]["content"]
-                logger.info(f"Analysis result length: {len(result) if result else 0}")
+                result = self._parse_analysis_content(response["choices"][0]["message"]["content"], structured)
+                logger.info(f"Analysis result: {result.dish_name if result else None}, {result.calories if result else 0} ккал")
+                if not result:
+                    return None
                 # Сохраняем в кэш
-                self._set_cache(cache_key, result)
+                self._set_cache(cache_key, result.to_dict())
+                self.photo_hash_index.add(photo_hash, cache_key, is_alive=self._is_cached)
                 return result
             
             logger.error("No valid response from API")
             return None
             
+        except AIOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"Error analyzing image: {e}")
             return None
     
-    async def analyze_text(self, text: str) -> Optional[str]:
-        """Анализирует текстовое описание еды"""
+    async def analyze_images(self, images: List[bytes], description: Optional[str] = None,
+                             user_id: Optional[int] = None, priority: int = PRIORITY_DEFAULT,
+                             on_queue_position: Optional[Callable[[int], Any]] = None,
+                             on_partial_text: Optional[Callable[[str], Any]] = None) -> Optional[AnalysisResult]:
+        """
+        Анализирует несколько фото одного приема пищи (альбом) одним запросом
+        
+        Все изображения уходят в одном сообщении, модель возвращает один общий результат.
+        Одно фото без описания анализируется как обычно (с кэшем по похожести).
+        """
         try:
+            images = [data for data in images if data and 100 <= len(data) <= MAX_IMAGE_SIZE]
+            if not images:
+                logger.error("No valid images provided for album analysis")
+                return None
+            if len(images) == 1 and not description:
+                return await self.analyze_image(
+                    images[0], user_id=user_id, priority=priority,
+                    on_queue_position=on_queue_position, on_partial_text=on_partial_text
+                )
+            
+            # Ключ кэша - по всем фото в порядке альбома и описанию
+            template = prompt_registry.analysis('album', ANALYSIS_OUTPUT_FORMAT)
+            digests = b"".join(hashlib.md5(data).digest() for data in images)
+            cache_key = self._get_cache_key(digests + (description or "").encode('utf-8'), template.cache_tag)
+            cached_result = self._analysis_from_cache(await self._aget_from_cache(cache_key))
+            if cached_result:
+                return cached_result
+            
+            # Фото готовятся в пуле потоков одновременно
+            prepared_images = await asyncio.gather(*(
+                asyncio.to_thread(
+                    image_preprocessing.prepare_image_for_vision,
+                    data, VISION_IMAGE_DETAIL, VISION_JPEG_QUALITY, VISION_LOW_DETAIL_EDGE_THRESHOLD
+                )
+                for data in images
+            ))
+            
+            request_text = f"Проанализируй эти {len(images)} фото одного приема пищи и определи общую калорийность."
+            if description:
+                request_text += f"\n\nОписание пользователя: {description}"
+            content = [{"type": "text", "text": request_text}]
+            for prepared in prepared_images:
+                image_base64 = base64.b64encode(prepared['data']).decode('utf-8')
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{prepared['mime_type']};base64,{image_base64}",
+                        "detail": prepared['detail']
+                    }
+                })
+            
             headers = {
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             }
+            payload = template.build_payload(self.vision_model, content)
+            structured = template.structured
+            if structured:
+                on_partial_text = None
             
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": """Ты эксперт по анализу еды и подсчету калорий. 
-                        Проанализируй описание еды и предоставь информацию в следующем формате:
-                        
-                        🍽️ Анализ блюда:
-
-                        Название: [название блюда]
-                        Вес: [общий вес блюда]г
-                        Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
-
-                        📊 БЖУ на 100г:
-                        • Белки: [количество]г
-                        • Жиры: [количество]г  
-                        • Углеводы: [количество]г
-
-                        📈 Общее БЖУ в блюде:
-                        • Белки: [общее количество]г
-                        • Жиры: [общее количество]г
-                        • Углеводы: [общее количество]г
-                        
-                        ВАЖНО - СТАНДАРТНЫЕ ДАННЫЕ ДЛЯ ПОПУЛЯРНЫХ БЛЮД (на 100г):
-                        
-                        Плов классический:
-                        • Калорийность: 170-180 ккал/100г
-                        • Белки: 7-8г/100г
-                        • Жиры: 8-10г/100г
-                        • Углеводы: 25-30г/100г
-                        
-                        Гречка с мясом:
-                        • Калорийность: 150-160 ккал/100г
-                        • Белки: 8-10г/100г
-                        • Жиры: 6-8г/100г
-                        • Углеводы: 20-25г/100г
-                        
-                        Борщ с мясом:
-                        • Калорийность: 60-80 ккал/100г
-                        • Белки: 4-5г/100г
-                        • Жиры: 3-4г/100г
-                        • Углеводы: 6-8г/100г
-                        
-                        Используй эти стандартные данные как основу для расчета!
-                        
-                        НЕ добавляй никаких дополнительных пояснений, расчетов или объяснений!
-                        НЕ используй обратные слеши (\\) в числах!
-                        
-                        Пример правильного формата:
-                        • Белки: 0,3г (не 03г)
-                        • Жиры: 2,5г (не 25г)
-                        • Углеводы: 13,8г (не 138г)
-                        
-                        Используй запятую как десятичный разделитель: 0,3г вместо 0.3г"""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Проанализируй это описание еды и определи калорийность: {text}"
-                    }
-                ],
-                "max_tokens": 500,
-                "temperature": 0.3
+            logger.info(f"Making album API request with {len(images)} images")
+            request_started = time.perf_counter()
+            response = await self._make_request(
+                "POST",
+                f"{self.base_url}chat/completions",
+                endpoint='vision',
+                user_id=user_id,
+                priority=priority,
+                on_queue_position=on_queue_position,
+                on_partial_text=on_partial_text,
+                headers=headers,
+                json=payload
+            )
+            
+            if response:
+                request_time = time.perf_counter() - request_started
+                for prepared in prepared_images:
+                    self._record_image_metrics(prepared, request_time, response.get('usage'))
+                template.record_usage(response.get('usage'))
+            
+            if response and "choices" in response:
+                result = self._parse_analysis_content(response["choices"][0]["message"]["content"], structured)
+                if not result:
+                    return None
+                self._set_cache(cache_key, result.to_dict())
+                return result
+            
+            logger.error("No valid response from API for album")
+            return None
+            
+        except AIOverloadedError:
+            raise
+        except Exception as e:
+            logger.error(f"Error analyzing album: {e}")
+            return None
+    
+    async def analyze_text(self, text: str, user_id: Optional[int] = None,
+                           priority: int = PRIORITY_DEFAULT,
+                           on_partial_text: Optional[Callable[[str], Any]] = None) -> Optional[AnalysisResult]:
+        """Анализирует текстовое описание еды (on_partial_text получает текст ответа по мере генерации)"""
+        try:
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
             }
             
+            template = prompt_registry.analysis('text', ANALYSIS_OUTPUT_FORMAT)
+            payload = template.build_payload(
+                self.model, f"Проанализируй это описание еды и определи калорийность: {text}"
+            )
+            structured = template.structured
+            if structured:
+                on_partial_text = None
+            
             response = await self._make_request(
                 "POST",
                 f"{self.base_url}chat/completions",
+                user_id=user_id,
+                priority=priority,
+                on_partial_text=on_partial_text,
                 headers=headers,
                 json=payload
             )
             
             if response and "choices" in response:
-                return response["choices"][0]["message"]["content"]
+                template.record_usage(response.get('usage'))
+                return self._parse_analysis_content(response["choices"][0]["message"]["content"], structured)
             
             return None
             
+        except AIOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"Error analyzing text: {e}")
             return None
     
-    async def analyze_voice(self, update: Optional[Update] = None, context: Optional[ContextTypes.DEFAULT_TYPE] = None) -> Optional[str]:
-        """Анализирует голосовое описание еды через распознавание речи"""
+    async def analyze_supplement(self, previous_result: str, correction: str,
+                                 user_id: Optional[int] = None,
+                                 priority: int = PRIORITY_DEFAULT) -> Optional[AnalysisResult]:
+        """
+        Уточняет показанный анализ по дополнению пользователя
+
+        Вместо полного текста прежнего анализа отправляется его краткое представление
+        (числа без оформления) и само уточнение - запрос не растет от раунда к раунду.
+        """
         try:
-            from voice_handler import voice_handler
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
             
-            logger.info("Starting voice analysis with speech recognition")
+            template = prompt_registry.analysis('supplement', ANALYSIS_OUTPUT_FORMAT)
+            payload = template.build_payload(
+                self.model, f"Предыдущий результат: {previous_result}\nУточнение пользователя: {correction}"
+            )
+            
+            response = await self._make_request(
+                "POST",
+                f"{self.base_url}chat/completions",
+                user_id=user_id,
+                priority=priority,
+                headers=headers,
+                json=payload
+            )
+            
+            if response and "choices" in response:
+                template.record_usage(response.get('usage'))
+                return self._parse_analysis_content(response["choices"][0]["message"]["content"], template.structured)
+            
+            return None
+            
+        except AIOverloadedError:
+            raise
+        except Exception as e:
+            logger.error(f"Error analyzing supplement: {e}")
+            return None
+    
+    async def analyze_voice(self, update: Optional[Update] = None, context: Optional[ContextTypes.DEFAULT_TYPE] = None) -> Any:
+        """Анализирует голосовое описание еды через распознавание речи (распознанный текст - в voice_handler.transcribe_and_analyze)"""
+        try:
+            from voice_handler import voice_handler
             
             # Проверяем, что переданы необходимые параметры
             if update is None or context is None:
                 logger.error("analyze_voice requires update and context parameters")
                 return None
             
-            # Используем VoiceHandler для распознавания речи
-            recognized_text = await voice_handler.process_voice_message(update, context)
-            
-            if not recognized_text:
-                logger.warning("Voice recognition failed - no text returned")
-                return None
-            
-            logger.info(f"Voice recognition successful: '{recognized_text[:100]}...'")
-            
-            # Теперь анализируем распознанный текст через обычный API
-            return await self.analyze_text(recognized_text)
+            result = await voice_handler.transcribe_and_analyze(update, context)
+            if result.unavailable:
+                return "VOICE_TRANSCRIPTION_UNAVAILABLE"
+            return result.analysis
             
         except Exception as e:
             logger.error(f"Error analyzing voice: {e}")
             return None
     
-    async def analyze_photo_with_text(self, image_data: bytes, user_text: str) -> Optional[str]:
+    async def analyze_photo_with_text(self, image_data: bytes, user_text: str,
+                                      user_id: Optional[int] = None,
+                                      priority: int = PRIORITY_DEFAULT,
+                                      on_partial_text: Optional[Callable[[str], Any]] = None) -> Optional[AnalysisResult]:
         """Анализирует фото + текст пользователя для уточненного анализа"""
         try:
             headers = {
@@ -394,81 +664,44 @@ class APIClient:
                 "Content-Type": "application/json"
             }
             
-            # Сначала анализируем фото
-            photo_analysis = await self.analyze_image(image_data)
+            # Сначала анализируем фото - с тем же приоритетом, что и уточняющий запрос
+            photo_analysis = await self.analyze_image(image_data, user_id=user_id, priority=priority)
             if not photo_analysis:
                 logger.error("Failed to analyze photo")
                 return None
             
-            # Создаем объединенный промпт
-            combined_prompt = f"""
-Исходный анализ фото:
-{photo_analysis}
-
-Дополнительная информация от пользователя:
-{user_text}
-
-На основе анализа фото и дополнительной информации пользователя, предоставь уточненный анализ в следующем формате:
-
-🍽️ Анализ блюда:
-
-Название: [название блюда]
-Вес: [общий вес блюда]г
-Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
-
-📊 БЖУ на 100г:
-• Белки: [количество]г
-• Жиры: [количество]г  
-• Углеводы: [количество]г
-
-📈 Общее БЖУ в блюде:
-• Белки: [общее количество]г
-• Жиры: [общее количество]г
-• Углеводы: [общее количество]г
-
-Учти дополнительную информацию пользователя для более точного определения веса, ингредиентов и способа приготовления.
-"""
+            # Формат ответа - в системном промпте шаблона, здесь только данные запроса
+            template = prompt_registry.analysis('photo_text', ANALYSIS_OUTPUT_FORMAT)
+            payload = template.build_payload(
+                self.model,
+                f"Исходный анализ фото:\n{photo_analysis.text}\n\nДополнительная информация от пользователя:\n{user_text}"
+            )
+            if template.structured:
+                on_partial_text = None
             
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Ты эксперт по анализу еды и подсчету калорий. Используй анализ фото как основу и дополняй его информацией от пользователя для более точного результата."
-                    },
-                    {
-                        "role": "user",
-                        "content": combined_prompt
-                    }
-                ],
-                "max_tokens": 1000,
-                "temperature": 0.3
-            }
+            response = await self._make_request(
+                "POST",
+                f"{self.base_url}chat/completions",
+                user_id=user_id,
+                priority=priority,
+                on_partial_text=on_partial_text,
+                headers=headers,
+                json=payload
+            )
             
-            # Создаем SSL контекст
-            import ssl
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.post(
-                    f"{self.base_url}chat/completions",
-                    headers=headers,
-                    json=payload,
-                    timeout=self.timeout
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        analysis_text = result['choices'][0]['message']['content']
-                        logger.info(f"Photo+text analysis successful, result length: {len(analysis_text)}")
-                        return analysis_text
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"API error {response.status}: {error_text}")
-                        return None
+            if response and "choices" in response:
+                template.record_usage(response.get('usage'))
+                result = self._parse_analysis_content(response['choices'][0]['message']['content'], template.structured)
+                if not result:
+                    return None
+                logger.info(f"Photo+text analysis successful: {result.dish_name}, {result.calories} ккал")
+                return result
+            
+            logger.error("No valid response from API for photo+text analysis")
+            return None
                         
+        except AIOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"Error analyzing photo with text: {e}")
             return None
@@ -8,3 +8,4 @@ from handlers.misc import *
 from handlers.payments import *
 from handlers.profile import *
 from handlers._shared import *  # optional re-export of helpers/constants
+import reminder_commands  # registers reminder callback routes
@@ -0,0 +1,400 @@
+"""
+Общие (L2) бэкенды кэша для нескольких экземпляров бота
+
+Локальный CacheManager остается первым уровнем, а бэкенд хранит записи,
+доступные всем репликам, и рассылает им сообщения об инвалидации.
+"""
+import abc
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional, Any, Callable, Dict, Tuple, List
+from urllib.parse import urlparse
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+def serialize_entry(data: Any, expires_at: float) -> str:
+    """Сериализует запись кэша вместе со временем истечения"""
+    return json.dumps({'data': data, 'expires_at': expires_at}, ensure_ascii=False)
+
+def deserialize_entry(raw: Any) -> Optional[Tuple[Any, float]]:
+    """Возвращает (данные, оставшийся TTL) или None для поврежденной/устаревшей записи"""
+    try:
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        entry = json.loads(raw)
+        remaining = entry['expires_at'] - time.time()
+        if remaining <= 0:
+            return None
+        return entry['data'], remaining
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Failed to deserialize cache entry: {e}")
+        return None
+
+class CacheBackend(abc.ABC):
+    """Интерфейс общего кэша с рассылкой инвалидаций"""
+
+    def __init__(self):
+        # Идентификатор реплики: свои же инвалидации не обрабатываем повторно
+        self.instance_id = uuid.uuid4().hex
+        self.invalidation_handlers: Dict[str, Callable[[str], None]] = {}
+
+    def register_namespace(self, namespace: str, handler: Callable[[str], None]):
+        """Подписывает кэш пространства имен на инвалидации от других реплик"""
+        self.invalidation_handlers[namespace] = handler
+
+    def _dispatch_invalidation(self, full_key: str, origin: str):
+        """Передает инвалидацию локальному кэшу нужного пространства имен"""
+        if origin == self.instance_id:
+            return
+        namespace, _, key = full_key.partition(':')
+        handler = self.invalidation_handlers.get(namespace)
+        if handler:
+            handler(key)
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """Возвращает (данные, оставшийся TTL в секундах) или None"""
+
+    @abc.abstractmethod
+    async def set(self, key: str, data: Any, ttl: int) -> bool:
+        """Сохраняет данные с TTL и рассылает инвалидацию: реплики с прежним значением в L1 его сбросят"""
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> bool:
+        """Удаляет запись и рассылает инвалидацию остальным репликам"""
+
+    async def start(self):
+        """Запускает прием инвалидаций"""
+
+    async def close(self):
+        """Останавливает прием инвалидаций и освобождает ресурсы"""
+
+class SQLiteCacheBackend(CacheBackend):
+    """Общий кэш в SQLite-файле (реплики на одном хосте или общем томе)"""
+
+    def __init__(self, path: str, poll_interval: float = 2.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.last_invalidation_id = 0
+        self._poll_task: Optional[asyncio.Task] = None
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        """Соединение с фиксацией транзакции и закрытием по выходу"""
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ensure_tables(self):
+        """Создает таблицы записей и журнала инвалидаций"""
+        if self._initialized:
+            return
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+        self._initialized = True
+
+    def _get_sync(self, key: str) -> Optional[Tuple[Any, float]]:
+        self._ensure_tables()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM cache_entries WHERE key = ?", (key,)).fetchone()
+        return deserialize_entry(row[0]) if row else None
+
+    def _set_sync(self, key: str, data: Any, ttl: int):
+        self._ensure_tables()
+        expires_at = time.time() + ttl
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, serialize_entry(data, expires_at), expires_at)
+            )
+            conn.execute(
+                "INSERT INTO cache_invalidations (key, origin, created_at) VALUES (?, ?, ?)",
+                (key, self.instance_id, time.time())
+            )
+
+    def _delete_sync(self, key: str):
+        self._ensure_tables()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            conn.execute(
+                "INSERT INTO cache_invalidations (key, origin, created_at) VALUES (?, ?, ?)",
+                (key, self.instance_id, time.time())
+            )
+
+    def _poll_sync(self) -> List[Tuple[int, str, str]]:
+        """Читает новые инвалидации и удаляет устаревшие записи"""
+        self._ensure_tables()
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, key, origin FROM cache_invalidations WHERE id > ? ORDER BY id",
+                (self.last_invalidation_id,)
+            ).fetchall()
+            conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+            # Журнал инвалидаций нужен только репликам, которые опрашивают его сейчас
+            conn.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (now - 3600,))
+        return rows
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        try:
+            return await asyncio.to_thread(self._get_sync, key)
+        except Exception as e:
+            logger.error(f"SQLite cache get error: {e}")
+            return None
+
+    async def set(self, key: str, data: Any, ttl: int) -> bool:
+        try:
+            await asyncio.to_thread(self._set_sync, key, data, ttl)
+            return True
+        except Exception as e:
+            logger.error(f"SQLite cache set error: {e}")
+            return False
+
+    async def delete(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self._delete_sync, key)
+            return True
+        except Exception as e:
+            logger.error(f"SQLite cache delete error: {e}")
+            return False
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                for invalidation_id, key, origin in await asyncio.to_thread(self._poll_sync):
+                    self.last_invalidation_id = invalidation_id
+                    self._dispatch_invalidation(key, origin)
+            except Exception as e:
+                logger.error(f"SQLite cache invalidation poll error: {e}")
+
+    async def start(self):
+        def _current_max_id():
+            self._ensure_tables()
+            with self._connect() as conn:
+                return conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
+
+        # Инвалидации, случившиеся до запуска, не касаются пустого локального кэша
+        self.last_invalidation_id = await asyncio.to_thread(_current_max_id)
+        self._poll_task = asyncio.create_task(self._poll_loop())
+        logger.info(f"SQLite cache backend started: {self.path}")
+
+    async def close(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+class RedisError(Exception):
+    """Ошибка, возвращенная Redis-сервером"""
+
+class RedisCacheBackend(CacheBackend):
+    """Общий кэш на Redis (минимальный клиент протокола RESP на asyncio)"""
+
+    def __init__(self, url: str, channel: str = 'calorigram:cache:invalidate'):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.channel = channel
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self._subscriber_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _encode_command(*args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            value = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(f"${len(value)}\r\n".encode() + value + b"\r\n")
+        return b''.join(parts)
+
+    @staticmethod
+    async def _read_reply(reader: asyncio.StreamReader) -> Any:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            count = int(payload)
+            if count < 0:
+                return None
+            return [await RedisCacheBackend._read_reply(reader) for _ in range(count)]
+        raise RedisError(f"Unexpected Redis reply: {line!r}")
+
+    async def _open_connection(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(self._encode_command('AUTH', self.password))
+            await self._read_reply(reader)
+        if self.db:
+            writer.write(self._encode_command('SELECT', self.db))
+            await self._read_reply(reader)
+        return reader, writer
+
+    async def _pipeline(self, *commands: Tuple) -> List[Any]:
+        """
+        Отправляет команды одним пакетом на общем соединении и читает все ответы,
+        переподключаясь один раз при обрыве
+
+        Если обмен прерван до чтения всех ответов (обрыв, отмена задачи - например,
+        PhotoPrefetch.cancel()), соединение закрывается: иначе непрочитанные ответы
+        достались бы следующей команде и GET вернул бы значение чужого ключа.
+        """
+        async with self._lock:
+            for attempt in range(2):
+                completed = False
+                try:
+                    if self._writer is None or self._writer.is_closing():
+                        self._reader, self._writer = await self._open_connection()
+                    self._writer.write(b''.join(self._encode_command(*args) for args in commands))
+                    await self._writer.drain()
+                    replies, error = [], None
+                    for _ in commands:
+                        # Ошибку одной команды поднимаем после чтения всех ответов, чтобы не сбить соединение
+                        try:
+                            replies.append(await self._read_reply(self._reader))
+                        except RedisError as e:
+                            error = error or e
+                            replies.append(None)
+                    completed = True
+                    if error:
+                        raise error
+                    return replies
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    if attempt:
+                        raise
+                finally:
+                    if not completed:
+                        self._drop_connection()
+
+    def _drop_connection(self):
+        """Закрывает командное соединение - следующая команда откроет новое"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+
+    async def _command(self, *args) -> Any:
+        """Выполняет одну команду"""
+        replies = await self._pipeline(args)
+        return replies[0]
+
+    def _invalidation_command(self, key: str) -> Tuple:
+        return ('PUBLISH', self.channel, json.dumps({'key': key, 'origin': self.instance_id}))
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        try:
+            raw = await self._command('GET', key)
+            return deserialize_entry(raw) if raw is not None else None
+        except Exception as e:
+            logger.error(f"Redis cache get error: {e}")
+            return None
+
+    async def set(self, key: str, data: Any, ttl: int) -> bool:
+        try:
+            # TTL передается и в Redis (EX), и в саму запись для расчета остатка на L1;
+            # инвалидация уходит в том же пакете, без лишнего обхода до сервера
+            await self._pipeline(
+                ('SET', key, serialize_entry(data, time.time() + ttl), 'EX', max(1, int(ttl))),
+                self._invalidation_command(key),
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Redis cache set error: {e}")
+            return False
+
+    async def delete(self, key: str) -> bool:
+        try:
+            await self._pipeline(('DEL', key), self._invalidation_command(key))
+            return True
+        except Exception as e:
+            logger.error(f"Redis cache delete error: {e}")
+            return False
+
+    async def _subscribe_loop(self):
+        delay = 1.0
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._open_connection()
+                writer.write(self._encode_command('SUBSCRIBE', self.channel))
+                await writer.drain()
+                delay = 1.0
+                while True:
+                    reply = await self._read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        message = json.loads(reply[2])
+                        self._dispatch_invalidation(message['key'], message['origin'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Redis invalidation subscriber error: {e}, reconnecting in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+            finally:
+                if writer:
+                    writer.close()
+
+    async def start(self):
+        self._subscriber_task = asyncio.create_task(self._subscribe_loop())
+        logger.info(f"Redis cache backend started: {self.host}:{self.port}/{self.db}")
+
+    async def close(self):
+        if self._subscriber_task:
+            self._subscriber_task.cancel()
+            self._subscriber_task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+def create_cache_backend(kind: str, sqlite_path: str, redis_url: str) -> Optional[CacheBackend]:
+    """Создает общий бэкенд по настройке CACHE_BACKEND (memory - только локальный кэш)"""
+    kind = (kind or 'memory').lower()
+    if kind == 'sqlite':
+        return SQLiteCacheBackend(sqlite_path)
+    if kind == 'redis':
+        return RedisCacheBackend(redis_url)
+    if kind != 'memory':
+        logger.warning(f"Unknown CACHE_BACKEND '{kind}', using in-process cache only")
+    return None
@@ -1,11 +1,14 @@
 """
 Модуль для управления кэшем
 """
+import asyncio
 import time
 import hashlib
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Set
 from logging_config import get_logger
 from performance_optimizations import memory_optimizer
+from cache_backends import CacheBackend, create_cache_backend
+from config import CACHE_BACKEND, CACHE_SQLITE_PATH, REDIS_URL
 
 logger = get_logger(__name__)
 
@@ -131,8 +134,87 @@ class CacheManager:
             logger.error(f"Error clearing cache: {e}")
             return False
 
+class TwoTierCache:
+    """Двухуровневый кэш: локальный CacheManager (L1) и общий бэкенд для всех реплик (L2)"""
+    
+    def __init__(self, namespace: str, local: CacheManager, backend: Optional[CacheBackend] = None):
+        self.namespace = namespace
+        self.local = local
+        self.backend = backend
+        self.l2_hits = 0
+        self._pending: Set[asyncio.Task] = set()
+        if backend:
+            backend.register_namespace(namespace, self._on_remote_invalidation)
+    
+    def _full_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+    
+    def _on_remote_invalidation(self, key: str):
+        """Другая реплика перезаписала или удалила запись - убираем ее из L1"""
+        self.local.delete(key)
+    
+    def _schedule(self, coro):
+        """Запускает запись в L2 в фоне, не задерживая обработчик"""
+        try:
+            task = asyncio.get_running_loop().create_task(coro)
+        except RuntimeError:
+            # Нет запущенного event loop (например, при импорте) - пишем только в L1
+            coro.close()
+            return
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Получает данные только из L1"""
+        return self.local.get(key)
+    
+    async def aget(self, key: str) -> Optional[Any]:
+        """Получает данные из L1, а при промахе - из L2 с переносом в L1 на оставшийся TTL"""
+        data = self.local.get(key)
+        if data is not None or not self.backend:
+            return data
+        
+        entry = await self.backend.get(self._full_key(key))
+        if entry is None:
+            return None
+        data, remaining_ttl = entry
+        self.local.set(key, data, ttl=int(remaining_ttl))
+        self.l2_hits += 1
+        return data
+    
+    def set(self, key: str, data: Any, ttl: Optional[int] = None) -> bool:
+        """
+        Сохраняет данные в L1 и в фоне в L2 с тем же TTL; бэкенд рассылает инвалидацию,
+        чтобы реплики с прежним значением в L1 перечитали запись из L2
+        """
+        cache_ttl = ttl if ttl is not None else self.local.default_ttl
+        result = self.local.set(key, data, ttl=cache_ttl)
+        if self.backend:
+            self._schedule(self.backend.set(self._full_key(key), data, cache_ttl))
+        return result
+    
+    def delete(self, key: str) -> bool:
+        """Удаляет данные из L1, L2 и рассылает инвалидацию остальным репликам"""
+        result = self.local.delete(key)
+        if self.backend:
+            self._schedule(self.backend.delete(self._full_key(key)))
+        return result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику L1 и число попаданий в L2"""
+        stats = self.local.get_stats()
+        stats['l2_backend'] = type(self.backend).__name__ if self.backend else None
+        stats['l2_hits'] = self.l2_hits
+        return stats
+
+# Общий (L2) бэкенд кэша, выбирается переменной CACHE_BACKEND
+shared_cache_backend = create_cache_backend(CACHE_BACKEND, CACHE_SQLITE_PATH, REDIS_URL)
+
 # Глобальные экземпляры кэша для разных типов данных
 user_cache = CacheManager(default_ttl=600, max_size=500)  # 10 минут для пользователей
 analysis_cache = CacheManager(default_ttl=1800, max_size=200)  # 30 минут для анализов
 stats_cache = CacheManager(default_ttl=300, max_size=100)  # 5 минут для статистики
+transcription_cache = TwoTierCache(  # 1 час для распознанной речи
+    'transcription', CacheManager(default_ttl=3600, max_size=500), shared_cache_backend
+)
 
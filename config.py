@@ -39,6 +39,95 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # Модель для 
 OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini")  # Модель для анализа изображений
 OPENAI_WHISPER_MODEL = os.getenv("OPENAI_WHISPER_MODEL", "whisper-1")  # Модель для распознавания речи
 
+# Лимиты OpenAI по тарифу аккаунта (запросов и токенов в минуту) и честная доля на пользователя
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+OPENAI_CHAT_RPM = _env_float("OPENAI_CHAT_RPM", 500)
+OPENAI_CHAT_TPM = _env_float("OPENAI_CHAT_TPM", 200000)
+OPENAI_VISION_RPM = _env_float("OPENAI_VISION_RPM", 500)
+OPENAI_VISION_TPM = _env_float("OPENAI_VISION_TPM", 200000)
+OPENAI_WHISPER_RPM = _env_float("OPENAI_WHISPER_RPM", 50)
+USER_AI_REQUESTS_PER_MINUTE = _env_float("USER_AI_REQUESTS_PER_MINUTE", 6)
+USER_AI_BURST = _env_float("USER_AI_BURST", 3)
+
+# Одновременные запросы к ИИ: лимит на модель ("gpt-4o:4,gpt-4o-mini:12") и глубина очереди,
+# сверх которой запросы сразу отклоняются
+def _parse_model_limits(value: str) -> dict:
+    limits = {}
+    for item in value.split(','):
+        model, _, limit = item.strip().rpartition(':')
+        if model and limit.isdigit():
+            limits[model] = int(limit)
+    return limits
+
+AI_MAX_IN_FLIGHT = int(_env_float("AI_MAX_IN_FLIGHT", 10))
+AI_MAX_IN_FLIGHT_PER_MODEL = _parse_model_limits(os.getenv("AI_MAX_IN_FLIGHT_PER_MODEL", ""))
+AI_MAX_QUEUE_DEPTH = int(_env_float("AI_MAX_QUEUE_DEPTH", 50))
+
+# Повторы запросов к ИИ: пауза с джиттером (секунды), общий бюджет времени на запрос
+# пользователя с учетом очередей и повторов, circuit breaker по эндпоинтам
+RETRY_BASE_DELAY = _env_float("RETRY_BASE_DELAY", 0.5)
+RETRY_MAX_DELAY = _env_float("RETRY_MAX_DELAY", 8)
+AI_REQUEST_DEADLINE = _env_float("AI_REQUEST_DEADLINE", 60)
+CIRCUIT_FAILURE_THRESHOLD = int(_env_float("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RECOVERY_TIMEOUT = _env_float("CIRCUIT_RECOVERY_TIMEOUT", 30)
+
+# Хеджирование запросов к vision-модели: если ответа нет дольше текущего p90 задержки,
+# отправляется второй такой же запрос (не больше AI_HEDGE_MAX_EXTRA доли от всех запросов)
+AI_HEDGE_VISION = os.getenv("AI_HEDGE_VISION", "False").lower() == "true"
+AI_HEDGE_MAX_EXTRA = _env_float("AI_HEDGE_MAX_EXTRA", 0.05)
+
+# Распознавание речи: sequential (AssemblyAI только после неудачи Whisper), race (оба сервиса
+# сразу, первый результат побеждает) или hedge (AssemblyAI, если Whisper молчит дольше порога, секунды)
+TRANSCRIPTION_STRATEGY = os.getenv("TRANSCRIPTION_STRATEGY", "hedge").lower()
+TRANSCRIPTION_HEDGE_DELAY = _env_float("TRANSCRIPTION_HEDGE_DELAY", 4)
+
+# Одновременные загрузки фото и голосовых из Telegram (остальные ждут очереди)
+TELEGRAM_DOWNLOAD_CONCURRENCY = int(_env_float("TELEGRAM_DOWNLOAD_CONCURRENCY", 8))
+
+# Альбом: сколько секунд после последнего фото ждать следующие, прежде чем анализировать все фото вместе
+MEDIA_GROUP_WINDOW = _env_float("MEDIA_GROUP_WINDOW", 0.8)
+
+# Кэш анализов фото: максимальное расстояние Хэмминга между перцептивными хэшами,
+# при котором фото считаются одинаковыми (0 - отключить поиск похожих фото, кэш только
+# по точному совпадению байтов). Индекс общий для всех пользователей: при большом пороге
+# похоже снятая, но другая тарелка получит чужой анализ. По умолчанию выключено;
+# если включать - не больше 2-3 из 64 бит dHash
+try:
+    PHOTO_HASH_MAX_DISTANCE = int(os.getenv("PHOTO_HASH_MAX_DISTANCE", "0"))
+except ValueError:
+    PHOTO_HASH_MAX_DISTANCE = 0
+
+# Формат ответа ИИ при анализе: text (ответ показывается пользователю по мере генерации,
+# числа разбираются из текста) или json (structured output по схеме: точные числа и меньше
+# выходных токенов, но без потокового показа - сообщение обновляется только в конце)
+ANALYSIS_OUTPUT_FORMAT = os.getenv("ANALYSIS_OUTPUT_FORMAT", "text").lower()
+
+# Подготовка фото для vision-модели: detail (auto, low, high), качество JPEG и порог
+# детализации сцены, ниже которого в режиме auto используется low (0 - только по размеру)
+VISION_IMAGE_DETAIL = os.getenv("VISION_IMAGE_DETAIL", "auto").lower()
+VISION_JPEG_QUALITY = int(_env_float("VISION_JPEG_QUALITY", 85))
+VISION_LOW_DETAIL_EDGE_THRESHOLD = _env_float("VISION_LOW_DETAIL_EDGE_THRESHOLD", 0)
+
+# Локальная база продуктов: JSON-файл с начальными данными и порог сходства названий (0..1)
+FOOD_SEED_PATH = os.getenv("FOOD_SEED_PATH", "")
+try:
+    FOOD_KB_MIN_SIMILARITY = float(os.getenv("FOOD_KB_MIN_SIMILARITY", "0.8"))
+except ValueError:
+    FOOD_KB_MIN_SIMILARITY = 0.8
+# Сколько разных пользователей должны подтвердить продукт, прежде чем база ответит им без ИИ
+# (начальные данные из FOOD_SEED_PATH считаются проверенными)
+FOOD_KB_MIN_CONFIRMATIONS = int(_env_float("FOOD_KB_MIN_CONFIRMATIONS", 3))
+
+# Общий кэш для нескольких реплик: memory (только в процессе), sqlite или redis
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "cache.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 # Database Configuration
 DATABASE_PATH = os.getenv("DATABASE_PATH", "users.db")
 
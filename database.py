@@ -1416,3 +1416,109 @@ def mark_payment_processed(provider_charge_id: str, telegram_id: int, amount: in
     except Exception as e:
         logger.error(f"mark_payment_processed error: {e}")
         return False
+
+
+# === Локальная база продуктов (значения на 100г из подтвержденных анализов) ===
+def ensure_food_items_table():
+    """Создаёт таблицы food_items и food_item_confirmations (если нет)."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS food_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    display_name TEXT NOT NULL,
+                    calories_100g REAL NOT NULL,
+                    protein_100g REAL DEFAULT 0,
+                    fat_100g REAL DEFAULT 0,
+                    carbs_100g REAL DEFAULT 0,
+                    confirmations INTEGER DEFAULT 0,
+                    source TEXT DEFAULT 'confirmed',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Кто подтверждал продукт: локальный ответ выдается, только когда его подтвердили разные пользователи
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS food_item_confirmations (
+                    name TEXT NOT NULL,
+                    telegram_id INTEGER NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (name, telegram_id)
+                )
+            ''')
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"ensure_food_items_table error: {e}")
+        return False
+
+def upsert_food_item(name: str, display_name: str, calories_100g: float, protein_100g: float,
+                     fat_100g: float, carbs_100g: float, source: str = 'confirmed',
+                     telegram_id: Optional[int] = None) -> bool:
+    """Добавляет продукт или усредняет его значения с новым подтверждением (telegram_id - кто подтвердил)"""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            if source == 'seed':
+                # Начальные данные не перезаписывают то, что уже подтвердили пользователи
+                c.execute('''
+                    INSERT OR IGNORE INTO food_items
+                        (name, display_name, calories_100g, protein_100g, fat_100g, carbs_100g, confirmations, source)
+                    VALUES (?, ?, ?, ?, ?, ?, 0, 'seed')
+                ''', (name, display_name, calories_100g, protein_100g, fat_100g, carbs_100g))
+            else:
+                c.execute('''
+                    INSERT INTO food_items
+                        (name, display_name, calories_100g, protein_100g, fat_100g, carbs_100g, confirmations, source)
+                    VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        calories_100g = (calories_100g * confirmations + excluded.calories_100g) / (confirmations + 1),
+                        protein_100g = (protein_100g * confirmations + excluded.protein_100g) / (confirmations + 1),
+                        fat_100g = (fat_100g * confirmations + excluded.fat_100g) / (confirmations + 1),
+                        carbs_100g = (carbs_100g * confirmations + excluded.carbs_100g) / (confirmations + 1),
+                        confirmations = confirmations + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (name, display_name, calories_100g, protein_100g, fat_100g, carbs_100g, source))
+                if telegram_id is not None:
+                    c.execute(
+                        "INSERT OR IGNORE INTO food_item_confirmations (name, telegram_id) VALUES (?, ?)",
+                        (name, telegram_id)
+                    )
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"upsert_food_item error: {e}")
+        return False
+
+# Продукт и число разных пользователей, подтвердивших его
+FOOD_ITEM_SELECT = '''
+    SELECT f.*, (SELECT COUNT(*) FROM food_item_confirmations fc WHERE fc.name = f.name) AS confirmed_users
+    FROM food_items f
+'''
+
+def get_food_item(name: str) -> Optional[Dict[str, Any]]:
+    """Возвращает продукт по нормализованному имени"""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(FOOD_ITEM_SELECT + " WHERE f.name = ?", (name,))
+            row = c.fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"get_food_item error: {e}")
+        return None
+
+def get_all_food_items() -> List[Dict[str, Any]]:
+    """Возвращает все продукты локальной базы"""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(FOOD_ITEM_SELECT)
+            return [dict(row) for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"get_all_food_items error: {e}")
+        return []
+
+# Таблицы базы продуктов создаются один раз при инициализации базы
+ensure_food_items_table()
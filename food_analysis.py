@@ -31,13 +31,13 @@ class FoodAnalyzer:
                 if not analysis_result:
                     return {"success": False, "error": "Не удалось проанализировать фото"}
                 
-                # Извлекаем данные из анализа
-                calories = self._extract_calories(analysis_result)
-                dish_name = self._extract_dish_name(analysis_result)
+                # Клиент API возвращает уже разобранный анализ
+                calories = analysis_result.calories
+                dish_name = analysis_result.dish_name
                 
                 return {
                     "success": True,
-                    "analysis": analysis_result,
+                    "analysis": analysis_result.text,
                     "calories": calories,
                     "dish_name": dish_name
                 }
@@ -66,9 +66,9 @@ class FoodAnalyzer:
                 if not analysis_result:
                     return {"success": False, "error": "Не удалось проанализировать описание"}
                 
-                # Извлекаем данные из анализа
-                calories = self._extract_calories(analysis_result)
-                dish_name = self._extract_dish_name(analysis_result)
+                # Клиент API возвращает уже разобранный анализ
+                calories = analysis_result.calories
+                dish_name = analysis_result.dish_name
                 
                 # Проверяем качество анализа
                 if not calories and not dish_name:
@@ -79,7 +79,7 @@ class FoodAnalyzer:
                 
                 return {
                     "success": True,
-                    "analysis": analysis_result,
+                    "analysis": analysis_result.text,
                     "calories": calories,
                     "dish_name": dish_name
                 }
@@ -64,6 +64,7 @@ from handlers.misc import (
 
 from services.food_analysis_service import (
     extract_weight_from_description as extract_weight_from_service,
+    extract_calories_per_100g_from_analysis as extract_calories_per_100g_from_service,
     extract_calories_from_analysis as extract_calories_from_service,
     extract_macros_from_analysis as extract_macros_from_service,
     extract_dish_name_from_analysis as extract_dish_name_from_service,
@@ -91,32 +92,7 @@ def extract_weight_from_description(description: str) -> Optional[float]:
 
 def extract_calories_per_100g_from_analysis(analysis_text: str) -> Optional[int]:
     """Извлекает калорийность на 100г из текста анализа"""
-    try:
-        if not analysis_text or not isinstance(analysis_text, str):
-            return None
-            
-        # Ищем паттерны калорийности на 100г
-        patterns = [
-            r'(\d+)\s*ккал/100г',
-            r'(\d+)\s*ккал/100\s*г',
-            r'(\d+)\s*ккал\s*на\s*100\s*г',
-            r'(\d+)\s*ккал\s*на\s*100г',
-            r'калорийность\s*на\s*100г:\s*(\d+)',
-            r'калорийность\s*на\s*100\s*г:\s*(\d+)',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, analysis_text, re.IGNORECASE)
-            if match:
-                calories = int(match.group(1))
-                if 10 <= calories <= 1000:  # Разумные пределы для калорийности на 100г
-                    logger.info(f"Extracted calories per 100g: {calories} from pattern: {pattern}")
-                    return calories
-        
-        return None
-    except Exception as e:
-        logger.warning(f"Error extracting calories per 100g: {e}")
-        return None
+    return extract_calories_per_100g_from_service(analysis_text)
 
 # Используем функцию из сервиса анализа
 def extract_calories_from_analysis(analysis_text: str) -> Optional[int]:
@@ -397,18 +373,18 @@ async def send_broadcast_message(bot, message_text: str, admin_id: int) -> dict:
 
 
 # Используем функцию из сервиса анализа
-async def analyze_food_photo(image_data: bytes):
+async def analyze_food_photo(image_data: bytes, file_unique_id: str = None, user_id: int = None):
     """Анализирует фотографию еды с помощью API"""
-    return await analyze_food_photo_from_service(image_data)
+    return await analyze_food_photo_from_service(image_data, file_unique_id=file_unique_id, user_id=user_id)
 
 # Используем функции из сервиса анализа
-async def analyze_food_text(description: str):
+async def analyze_food_text(description: str, user_id: int = None):
     """Анализирует текстовое описание блюда с помощью API"""
-    return await analyze_food_text_from_service(description)
+    return await analyze_food_text_from_service(description, user_id=user_id)
 
-async def analyze_food_supplement(combined_prompt: str):
-    """Анализирует комбинированный промпт для дополнения анализа фото"""
-    return await analyze_food_supplement_from_service(combined_prompt)
+async def analyze_food_supplement(previous_result: str, additional_text: str, user_id: int = None):
+    """Уточняет показанный анализ по дополнению пользователя"""
+    return await analyze_food_supplement_from_service(previous_result, additional_text, user_id=user_id)
 
 async def transcribe_voice(audio_data: bytes):
     """Распознает речь из аудиофайла с помощью API
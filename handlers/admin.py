@@ -1,5 +1,6 @@
 # Auto-generated module for admin handlers extracted from bot_functions.py
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 
 # Импортируем необходимые функции напрямую
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -8,6 +9,11 @@ from database import get_db_connection, get_user_count, get_meals_count, get_dai
 from constants import ADMIN_CALLBACKS, GOALS
 from config import ADMIN_IDS
 from logging_config import get_logger
+from performance_optimizations import ai_admission
+from prompts import prompt_registry
+from resilience import circuit_breakers, vision_hedger
+from voice_handler import transcription_orchestrator
+from services.telegram_files import telegram_files
 from datetime import datetime, timedelta
 
 logger = get_logger(__name__)
@@ -80,6 +86,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 __all__.append('admin_command')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_panel'])
 async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает админ панель"""
     try:
@@ -123,6 +130,7 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🍽️ Последние приемы пищи", callback_data=ADMIN_CALLBACKS['admin_meals'])],
             [InlineKeyboardButton("⭐ Управление подписками", callback_data=ADMIN_CALLBACKS['admin_subscriptions'])],
             [InlineKeyboardButton("💎 Баланс Stars", callback_data="admin_star_balance")],
+            [InlineKeyboardButton("🛡 Состояние ИИ", callback_data="admin_ai_health")],
             [InlineKeyboardButton("📢 Рассылка", callback_data=ADMIN_CALLBACKS['admin_broadcast'])],
             [InlineKeyboardButton("🔙 Главное меню", callback_data=ADMIN_CALLBACKS['admin_back'])]
         ]
@@ -142,10 +150,10 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 __all__.append('show_admin_panel')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_stats'])
 async def handle_admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -189,6 +197,29 @@ async def handle_admin_stats_callback(update: Update, context: ContextTypes.DEFA
 • Воскресенье: {daily_stats['meals_today']} записей
         """
         
+        # Загрузка очередей к моделям ИИ
+        queue_stats = ai_admission.get_stats()
+        if queue_stats:
+            stats_text += "\n🤖 **Очереди к ИИ:**\n"
+            for model, model_stats in queue_stats.items():
+                stats_text += (
+                    f"• {model}: в работе {model_stats['in_flight']}/{model_stats['limit']}, "
+                    f"в очереди {model_stats['queued']}, отклонено {model_stats['rejected']}\n"
+                    f"  ожидание: среднее {model_stats['avg_wait']:.1f}с, p95 {model_stats['p95_wait']:.1f}с, "
+                    f"макс {model_stats['max_wait']:.1f}с\n"
+                )
+        
+        # Расход токенов промпта по шаблонам (и доля, взятая из кэша провайдера)
+        prompt_stats = prompt_registry.get_stats()
+        if prompt_stats:
+            stats_text += "\n📝 **Промпты:**\n"
+            for name, template_stats in prompt_stats.items():
+                stats_text += (
+                    f"• {name.replace('_', ' ')}: {template_stats['requests']} запросов, "
+                    f"~{template_stats['avg_prompt_tokens']:.0f} токенов, "
+                    f"из кэша {template_stats['cached_fraction']:.0%}\n"
+                )
+        
         keyboard = [
             [InlineKeyboardButton("🔙 Назад в админку", callback_data=ADMIN_CALLBACKS['admin_panel'])]
         ]
@@ -207,10 +238,10 @@ async def handle_admin_stats_callback(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_admin_stats_callback')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_users'])
 async def handle_admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Пользователи' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -263,10 +294,10 @@ async def handle_admin_users_callback(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_admin_users_callback')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_broadcast'])
 async def handle_admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Рассылка' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -293,10 +324,10 @@ async def handle_admin_broadcast_callback(update: Update, context: ContextTypes.
 
 __all__.append('handle_admin_broadcast_callback')
 
+@callback_router.route("broadcast_create")
 async def handle_broadcast_create_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик создания рассылки"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -330,10 +361,10 @@ async def handle_broadcast_create_callback(update: Update, context: ContextTypes
 
 __all__.append('handle_broadcast_create_callback')
 
+@callback_router.route("broadcast_stats")
 async def handle_broadcast_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик статистики рассылок"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -361,10 +392,10 @@ async def handle_broadcast_stats_callback(update: Update, context: ContextTypes.
 
 __all__.append('handle_broadcast_stats_callback')
 
+@callback_router.route("broadcast_confirm")
 async def handle_broadcast_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик подтверждения рассылки"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -409,10 +440,10 @@ async def handle_broadcast_confirm_callback(update: Update, context: ContextType
 
 __all__.append('handle_broadcast_confirm_callback')
 
+@callback_router.route("broadcast_cancel")
 async def handle_broadcast_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик отмены рассылки"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем состояние
     context.user_data.pop('waiting_for_broadcast_text', None)
@@ -456,10 +487,10 @@ async def handle_broadcast_text_input(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_broadcast_text_input')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_back'])
 async def handle_admin_back_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Главное меню' в админке"""
     query = update.callback_query
-    await query.answer()
     
     await query.edit_message_text(
         "🏠 **Главное меню**\n\n"
@@ -470,10 +501,10 @@ async def handle_admin_back_callback(update: Update, context: ContextTypes.DEFAU
 
 __all__.append('handle_admin_back_callback')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_subscriptions'])
 async def handle_admin_subscriptions_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Управление подписками' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -502,10 +533,10 @@ async def handle_admin_subscriptions_callback(update: Update, context: ContextTy
 
 __all__.append('handle_admin_subscriptions_callback')
 
+@callback_router.route(ADMIN_CALLBACKS['admin_check_subscription'])
 async def handle_admin_check_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Проверить подписку' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -526,10 +557,10 @@ async def handle_admin_check_subscription_callback(update: Update, context: Cont
 
 __all__.append('handle_admin_check_subscription_callback')
 
+@callback_router.route(prefixes=(ADMIN_CALLBACKS['admin_activate_trial'] + ':',))
 async def handle_admin_activate_trial_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик активации триального периода"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -568,10 +599,10 @@ async def handle_admin_activate_trial_callback(update: Update, context: ContextT
 
 __all__.append('handle_admin_activate_trial_callback')
 
+@callback_router.route(prefixes=(ADMIN_CALLBACKS['admin_activate_premium'] + ':',))
 async def handle_admin_activate_premium_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик активации премиум подписки"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -610,10 +641,10 @@ async def handle_admin_activate_premium_callback(update: Update, context: Contex
 
 __all__.append('handle_admin_activate_premium_callback')
 
+@callback_router.route(prefixes=(ADMIN_CALLBACKS['admin_deactivate_subscription'] + ':',))
 async def handle_admin_deactivate_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик деактивации подписки"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -719,7 +750,6 @@ __all__.append('handle_admin_telegram_id_input')
 async def handle_statistics_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика'"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -773,7 +803,6 @@ __all__.append('handle_statistics_callback')
 async def handle_stats_today_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'За сегодня'"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -865,7 +894,6 @@ __all__.append('handle_stats_today_callback')
 async def handle_stats_yesterday_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'За вчера'"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -961,7 +989,6 @@ __all__.append('handle_stats_yesterday_callback')
 async def handle_stats_week_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'За неделю'"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -1049,10 +1076,10 @@ async def handle_stats_week_callback(update: Update, context: ContextTypes.DEFAU
 
 __all__.append('handle_stats_week_callback')
 
+@callback_router.route("admin_star_balance")
 async def handle_admin_star_balance_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Баланс Stars' в админке"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -1119,10 +1146,129 @@ async def handle_admin_star_balance_callback(update: Update, context: ContextTyp
 
 __all__.append('handle_admin_star_balance_callback')
 
+CIRCUIT_STATE_LABELS = {
+    'closed': '🟢 работает',
+    'half_open': '🟡 пробный запрос',
+    'open': '🔴 отключен',
+}
+
+@callback_router.route("admin_ai_health", "admin_ai_health_reset")
+async def handle_admin_ai_health_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопки 'Состояние ИИ' в админке: circuit breaker'ы внешних сервисов"""
+    query = update.callback_query
+    
+    user = update.effective_user
+    
+    if user.id not in ADMIN_IDS:
+        await query.message.reply_text("❌ У вас нет прав администратора.")
+        return
+    
+    try:
+        if query.data == "admin_ai_health_reset":
+            circuit_breakers.reset_all()
+            logger.info(f"Admin {user.id} reset AI circuit breakers")
+        
+        breaker_stats = circuit_breakers.get_stats()
+        if breaker_stats:
+            lines = []
+            for name, stats in sorted(breaker_stats.items()):
+                line = f"• {name}: {CIRCUIT_STATE_LABELS.get(stats['state'], stats['state'])}"
+                if stats['state'] == 'open':
+                    line += f", проба через {stats['retry_in']:.0f}с"
+                line += f"\n  сбоев подряд: {stats['consecutive_failures']}, всего: {stats['total_failures']}, " \
+                        f"отклонено: {stats['rejected']}"
+                lines.append(line)
+            breakers_text = "\n".join(lines)
+        else:
+            breakers_text = "Запросов к сервисам ИИ еще не было"
+        
+        # Хеджирование запросов к vision-модели
+        hedge_stats = vision_hedger.get_stats()
+        if vision_hedger.enabled and hedge_stats['requests']:
+            hedge_delay = hedge_stats['hedge_delay']
+            breakers_text += (
+                f"\n\n⚡ **Хеджирование фото:** {hedge_stats['hedges']} из {hedge_stats['requests']} "
+                f"({hedge_stats['hedge_rate']:.1%}), второй запрос быстрее: {hedge_stats['hedge_wins']}\n"
+                f"порог: {f'{hedge_delay:.1f}с' if hedge_delay is not None else 'накопление данных'}, "
+                f"p99: {hedge_stats['p99']:.1f}с, пропущено из-за лимитов: {hedge_stats['hedges_throttled']}"
+            )
+        
+        # Распознавание речи: задержка и доля побед каждого сервиса
+        transcription_stats = transcription_orchestrator.get_stats()
+        if transcription_stats['providers']:
+            breakers_text += (
+                f"\n\n🎤 **Распознавание речи** ({transcription_stats['strategy']}): "
+                f"p50 {transcription_stats['p50']:.1f}с, p95 {transcription_stats['p95']:.1f}с"
+            )
+            for name, stats in sorted(transcription_stats['providers'].items()):
+                breakers_text += (
+                    f"\n• {name}: побед {stats['wins']} из {stats['requests']} ({stats['win_rate']:.0%}), "
+                    f"p50 {stats['p50']:.1f}с, p95 {stats['p95']:.1f}с"
+                )
+        
+        # Загрузка файлов из Telegram: задержка и ошибки по типам файлов
+        download_stats = telegram_files.get_stats()
+        if download_stats['kinds']:
+            breakers_text += (
+                f"\n\n📥 **Загрузка файлов** (одновременно до {download_stats['max_concurrent']}, "
+                f"сейчас {download_stats['in_progress']})"
+            )
+            for kind, stats in sorted(download_stats['kinds'].items()):
+                failures = sum(stats['failures'].values())
+                breakers_text += (
+                    f"\n• {kind}: {stats['downloads']} шт, p50 {stats['p50'] * 1000:.0f}мс, "
+                    f"p95 {stats['p95'] * 1000:.0f}мс, ожидание p95 {stats['p95_wait'] * 1000:.0f}мс, ошибок {failures}"
+                )
+        
+        # Кнопки: самые медленные маршруты callback-запросов
+        route_stats = callback_router.get_stats()
+        if route_stats:
+            breakers_text += "\n\n🔘 **Кнопки** (самые медленные, p95)"
+            slowest = sorted(route_stats.items(), key=lambda item: item[1]['p95'], reverse=True)[:5]
+            for name, stats in slowest:
+                # Подчеркивания в callback_data ломают Markdown
+                name = name.replace('_', '\\_').replace('*', '\\*')
+                breakers_text += (
+                    f"\n• {name}: {stats['calls']} нажатий, p50 {stats['p50'] * 1000:.0f}мс, "
+                    f"p95 {stats['p95'] * 1000:.0f}мс, ошибок {stats['errors']}"
+                )
+        
+        health_text = f"""
+🛡 **Состояние сервисов ИИ**
+
+{breakers_text}
+
+🔄 **Обновлено:** {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}
+        """
+        
+        keyboard = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_ai_health")],
+            [InlineKeyboardButton("♻️ Сбросить", callback_data="admin_ai_health_reset")],
+            [InlineKeyboardButton("🔙 Админ панель", callback_data=ADMIN_CALLBACKS['admin_panel'])]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.message.reply_text(
+            health_text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in handle_admin_ai_health_callback: {e}")
+        await query.message.reply_text(
+            "❌ Произошла ошибка при получении состояния ИИ. Попробуйте позже.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Админ панель", callback_data=ADMIN_CALLBACKS['admin_panel'])]
+            ])
+        )
+
+__all__.append('handle_admin_ai_health_callback')
+
+@callback_router.route(ADMIN_CALLBACKS['admin_meals'])
 async def handle_admin_meals_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик просмотра последних приемов пищи"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
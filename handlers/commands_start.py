@@ -1,6 +1,7 @@
 # Auto-generated module for commands_start handlers extracted from bot_functions.py
 from ._shared import *  # imports, constants, helpers
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 
 __all__ = []
 
@@ -16,16 +17,17 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 __all__.append('start_command')
 
+@callback_router.route("help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     return await help_command_from_handler(update, context)
 
 __all__.append('help_command')
 
+@callback_router.route("menu_from_meal_selection")
 async def handle_menu_from_meal_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Меню' из меню выбора приема пищи - отправляет новое сообщение"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     await query.message.reply_text(
@@ -92,6 +94,7 @@ async def show_admin_manage_subscription_menu(update: Update, context: ContextTy
 
 __all__.append('show_admin_manage_subscription_menu')
 
+@callback_router.route("subscription", "buy_subscription")
 async def show_subscription_purchase_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает меню покупки подписки"""
     query = update.callback_query
@@ -1,56 +1,54 @@
 # Auto-generated module for media handlers extracted from bot_functions.py
 from ._shared import *  # imports, constants, helpers
-from database import add_meal, add_calorie_check
+from typing import List
+from database import add_calorie_check
+from config import MEDIA_GROUP_WINDOW
 from constants import MAX_IMAGE_SIZE, MAX_AUDIO_SIZE
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 from handlers.menu import get_main_menu_keyboard_for_user
+from handlers.subscription import get_flow_ai_request_priority, remember_subscription_access
+from performance_optimizations import AIOverloadedError
+from utils.message_streaming import ProgressiveMessageEditor, DeferredMessage
 from services.food_analysis_service import (
     analyze_food_photo_with_text, 
     analyze_food_photo,
-    is_valid_analysis,
-    remove_explanations_from_analysis,
-    extract_macros_from_analysis,
-    extract_dish_name_from_analysis,
+    analyze_food_photos,
+    get_cached_photo_analysis,
     clean_markdown_text
 )
+from models.analysis import AnalysisResult
+from services.pending_analysis import PendingAnalysis, store_pending_analysis
+from services.telegram_files import telegram_files, FileDownloadError
+from voice_handler import voice_handler
 from logging_config import get_logger
-import aiohttp
 
 logger = get_logger(__name__)
 
 __all__ = []
 
-def validate_image_file(file_data: bytes) -> bool:
-    """Валидация изображения по содержимому файла"""
-    try:
-        # Проверяем размер файла
-        if len(file_data) > MAX_IMAGE_SIZE:
-            return False
-        
-        # Проверяем магические байты для определения типа файла
-        if file_data.startswith(b'\xff\xd8\xff'):  # JPEG
-            return True
-        elif file_data.startswith(b'\x89PNG\r\n\x1a\n'):  # PNG
-            return True
-        elif file_data.startswith(b'RIFF') and b'WEBP' in file_data[:12]:  # WebP
-            return True
-        elif file_data.startswith(b'GIF87a') or file_data.startswith(b'GIF89a'):  # GIF
-            return True
-        else:
-            return False
-    except Exception as e:
-        logger.error(f"Error validating image file: {e}")
-        return False
+def photo_download_error_text(error: FileDownloadError) -> str:
+    """Сообщение пользователю о неудачной загрузке фото"""
+    if error.reason == 'too_large':
+        return (f"❌ **Файл слишком большой**\n\n"
+                f"Размер фотографии превышает {MAX_IMAGE_SIZE // (1024 * 1024)}MB. Пожалуйста, отправьте фото меньшего размера.")
+    if error.reason == 'invalid_format':
+        return ("❌ **Неподдерживаемый формат файла**\n\n"
+                "Пожалуйста, отправьте изображение в формате JPEG, PNG или WebP.")
+    status = f"Код ошибки: {error.status}\n" if error.status else ""
+    return ("❌ **Ошибка при загрузке фотографии**\n\n"
+            f"{status}Попробуйте отправить фото еще раз или используйте команду /addphoto")
 
+@callback_router.route("check_photo_text")
 async def handle_check_photo_text_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Фото + Текст' для проверки калорий"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Проверяем подписку и лимит использований
     access_info = check_subscription_access(user.id)
+    remember_subscription_access(context, access_info)
     if not access_info['has_access']:
         daily_checks = get_daily_calorie_checks_count(user.id)
         if daily_checks >= 3:
@@ -97,6 +95,197 @@ async def handle_check_photo_text_callback(update: Update, context: ContextTypes
 
 __all__.append('handle_check_photo_text_callback')
 
+AI_OVERLOADED_MESSAGE = (
+    "⏳ **Сервис анализа сейчас перегружен**\n\n"
+    "Слишком много запросов одновременно. Пожалуйста, попробуйте через минуту."
+)
+
+def make_queue_position_callback(processing_msg, processing_text: str):
+    """Возвращает callback, который показывает позицию в очереди к ИИ в сообщении об обработке"""
+    async def show_queue_position(position: int):
+        if position:
+            text = (
+                "⏳ **Фотография в очереди на анализ**\n\n"
+                f"Ваша позиция в очереди: {position}. Анализ начнется автоматически."
+            )
+        else:
+            text = processing_text
+        try:
+            await processing_msg.edit_text(text, parse_mode='Markdown')
+        except TelegramError as e:
+            logger.debug(f"Failed to update queue position message: {e}")
+    return show_queue_position
+
+# Ключ в context.user_data: запущенные загрузки фото по message_id
+PHOTO_PREFETCH_KEY = 'photo_prefetch'
+
+class PhotoPrefetch:
+    """
+    Поиск готового анализа и скачивание фото, запущенные сразу при получении сообщения
+    
+    Скачивание идет параллельно с проверками пользователя в базе и отправкой сообщения
+    об обработке; если анализ нашелся по file_unique_id, скачивание отменяется.
+    """
+    
+    def __init__(self, bot, message, lookup_cache: bool = True):
+        photo = message.photo[-1]  # Берем фото в наилучшем качестве
+        self.message_id = message.message_id
+        self.cached_task = (asyncio.create_task(get_cached_photo_analysis(photo.file_unique_id))
+                            if lookup_cache else None)
+        self.download_task = asyncio.create_task(
+            telegram_files.download(bot, photo.file_id, 'photo', MAX_IMAGE_SIZE, file_size=photo.file_size)
+        )
+        # Ошибка отмененной или ненужной загрузки не должна попадать в лог как "never retrieved"
+        self.download_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    
+    async def cached_analysis(self) -> Optional[AnalysisResult]:
+        """Ранее полученный анализ этого фото; при попадании скачивание отменяется"""
+        if self.cached_task is None:
+            return None
+        result = await self.cached_task
+        if result:
+            self.cancel()
+        return result
+    
+    async def image(self) -> bytes:
+        """Байты фото (FileDownloadError, если скачать не удалось)"""
+        return await self.download_task
+    
+    def cancel(self):
+        for task in (self.cached_task, self.download_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def edit_or_reply(processing_msg: DeferredMessage, message, text: str, **kwargs):
+    """
+    Сообщение об ошибке: правка сообщения об обработке, а если его не удалось отправить
+    (flood wait, сеть) или изменить - новый ответ пользователю
+    """
+    try:
+        return await processing_msg.edit_text(text, **kwargs)
+    except Exception as e:
+        logger.warning(f"Failed to edit processing message: {e}")
+        return await message.reply_text(text, **kwargs)
+
+async def download_photos(prefetches: List[PhotoPrefetch]) -> List[bytes]:
+    """Байты фото по порядку; не скачавшиеся пропускаются (ошибка - только если не скачалось ни одно)"""
+    results = await asyncio.gather(*(prefetch.image() for prefetch in prefetches), return_exceptions=True)
+    images = [result for result in results if isinstance(result, bytes)]
+    if not images:
+        raise results[0]
+    return images
+
+# Ключ в context.user_data: собираемые альбомы по media_group_id
+MEDIA_GROUP_KEY = 'media_groups'
+
+# Больше фото в одном альбоме Telegram не присылает
+MEDIA_GROUP_MAX_PHOTOS = 10
+
+class MediaGroupBuffer:
+    """
+    Фото одного альбома, собираемые для общего анализа
+    
+    Каждое фото альбома приходит отдельным обновлением. Первое обрабатывается как обычно
+    и ждет остальные, пока они приходят не реже раза в MEDIA_GROUP_WINDOW секунд; следующие
+    только добавляют сюда свою загрузку. Сообщение об обработке и запрос к ИИ - одни на альбом.
+    """
+    
+    def __init__(self, media_group_id: str):
+        self.media_group_id = media_group_id
+        self.prefetches: List[PhotoPrefetch] = []
+        self.captions: List[str] = []
+        self.last_added = 0.0
+        self._arrived = asyncio.Event()
+    
+    def add(self, prefetch: PhotoPrefetch, caption: Optional[str] = None):
+        self.prefetches.append(prefetch)
+        if caption and caption.strip():
+            self.captions.append(caption.strip())
+        self.last_added = asyncio.get_running_loop().time()
+        self._arrived.set()
+    
+    async def collect(self, window: float) -> List[PhotoPrefetch]:
+        """Ждет, пока фото перестанут приходить, и возвращает загрузки всех фото альбома"""
+        loop = asyncio.get_running_loop()
+        while len(self.prefetches) < MEDIA_GROUP_MAX_PHOTOS:
+            remaining = self.last_added + window - loop.time()
+            if remaining <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return list(self.prefetches)
+    
+    def cancel(self):
+        for prefetch in self.prefetches:
+            prefetch.cancel()
+
+def start_photo_prefetch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> PhotoPrefetch:
+    """Запускает скачивание фото из сообщения до проверок пользователя (первое фото альбома открывает альбом)"""
+    message = update.message
+    # Готовый анализ ищется только для одиночного фото - альбом анализируется целиком
+    prefetch = PhotoPrefetch(context.bot, message, lookup_cache=not message.media_group_id)
+    context.user_data.setdefault(PHOTO_PREFETCH_KEY, {})[prefetch.message_id] = prefetch
+    if message.media_group_id:
+        group = MediaGroupBuffer(message.media_group_id)
+        group.add(prefetch, message.caption)
+        context.user_data.setdefault(MEDIA_GROUP_KEY, {})[message.media_group_id] = group
+    return prefetch
+
+__all__.append('start_photo_prefetch')
+
+def take_photo_prefetch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[PhotoPrefetch]:
+    """Забирает загрузку, запущенную для этого сообщения (None, если ее нет)"""
+    return context.user_data.get(PHOTO_PREFETCH_KEY, {}).pop(update.message.message_id, None)
+
+def cancel_photo_prefetch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет загрузку фото (и всего альбома), если сообщение не будет обработано"""
+    prefetch = take_photo_prefetch(update, context)
+    if prefetch is not None:
+        prefetch.cancel()
+    if update.message.media_group_id:
+        group = context.user_data.get(MEDIA_GROUP_KEY, {}).pop(update.message.media_group_id, None)
+        if group is not None:
+            group.cancel()
+
+__all__.append('cancel_photo_prefetch')
+
+def add_to_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Добавляет фото к уже собираемому альбому
+    
+    Возвращает False для одиночного фото и первого фото альбома - их обрабатывают как обычно.
+    """
+    message = update.message
+    if not message.media_group_id:
+        return False
+    group = context.user_data.get(MEDIA_GROUP_KEY, {}).get(message.media_group_id)
+    if group is None:
+        return False
+    group.add(PhotoPrefetch(context.bot, message, lookup_cache=False), message.caption)
+    logger.info(f"Photo {message.message_id} added to album {message.media_group_id} ({len(group.prefetches)} photos)")
+    return True
+
+__all__.append('add_to_media_group')
+
+async def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              prefetch: PhotoPrefetch) -> Tuple[List[PhotoPrefetch], Optional[str]]:
+    """Загрузки всех фото альбома и его подпись; для одиночного фото - только его загрузка"""
+    media_group_id = update.message.media_group_id
+    groups = context.user_data.get(MEDIA_GROUP_KEY, {})
+    group = groups.get(media_group_id) if media_group_id else None
+    if group is None:
+        return [prefetch], None
+    try:
+        prefetches = await group.collect(MEDIA_GROUP_WINDOW)
+    finally:
+        # Фото, пришедшие позже, откроют новый альбом
+        groups.pop(media_group_id, None)
+    logger.info(f"Album {media_group_id} collected: {len(prefetches)} photos")
+    return prefetches, "\n".join(group.captions) or None
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик фотографий"""
     is_for_adding = context.user_data.get('waiting_for_photo', False)
@@ -105,6 +294,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_for_check_photo_text = context.user_data.get('waiting_for_check_photo_text', False)
     
     if not (is_for_adding or is_for_checking or is_for_photo_text or is_for_check_photo_text):
+        cancel_photo_prefetch(update, context)
         return
     
     user = update.effective_user
@@ -120,113 +310,98 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop('analysis_supplemented', None)
     context.user_data.pop('check_analysis_supplemented', None)
     
-    # Отправляем сообщение о начале обработки
-    processing_msg = await update.message.reply_text(
-        "🔄 **Обрабатываю фотографию...**\n\n"
-        "Анализирую изображение с помощью ИИ модели...",
-        parse_mode='Markdown'
+    # Отправляем сообщение о начале обработки (для альбома - одно на все фото)
+    if update.message.media_group_id:
+        processing_text = (
+            "🔄 **Обрабатываю фотографии...**\n\n"
+            "Анализирую все фото альбома вместе с помощью ИИ модели..."
+        )
+    else:
+        processing_text = (
+            "🔄 **Обрабатываю фотографию...**\n\n"
+            "Анализирую изображение с помощью ИИ модели..."
+        )
+    # Сообщение об обработке, поиск готового анализа, скачивание фото и запрос подписки
+    # к базе идут одновременно: правки сообщения дождутся его отправки
+    processing_msg = DeferredMessage(update.message.reply_text(processing_text, parse_mode='Markdown'))
+    prefetch = take_photo_prefetch(update, context) or PhotoPrefetch(
+        context.bot, update.message, lookup_cache=not update.message.media_group_id
     )
+    prefetches = [prefetch]
+    # Подписчики идут в очереди к модели раньше бесплатных проверок калорий
+    priority_task = asyncio.create_task(get_flow_ai_request_priority(
+        context, user.id,
+        is_for_checking or is_for_check_photo_text or context.user_data.get('check_mode', False)
+    ))
+    priority_task.add_done_callback(lambda task: task.cancelled() or task.exception())
     
     try:
-        # Получаем файл фотографии
-        file = await context.bot.get_file(photo.file_id)
-        file_url = file.file_path
-        
-        logger.info(f"Downloading photo from: {file_url}")
+        # Остальные фото альбома приходят отдельными обновлениями - дожидаемся их
+        prefetches, album_caption = await collect_media_group(update, context, prefetch)
         
-        # Скачиваем изображение асинхронно с исправленными SSL настройками
-        import aiohttp
-        import ssl
-        
-        # Создаем SSL контекст с мягкими настройками
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
+        # Повторно отправленное (например, пересланное) фото уже анализировалось -
+        # берем результат по file_unique_id, не обращаясь к ИИ
+        analysis = await prefetch.cached_analysis()
+        if analysis:
+            logger.info(f"Photo {photo.file_unique_id} served from file_unique_id cache")
+        else:
+            # Фото скачиваются потоком через общий сервис загрузок
+            try:
+                images = await download_photos(prefetches)
+            except FileDownloadError as e:
+                await processing_msg.edit_text(
+                    photo_download_error_text(e),
+                    reply_markup=get_main_menu_keyboard_for_user(update),
+                    parse_mode='Markdown'
+                )
+                return
         
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            if file_url.startswith('https://'):
-                url = file_url
-            else:
-                url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_url}"
-            
-            async with session.get(url) as response:
-                logger.info(f"Photo download response: {response.status}")
-                
-                if response.status != 200:
-                    logger.error(f"Failed to download photo: {response.status}")
-                    await processing_msg.edit_text(
-                        f"❌ Ошибка при загрузке фотографии\n\n"
-                        f"Код ошибки: {response.status}\n"
-                        f"URL: {url}\n"
-                        f"Попробуйте отправить фото еще раз или используйте команду /addphoto"
-                    )
-                    return
-                
-                # Проверяем размер файла
-                content_length = response.headers.get('content-length')
-                if content_length and int(content_length) > MAX_IMAGE_SIZE:
-                    await processing_msg.edit_text(
-                        f"❌ **Файл слишком большой**\n\n"
-                        f"Размер фотографии превышает {MAX_IMAGE_SIZE // (1024 * 1024)}MB. Пожалуйста, отправьте фото меньшего размера.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
+            # Отправляем запрос к языковой модели - подготовка фото начинается сразу после скачивания
+            logger.info("Starting food photo analysis...")
+            priority = await priority_task
+            # Ответ ИИ показываем по мере генерации, итоговый разбор - по полному тексту
+            stream_editor = ProgressiveMessageEditor(processing_msg, "🔄 Анализирую фотографию...")
+            try:
+                if len(images) > 1 or album_caption:
+                    # Альбом - все фото и подпись одним запросом, один общий результат
+                    analysis = await analyze_food_photos(
+                        images, description=album_caption, user_id=user.id, priority=priority,
+                        on_queue_position=make_queue_position_callback(processing_msg, processing_text),
+                        on_partial_text=stream_editor.update
                     )
-                    return
-                
-                # Читаем содержимое файла
-                image_content = await response.read()
-                
-                # Проверяем размер после загрузки
-                if len(image_content) > MAX_IMAGE_SIZE:
-                    await processing_msg.edit_text(
-                        f"❌ **Файл слишком большой**\n\n"
-                        f"Размер фотографии превышает {MAX_IMAGE_SIZE // (1024 * 1024)}MB. Пожалуйста, отправьте фото меньшего размера.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
-                    )
-                    return
-                
-                # Проверяем тип файла
-                if not validate_image_file(image_content):
-                    await processing_msg.edit_text(
-                        "❌ **Неподдерживаемый формат файла**\n\n"
-                        "Пожалуйста, отправьте изображение в формате JPEG, PNG или WebP.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
+                else:
+                    analysis = await analyze_food_photo(
+                        images[0], file_unique_id=photo.file_unique_id, user_id=user.id, priority=priority,
+                        on_queue_position=make_queue_position_callback(processing_msg, processing_text),
+                        on_partial_text=stream_editor.update
                     )
-                    return
-        
-        # Отправляем запрос к языковой модели
-        logger.info("Starting food photo analysis...")
-        analysis_result = await analyze_food_photo(image_content)
-        logger.info(f"Analysis result: {analysis_result is not None}")
+            finally:
+                await stream_editor.finish()
+        logger.info(f"Analysis result: {analysis is not None}")
         
-        if analysis_result:
-            logger.info(f"Analysis result length: {len(analysis_result)}")
-            logger.info(f"Analysis result preview: {analysis_result[:200]}...")
+        if analysis:
+            logger.info(f"Analysis result: {analysis.dish_name}, {analysis.calories} kcal")
         
         # Получаем информацию о выбранном приеме пищи
         selected_meal = context.user_data.get('selected_meal_name', 'Прием пищи')
         
         # Проверяем валидность анализа
-        is_valid = is_valid_analysis(analysis_result) if analysis_result else False
+        is_valid = analysis.is_valid if analysis else False
         logger.info(f"Analysis is valid: {is_valid}")
         
-        if analysis_result and is_valid:
-            # Удаляем пояснения из анализа
-            analysis_result = remove_explanations_from_analysis(analysis_result)
+        if analysis and is_valid:
+            # Текст результата уже без пояснений
+            analysis_result = analysis.text
             
-            # Парсим результат анализа для извлечения БЖУ
-            calories, protein, fat, carbs = extract_macros_from_analysis(analysis_result)
-            dish_name = extract_dish_name_from_analysis(analysis_result) or "Блюдо по фото"
+            # Анализ уже разобран - подтверждение возьмет готовые числа
+            pending = PendingAnalysis.from_result(analysis, 'photo', "Блюдо по фото")
             
             # Проверяем комбинированный режим
             if is_for_photo_text or is_for_check_photo_text:
                 # Сохраняем результат анализа фото для последующего объединения с текстом
                 context.user_data['photo_analysis_result'] = analysis_result
-                context.user_data['photo_dish_name'] = dish_name
-                context.user_data['photo_calories'] = calories
+                context.user_data['photo_dish_name'] = pending.dish_name
+                context.user_data['photo_calories'] = pending.calories
                 
                 # Устанавливаем состояние ожидания текста
                 if is_for_photo_text:
@@ -251,9 +426,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if is_check_mode:
                 # Режим проверки калорий - показываем результат с кнопками подтверждения
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, pending)
                 context.user_data['waiting_for_photo_confirmation'] = True
                 context.user_data['check_mode'] = True
                 
@@ -272,9 +445,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 # Режим добавления блюда - показываем результат с кнопками подтверждения
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, pending)
                 context.user_data['waiting_for_photo_confirmation'] = True
                 context.user_data['save_mode'] = True
                 
@@ -290,9 +461,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     ]), 
                     parse_mode='Markdown'
                 )
-        elif analysis_result:
+        elif analysis:
             # ИИ вернул результат, но не смог определить калории
-            logger.warning(f"Analysis returned but is not valid. Result: {analysis_result[:200]}...")
+            logger.warning(f"Analysis returned but is not valid. Result: {analysis.text[:200]}...")
             await processing_msg.edit_text(
                 "❌ **Анализ не удался**\n\n"
                 "ИИ не смог определить калорийность блюда на фотографии.\n\n"
@@ -322,13 +493,26 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
             
+    except AIOverloadedError:
+        await edit_or_reply(
+            processing_msg, update.message,
+            AI_OVERLOADED_MESSAGE,
+            reply_markup=get_main_menu_keyboard_for_user(update),
+            parse_mode='Markdown'
+        )
     except Exception as e:
         logger.error(f"Error processing photo: {e}")
-        await processing_msg.edit_text(
+        await edit_or_reply(
+            processing_msg, update.message,
             "❌ Произошла ошибка\n\n"
             "Не удалось обработать фотографию. Попробуйте позже или используйте команду /addphoto снова.",
             reply_markup=get_main_menu_keyboard_for_user(update)
         )
+    finally:
+        # Приоритет не нужен, если обработка закончилась раньше запроса к ИИ
+        priority_task.cancel()
+        for item in prefetches:
+            item.cancel()
 
 __all__.append('handle_photo')
 
@@ -357,30 +541,18 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         logger.info(f"Processing voice message from user {user.id}, duration: {voice.duration}s")
         
-        # Используем новый API клиент для анализа голоса
-        async with api_client:
-            analysis_result = await api_client.analyze_voice(update, context)
-            
-        # Сохраняем распознанный текст в контексте для последующего использования
-        if analysis_result and 'recognized_text' in str(analysis_result):
-            # Если анализ содержит распознанный текст, извлекаем его
-            context.user_data['recognized_text'] = analysis_result
-        else:
-            context.user_data['recognized_text'] = 'Голосовое сообщение'
+        # Распознавание и анализ одним вызовом: распознанный текст возвращается вместе с анализом
+        is_check_mode = context.user_data.get('check_mode', False)
+        pipeline_result = await voice_handler.transcribe_and_analyze(
+            update, context, priority=await get_flow_ai_request_priority(context, user.id, is_check_mode=is_check_mode)
+        )
+        analysis = pipeline_result.analysis
         
-        if not analysis_result:
-            await processing_msg.edit_text(
-                "❌ Ошибка распознавания речи\n\n"
-                "Не удалось распознать голосовое сообщение. Попробуйте:\n"
-                "• Говорить четче и медленнее\n"
-                "• Убедиться, что микрофон работает\n"
-                "• Использовать команду /addtext для текстового описания\n\n"
-                "Попробуйте команду /addvoice снова."
-            )
-            return
+        # Распознанный текст нужен для дополнения и подтверждения анализа - без повторного распознавания
+        context.user_data['recognized_text'] = pipeline_result.transcript or 'Голосовое сообщение'
         
         # Проверяем, доступно ли распознавание речи
-        if analysis_result == "VOICE_TRANSCRIPTION_UNAVAILABLE":
+        if pipeline_result.unavailable:
             await processing_msg.edit_text(
                 "🎤 **Распознавание речи временно недоступно**\n\n"
                 "Для работы с голосовыми сообщениями необходимо настроить API ключи для распознавания речи.\n\n"
@@ -400,24 +572,30 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        if analysis_result and is_valid_analysis(analysis_result):
-            # Удаляем пояснения из анализа
-            analysis_result = remove_explanations_from_analysis(analysis_result)
-            
-            # Парсим результат анализа для извлечения БЖУ
-            calories, protein, fat, carbs = extract_macros_from_analysis(analysis_result)
-            dish_name = extract_dish_name_from_analysis(analysis_result) or "Голосовое сообщение"
-            
-            # Проверяем режим - добавление или проверка калорий
-            is_check_mode = context.user_data.get('check_mode', False)
+        if not pipeline_result.transcript:
+            await processing_msg.edit_text(
+                "❌ Ошибка распознавания речи\n\n"
+                "Не удалось распознать голосовое сообщение. Попробуйте:\n"
+                "• Говорить четче и медленнее\n"
+                "• Убедиться, что микрофон работает\n"
+                "• Использовать команду /addtext для текстового описания\n\n"
+                "Попробуйте команду /addvoice снова."
+            )
+            return
+        
+        if analysis and analysis.is_valid:
+            # Текст результата уже без пояснений
+            analysis_result = analysis.text
+            transcription_result = pipeline_result.transcript
+            cleaned_result = clean_markdown_text(analysis_result)
             
             if is_check_mode:
                 # Режим проверки калорий - только показываем результат
                 # Записываем использование функции
                 add_calorie_check(user.id, 'voice')
                 
-                cleaned_result = clean_markdown_text(analysis_result)
-                result_text = f"🔍 **Анализ калорий**\n\n{cleaned_result}\n\nℹ️ **Данные НЕ сохранены в статистику**"
+                result_text = (f"🔍 **Анализ калорий**\n\n**🎤 Распознанный текст:** {transcription_result}\n\n"
+                               f"{cleaned_result}\n\nℹ️ **Данные НЕ сохранены в статистику**")
                 
                 await processing_msg.edit_text(
                     result_text, 
@@ -429,51 +607,26 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Сбрасываем режим проверки
                 context.user_data['check_mode'] = False
             else:
-                # Режим добавления блюда - сохраняем в базу
-                try:
-                    meal_type = context.user_data.get('selected_meal', 'meal_breakfast')
-                    selected_meal = context.user_data.get('selected_meal_name', 'Прием пищи')
-                    
-                    # Извлекаем БЖУ из анализа
-                    calories_from_analysis, protein, fat, carbs = extract_macros_from_analysis(analysis_result)
-                    
-                    # Сохраняем в базу данных
-                    success = add_meal(
-                        telegram_id=user.id,
-                        meal_type=meal_type,
-                        meal_name=selected_meal,
-                        dish_name=dish_name,
-                        calories=calories,
-                        protein=protein,
-                        fat=fat,
-                        carbs=carbs,
-                        analysis_type="voice"
-                    )
-                    
-                    if success:
-                        logger.info(f"Meal saved successfully for user {user.id}")
-                        # Добавляем информацию о распознанном тексте
-                        cleaned_result = clean_markdown_text(analysis_result)
-                        # Получаем распознанный текст из контекста или используем заглушку
-                        transcription_result = context.user_data.get('recognized_text', 'Голосовое сообщение')
-                        result_with_transcription = f"**🎤 Распознанный текст:** {transcription_result}\n\n{cleaned_result}"
-                        await processing_msg.edit_text(result_with_transcription, reply_markup=get_analysis_result_keyboard(), parse_mode='Markdown')
-                    else:
-                        logger.warning(f"Failed to save meal for user {user.id}")
-                        await processing_msg.edit_text(
-                            "❌ Ошибка сохранения\n\n"
-                            "Не удалось сохранить данные о приеме пищи. Попробуйте еще раз.",
-                            reply_markup=get_main_menu_keyboard_for_user(update)
-                        )
-                    
-                except Exception as e:
-                    logger.error(f"Error saving meal to database: {e}")
-                    await processing_msg.edit_text(
-                        "❌ Ошибка сохранения\n\n"
-                        "Не удалось сохранить данные о приеме пищи. Попробуйте еще раз.",
-                        reply_markup=get_main_menu_keyboard_for_user(update)
+                # Режим добавления блюда - как у текстового описания: подтверждение или дополнение.
+                # Распознанный текст хранится в анализе как описание и уходит в уточняющий запрос
+                store_pending_analysis(context.user_data, PendingAnalysis.from_result(
+                    analysis, 'voice', "Голосовое сообщение", description=transcription_result
+                ))
+                context.user_data['waiting_for_text_confirmation'] = True
+                context.user_data['save_mode'] = True
+                context.user_data.pop('text_analysis_supplemented', None)
+                
+                meal_name = context.user_data.get('meal_name_name', 'Прием пищи')
+                await processing_msg.edit_text(
+                    f"**🍽️ {meal_name}**\n\n**🎤 Распознанный текст:** {transcription_result}\n\n{cleaned_result}",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("✅ Все верно?", callback_data="confirm_text_analysis")],
+                        [InlineKeyboardButton("✏️ Дополнить", callback_data="add_to_text_analysis")],
+                        [InlineKeyboardButton("❌ Отменить", callback_data="cancel_text_analysis")]
+                    ]),
+                    parse_mode='Markdown'
                 )
-        elif analysis_result:
+        elif analysis:
             # ИИ вернул результат, но не смог определить калории
             transcription_result = context.user_data.get('recognized_text', 'Голосовое сообщение')
             await processing_msg.edit_text(
@@ -506,6 +659,12 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
             
+    except AIOverloadedError:
+        await processing_msg.edit_text(
+            AI_OVERLOADED_MESSAGE,
+            reply_markup=get_main_menu_keyboard_for_user(update),
+            parse_mode='Markdown'
+        )
     except Exception as e:
         logger.error(f"Error processing voice: {e}")
         await processing_msg.edit_text(
@@ -516,15 +675,16 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 __all__.append('handle_voice')
 
+@callback_router.route("check_photo")
 async def handle_check_photo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Анализ по фото' для проверки калорий"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Проверяем подписку и лимит использований
     access_info = check_subscription_access(user.id)
+    remember_subscription_access(context, access_info)
     if not access_info['has_access']:
         daily_checks = get_daily_calorie_checks_count(user.id)
         if daily_checks >= 3:
@@ -562,15 +722,16 @@ async def handle_check_photo_callback(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_check_photo_callback')
 
+@callback_router.route("check_voice")
 async def handle_check_voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Анализ по голосу' для проверки калорий"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Проверяем подписку и лимит использований
     access_info = check_subscription_access(user.id)
+    remember_subscription_access(context, access_info)
     if not access_info['has_access']:
         daily_checks = get_daily_calorie_checks_count(user.id)
         if daily_checks >= 3:
@@ -608,10 +769,10 @@ async def handle_check_voice_callback(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_check_voice_callback')
 
+@callback_router.route("analyze_photo")
 async def handle_analyze_photo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Анализ по фото'"""
     query = update.callback_query
-    await query.answer()
     
     # Устанавливаем состояние ожидания фото
     context.user_data['waiting_for_photo'] = True
@@ -642,10 +803,10 @@ async def handle_analyze_photo_callback(update: Update, context: ContextTypes.DE
 
 __all__.append('handle_analyze_photo_callback')
 
+@callback_router.route("analyze_voice")
 async def handle_analyze_voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Анализ по голосовому'"""
     query = update.callback_query
-    await query.answer()
     
     # Устанавливаем состояние ожидания голосового сообщения
     context.user_data['waiting_for_voice'] = True
@@ -679,10 +840,10 @@ async def handle_analyze_voice_callback(update: Update, context: ContextTypes.DE
 
 __all__.append('handle_analyze_voice_callback')
 
+@callback_router.route("analyze_photo_text")
 async def handle_analyze_photo_text_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Фото + Текст' для добавления блюда"""
     query = update.callback_query
-    await query.answer()
     
     # Устанавливаем состояние ожидания фото
     context.user_data['waiting_for_photo_text'] = True
@@ -717,10 +878,10 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
     """Обрабатывает сообщения с фото + текстом для уточненного анализа"""
     user = update.effective_user
     message = update.message
+    priority_task = None
     
     try:
-        # Получаем фото и текст
-        photo = message.photo[-1]  # Берем самое большое фото
+        # Получаем текст (фото скачивает PhotoPrefetch)
         caption = message.caption or ""
         
         if not caption.strip():
@@ -730,80 +891,58 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
         
         logger.info(f"Processing photo with text from user {user.id}: '{caption[:50]}...'")
         
-        # Отправляем сообщение о начале обработки
-        processing_msg = await message.reply_text(
+        # Сообщение о начале обработки отправляется параллельно со скачиванием фото
+        processing_msg = DeferredMessage(message.reply_text(
             "🔍 **Анализирую фото + текст...**\n\n"
             f"📝 Ваш текст: {caption}\n\n"
             "⏳ Пожалуйста, подождите...",
             parse_mode='Markdown'
-        )
-        
-        # Скачиваем фото
-        photo_file = await context.bot.get_file(photo.file_id)
+        ))
+        prefetch = take_photo_prefetch(update, context) or PhotoPrefetch(context.bot, message, lookup_cache=False)
+        priority_task = asyncio.create_task(get_flow_ai_request_priority(
+            context, user.id, context.user_data.get('check_mode', False)
+        ))
+        priority_task.add_done_callback(lambda task: task.cancelled() or task.exception())
         
-        # Создаем SSL контекст с мягкими настройками
-        import ssl
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(photo_file.file_path) as response:
-                if response.status != 200:
-                    await processing_msg.edit_text(
-                        "❌ **Ошибка загрузки фото**\n\n"
-                        "Не удалось загрузить фотографию. Попробуйте еще раз.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
-                    )
-                    return
-                
-                image_content = await response.read()
-                
-                # Проверяем размер файла
-                if len(image_content) > MAX_IMAGE_SIZE:
-                    await processing_msg.edit_text(
-                        f"❌ **Файл слишком большой**\n\n"
-                        f"Размер фотографии превышает {MAX_IMAGE_SIZE // (1024 * 1024)}MB. Пожалуйста, отправьте фото меньшего размера.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
-                    )
-                    return
-                
-                # Проверяем тип файла
-                if not validate_image_file(image_content):
-                    await processing_msg.edit_text(
-                        "❌ **Неподдерживаемый формат файла**\n\n"
-                        "Пожалуйста, отправьте изображение в формате JPEG, PNG или WebP.",
-                        reply_markup=get_main_menu_keyboard_for_user(update),
-                        parse_mode='Markdown'
-                    )
-                    return
+        # Фото скачивается потоком через общий сервис загрузок
+        try:
+            image_content = await prefetch.image()
+        except FileDownloadError as e:
+            await processing_msg.edit_text(
+                photo_download_error_text(e),
+                reply_markup=get_main_menu_keyboard_for_user(update),
+                parse_mode='Markdown'
+            )
+            return
         
         # Анализируем фото + текст
         logger.info("Starting photo+text analysis...")
-        analysis_result = await analyze_food_photo_with_text(image_content, caption)
-        logger.info(f"Photo+text analysis result: {analysis_result is not None}")
+        stream_editor = ProgressiveMessageEditor(processing_msg, "🔄 Анализирую фото с вашим описанием...")
+        try:
+            analysis = await analyze_food_photo_with_text(
+                image_content, caption, user_id=user.id, priority=await priority_task,
+                on_partial_text=stream_editor.update
+            )
+        finally:
+            await stream_editor.finish()
+        logger.info(f"Photo+text analysis result: {analysis is not None}")
         
-        if analysis_result:
-            logger.info(f"Analysis result length: {len(analysis_result)}")
-            logger.info(f"Analysis result preview: {analysis_result[:200]}...")
+        if analysis:
+            logger.info(f"Analysis result: {analysis.dish_name}, {analysis.calories} kcal")
         
         # Получаем информацию о выбранном приеме пищи
         selected_meal = context.user_data.get('selected_meal_name', 'Прием пищи')
         
         # Проверяем валидность анализа
-        is_valid = is_valid_analysis(analysis_result) if analysis_result else False
+        is_valid = analysis.is_valid if analysis else False
         logger.info(f"Analysis is valid: {is_valid}")
         
         if is_valid:
-            # Удаляем пояснения из анализа
-            analysis_result = remove_explanations_from_analysis(analysis_result)
+            # Текст результата уже без пояснений
+            analysis_result = analysis.text
             
-            # Парсим результат анализа для извлечения БЖУ
-            calories, protein, fat, carbs = extract_macros_from_analysis(analysis_result)
-            dish_name = extract_dish_name_from_analysis(analysis_result) or caption[:50]
+            # Анализ уже разобран - подтверждение возьмет готовые числа
+            pending = PendingAnalysis.from_result(analysis, 'photo_text', caption[:50])
             
             # Проверяем режим - добавление или проверка калорий
             is_check_mode = context.user_data.get('check_mode', False)
@@ -813,9 +952,7 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
                 add_calorie_check(user.id, 'photo_text')
                 
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, pending)
                 context.user_data['waiting_for_photo_text_confirmation'] = True
                 context.user_data['check_mode'] = True
                 
@@ -834,9 +971,7 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
             else:
                 # Режим добавления блюда - показываем результат с кнопками подтверждения
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, pending)
                 context.user_data['waiting_for_photo_text_confirmation'] = True
                 context.user_data['save_mode'] = True
                 
@@ -852,7 +987,7 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
                     ]), 
                     parse_mode='Markdown'
                 )
-        elif analysis_result:
+        elif analysis:
             # ИИ вернул результат, но не смог определить калории
             await processing_msg.edit_text(
                 f"**📝 Ваш текст:** {caption}\n\n"
@@ -891,6 +1026,11 @@ async def handle_photo_with_text(update: Update, context: ContextTypes.DEFAULT_T
             "Не удалось обработать фото с текстом. Попробуйте позже или используйте команду /addphoto снова.",
             reply_markup=get_main_menu_keyboard_for_user(update)
         )
+    finally:
+        # Загрузка и запрос приоритета, запущенные до проверок, не должны пережить обработку сообщения
+        if priority_task is not None:
+            priority_task.cancel()
+        cancel_photo_prefetch(update, context)
 
 __all__.append('handle_photo_with_text')
 
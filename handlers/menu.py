@@ -118,7 +118,6 @@ async def show_welcome_message_with_data(update: Update, context: ContextTypes.D
             )
         else:
             query = update.callback_query
-            await query.answer()
             await query.edit_message_text(
                 welcome_message,
                 reply_markup=get_main_menu_keyboard_for_user(update),
@@ -144,7 +143,6 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # Если это callback query
             query = update.callback_query
-            await query.answer()
             await query.edit_message_text(
                 "🏠 **Главное меню**\n\n"
                 "Выберите нужную функцию:",
@@ -287,7 +285,6 @@ async def terms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     elif hasattr(update, 'callback_query') and update.callback_query:
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text(
             terms_text,
             reply_markup=get_main_menu_keyboard_for_user(update),
@@ -300,7 +297,6 @@ async def terms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик возврата в главное меню"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем все состояния
     context.user_data.clear()
@@ -311,7 +307,6 @@ async def handle_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback кнопки главного меню"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем все состояния
     context.user_data.clear()
@@ -322,7 +317,6 @@ async def handle_main_menu_callback(update: Update, context: ContextTypes.DEFAUL
 async def handle_menu_from_meal_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Возврат в меню из выбора типа приема пищи"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем состояния
     context.user_data.pop('selected_meal', None)
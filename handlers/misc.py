@@ -1,24 +1,22 @@
 # Auto-generated module for misc handlers extracted from bot_functions.py
 from ._shared import *  # imports, constants, helpers
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 from logging_config import get_logger
 from handlers.registration import check_user_registration, validate_age, validate_height, validate_weight
 from handlers.admin import is_admin
-from handlers.subscription import check_subscription_access
+from handlers.subscription import check_subscription_access, get_flow_ai_request_priority, remember_subscription_access
+from utils.message_streaming import ProgressiveMessageEditor
 from handlers.menu import get_main_menu_keyboard, get_main_menu_keyboard_for_user, get_analysis_result_keyboard
-from handlers.media import handle_photo_with_text
+from handlers.media import handle_photo_with_text, start_photo_prefetch, cancel_photo_prefetch, add_to_media_group
 from services.food_analysis_service import (
     analyze_food_text, 
     analyze_food_supplement,
-    is_valid_analysis, 
-    remove_explanations_from_analysis, 
-    extract_calories_from_analysis,
-    extract_macros_from_analysis,
     extract_weight_from_description,
-    extract_calories_per_100g_from_analysis,
-    extract_dish_name_from_analysis,
     clean_markdown_text
 )
+from services.pending_analysis import PendingAnalysis, store_pending_analysis, get_pending_analysis, pop_pending_analysis
+from services.food_knowledge_base import food_knowledge_base
 from database import get_user_by_telegram_id, check_user_subscription, get_daily_calorie_checks_count, add_meal, add_calorie_check, get_daily_calories
 from constants import MIN_AGE, MAX_AGE, MIN_HEIGHT, MAX_HEIGHT, MIN_WEIGHT, MAX_WEIGHT
 
@@ -26,6 +24,7 @@ logger = get_logger(__name__)
 
 __all__ = []
 
+@callback_router.route("terms")
 async def terms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /terms - условия подписки"""
     return await terms_command_from_handler(update, context)
@@ -168,10 +167,10 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 __all__.append('handle_text_input')
 
+@callback_router.route(prefixes=("activity_",))
 async def handle_activity_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора уровня активности"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith('activity_'):
         # Проверяем, есть ли данные пользователя
@@ -214,10 +213,10 @@ async def handle_activity_callback(update: Update, context: ContextTypes.DEFAULT
 
 __all__.append('handle_activity_callback')
 
+@callback_router.route(prefixes=("goal_",))
 async def handle_goal_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора цели пользователя"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, есть ли данные пользователя
     if 'user_data' not in context.user_data:
@@ -462,202 +461,52 @@ async def addvoice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 __all__.append('addvoice_command')
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик callback запросов"""
-    query = update.callback_query
-    user = update.effective_user
+    """
+    Обработчик callback запросов
     
-    # Логируем только в режиме разработки
-    if TEST_MODE:
-        logger.debug(f"handle_callback_query: user={user.id}, data={query.data}")
+    Обработчик выбирается по таблице маршрутов (handlers/router.py): модули регистрируют
+    свои кнопки декоратором @callback_router.route.
+    """
+    if await callback_router.dispatch(update, context):
+        return
     
+    query = update.callback_query
     try:
         await query.answer()
     except Exception as e:
         logger.warning(f"Failed to answer callback query: {e}")
-        # Продолжаем обработку даже если не удалось ответить на callback
-    
-    # Добавляем информацию о callback
-    logger.info(f"Callback query received from user {user.id}: {query.data}")
     
-    if query.data == "register":
-        # Для callback query нужно использовать query.message.reply_text вместо update.message.reply_text
-        user = update.effective_user
-        
-        # Проверяем, зарегистрирован ли пользователь
-        try:
-            existing_user = check_user_registration(user.id)
-            
-            if existing_user:
-                await query.message.reply_text(
-                    "Вы уже зарегистрированы! Используйте /profile для просмотра данных."
-                )
-                return
-        except Exception as e:
-            logger.error(f"Error checking user registration: {e}")
-            await query.message.reply_text(
-                "❌ Произошла ошибка при проверке регистрации. Попробуйте позже."
-            )
-            return
-        
-        # Сохраняем состояние регистрации
-        context.user_data['registration_step'] = 'name'
-        context.user_data['user_data'] = {'telegram_id': user.id}
-        
-        await query.message.reply_text(
-            "Давайте зарегистрируем вас в системе!\n\n"
-            "Введите ваше имя:"
-        )
-    elif query.data == "help":
-        await bf.help_command(update, context)
-    elif query.data == "main_menu":
-        # Просто показываем главное меню в новом сообщении
-        await query.message.reply_text(
-            "🏠 **Главное меню**\n\n"
-            "Выберите нужную функцию:",
-            reply_markup=get_main_menu_keyboard_for_user(update),
-            parse_mode='Markdown'
-        )
-    elif query.data == "subscription":
-        await bf.show_subscription_purchase_menu(update, context)
-    elif query.data == "buy_subscription":
-        await bf.show_subscription_purchase_menu(update, context)
-    elif query.data == "terms":
-        await bf.terms_command(update, context)
-    elif query.data.startswith('gender_'):
-        await bf.handle_gender_callback(update, context)
-    elif query.data.startswith('activity_'):
-        await bf.handle_activity_callback(update, context)
-    elif query.data.startswith('goal_'):
-        await bf.handle_goal_callback(update, context)
-    elif query.data == "send_location":
-        await handle_send_location_callback(update, context)
-    elif query.data == "manual_timezone":
-        await handle_manual_timezone_callback(update, context)
-    elif query.data.startswith('tz_') or query.data == 'tz_other' or query.data.startswith('tz_group_') or query.data.startswith('tz_hemisphere_') or query.data == 'tz_back_to_hemispheres':
-        await bf.handle_timezone_callback(update, context)
-    elif query.data == "reset_confirm":
-        await bf.handle_reset_confirm(update, context)
-    elif query.data == "add_dish":
-        await bf.handle_add_dish(update, context)
-    elif query.data == "check_calories":
-        await bf.handle_check_calories(update, context)
-    elif query.data == "addmeal":
-        await bf.handle_addmeal_callback(update, context)
-    elif query.data == "menu_from_meal_selection":
-        await bf.handle_menu_from_meal_selection(update, context)
-    elif query.data == "profile":
-        await bf.handle_profile_callback(update, context)
-    elif query.data == "back_to_main":
-        await bf.handle_back_to_main(update, context)
-    elif query.data.startswith('meal_'):
-        await bf.handle_meal_selection(update, context)
-    elif query.data == "analyze_photo":
-        await bf.handle_analyze_photo_callback(update, context)
-    elif query.data == "analyze_text":
-        await bf.handle_analyze_text_callback(update, context)
-    elif query.data == "analyze_voice":
-        await bf.handle_analyze_voice_callback(update, context)
-    elif query.data == "analyze_photo_text":
-        await bf.handle_analyze_photo_text_callback(update, context)
-    elif query.data == "check_photo":
-        await bf.handle_check_photo_callback(update, context)
-    elif query.data == "check_text":
-        await bf.handle_check_text_callback(update, context)
-    elif query.data == "check_voice":
-        await bf.handle_check_voice_callback(update, context)
-    elif query.data == "check_photo_text":
-        await bf.handle_check_photo_text_callback(update, context)
-    elif query.data == "statistics":
-        await bf.handle_statistics_callback(update, context)
-    elif query.data == "stats_today":
-        await bf.handle_stats_today_callback(update, context)
-    elif query.data == "stats_yesterday":
-        await bf.handle_stats_yesterday_callback(update, context)
-    elif query.data == "stats_week":
-        await bf.handle_stats_week_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_stats']:
-        await bf.handle_admin_stats_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_users']:
-        await bf.handle_admin_users_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_meals']:
-        await bf.handle_admin_meals_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_broadcast']:
-        await bf.handle_admin_broadcast_callback(update, context)
-    elif query.data == "broadcast_create":
-        await bf.handle_broadcast_create_callback(update, context)
-    elif query.data == "broadcast_stats":
-        await bf.handle_broadcast_stats_callback(update, context)
-    elif query.data == "broadcast_confirm":
-        await bf.handle_broadcast_confirm_callback(update, context)
-    elif query.data == "broadcast_cancel":
-        await bf.handle_broadcast_cancel_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_subscriptions']:
-        await bf.handle_admin_subscriptions_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_check_subscription']:
-        await bf.handle_admin_check_subscription_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_manage_subscription']:
-        await bf.handle_admin_manage_subscription_callback(update, context)
-    elif query.data.startswith(ADMIN_CALLBACKS['admin_activate_trial'] + ':'):
-        await bf.handle_admin_activate_trial_callback(update, context)
-    elif query.data.startswith(ADMIN_CALLBACKS['admin_activate_premium'] + ':'):
-        await bf.handle_admin_activate_premium_callback(update, context)
-    elif query.data.startswith(ADMIN_CALLBACKS['admin_deactivate_subscription'] + ':'):
-        await bf.handle_admin_deactivate_subscription_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_back']:
-        await bf.handle_admin_back_callback(update, context)
-    elif query.data == ADMIN_CALLBACKS['admin_panel']:
-        await bf.show_admin_panel(update, context)
-    elif query.data == "buy_subscription":
-        await bf.show_subscription_purchase_menu(update, context)
-    elif query.data.startswith("buy_"):
-        await bf.handle_subscription_purchase(update, context)
-    elif query.data == "separator":
-        # Игнорируем нажатие на разделитель
-        await query.answer()
-    elif query.data == "admin_star_balance":
-        await bf.handle_admin_star_balance_callback(update, context)
-    elif query.data == "cancel_analysis":
-        await bf.handle_cancel_analysis(update, context)
-    elif query.data == "confirm_analysis":
-        await bf.handle_confirm_analysis(update, context)
-    elif query.data == "add_to_analysis":
-        await bf.handle_add_to_analysis(update, context)
-    elif query.data == "confirm_check_analysis":
-        await bf.handle_confirm_check_analysis(update, context)
-    elif query.data == "add_to_check_analysis":
-        await bf.handle_add_to_check_analysis(update, context)
-    elif query.data == "confirm_photo_text_analysis":
-        await bf.handle_confirm_photo_text_analysis(update, context)
-    elif query.data == "add_to_photo_text_analysis":
-        await bf.handle_add_to_photo_text_analysis(update, context)
-    elif query.data == "confirm_photo_text_check_analysis":
-        await bf.handle_confirm_photo_text_check_analysis(update, context)
-    elif query.data == "add_to_photo_text_check_analysis":
-        await bf.handle_add_to_photo_text_check_analysis(update, context)
-    elif query.data == "confirm_text_analysis":
-        await bf.handle_confirm_text_analysis(update, context)
-    elif query.data == "add_to_text_analysis":
-        await bf.handle_add_to_text_analysis(update, context)
-    elif query.data == "confirm_check_text_analysis":
-        await bf.handle_confirm_check_text_analysis(update, context)
-    elif query.data == "add_to_check_text_analysis":
-        await bf.handle_add_to_check_text_analysis(update, context)
-    elif query.data == "cancel_text_analysis":
-        await bf.handle_cancel_text_analysis(update, context)
-    else:
-        # Если callback data не распознан
-        logger.warning(f"Unknown callback data: {query.data}")
-        await query.message.reply_text(
-            "❌ Неизвестная команда. Попробуйте снова.",
-            reply_markup=get_main_menu_keyboard_for_user(update)
-        )
+    # Если callback data не распознан
+    logger.warning(f"Unknown callback data: {query.data}")
+    await query.message.reply_text(
+        "❌ Неизвестная команда. Попробуйте снова.",
+        reply_markup=get_main_menu_keyboard_for_user(update)
+    )
 
 __all__.append('handle_callback_query')
 
+@callback_router.route("main_menu")
+async def handle_main_menu_message_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка 'Главное меню': меню новым сообщением, состояние не сбрасывается"""
+    await update.callback_query.message.reply_text(
+        "🏠 **Главное меню**\n\n"
+        "Выберите нужную функцию:",
+        reply_markup=get_main_menu_keyboard_for_user(update),
+        parse_mode='Markdown'
+    )
+
+__all__.append('handle_main_menu_message_callback')
+
+@callback_router.route("separator")
+async def handle_separator_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие на разделитель игнорируется"""
+
+__all__.append('handle_separator_callback')
+
+@callback_router.route(prefixes=("gender_",))
 async def handle_gender_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора пола"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith('gender_'):
         # Проверяем, есть ли данные пользователя
@@ -681,10 +530,10 @@ async def handle_gender_callback(update: Update, context: ContextTypes.DEFAULT_T
 
 __all__.append('handle_gender_callback')
 
+@callback_router.route("reset_confirm")
 async def handle_reset_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик подтверждения сброса данных"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -731,10 +580,10 @@ async def handle_reset_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
 
 __all__.append('handle_reset_confirm')
 
+@callback_router.route("add_dish")
 async def handle_add_dish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Добавить блюдо'"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -753,6 +602,7 @@ async def handle_add_dish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверяем подписку
     access_info = check_subscription_access(user.id)
+    remember_subscription_access(context, access_info)
     if not access_info['has_access']:
         subscription_msg = get_subscription_message(access_info)
         await query.edit_message_text(
@@ -794,10 +644,10 @@ __all__.append('handle_add_dish')
 
 
 
+@callback_router.route("cancel_analysis")
 async def handle_cancel_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Отмена' для отмены анализа"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем все состояния ожидания
     context.user_data.pop('waiting_for_photo', None)
@@ -824,10 +674,8 @@ async def handle_cancel_analysis(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data.pop('waiting_for_additional_text', None)
     context.user_data.pop('waiting_for_check_additional_text', None)
     context.user_data.pop('waiting_for_photo_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
-    context.user_data.pop('calories_display', None)
+    context.user_data.pop('waiting_for_photo_text_confirmation', None)
+    pop_pending_analysis(context.user_data)
     
     # Показываем главное меню
     await query.edit_message_text(
@@ -839,10 +687,10 @@ async def handle_cancel_analysis(update: Update, context: ContextTypes.DEFAULT_T
 
 __all__.append('handle_cancel_analysis')
 
+@callback_router.route("back_to_main")
 async def handle_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Назад в меню'"""
     query = update.callback_query
-    await query.answer()
     
     await query.edit_message_text(
         "🏠 **Главное меню**\n\n"
@@ -931,9 +779,22 @@ async def handle_universal_analysis(update: Update, context: ContextTypes.DEFAUL
         await bf.handle_check_additional_text_analysis(update, context)
         return
     
+    # Фото начинаем скачивать сразу - параллельно с проверками пользователя в базе
+    if message.photo:
+        # Следующие фото альбома только добавляются к общему анализу, который ведет первое фото
+        if add_to_media_group(update, context):
+            return
+        start_photo_prefetch(update, context)
+    
+    # Регистрация и подписка читаются из базы одновременно, в пуле потоков
+    user_data, subscription = await asyncio.gather(
+        asyncio.to_thread(get_user_by_telegram_id, user.id),
+        asyncio.to_thread(check_user_subscription, user.id)
+    )
+    
     # Проверяем, зарегистрирован ли пользователь
-    user_data = get_user_by_telegram_id(user.id)
     if not user_data:
+        cancel_photo_prefetch(update, context)
         await message.reply_text(
             "❌ Вы не зарегистрированы в системе!\n"
             "Используйте /register для регистрации.",
@@ -943,8 +804,8 @@ async def handle_universal_analysis(update: Update, context: ContextTypes.DEFAUL
     
     # Проверяем подписку только если не в режиме проверки калорий и пользователь не админ
     if not context.user_data.get('check_mode', False) and not is_admin(user.id):
-        subscription = check_user_subscription(user.id)
         if not subscription['is_active']:
+            cancel_photo_prefetch(update, context)
             await message.reply_text(
                 "❌ У вас нет активной подписки!\n\n"
                 "Используйте /subscription для покупки подписки.",
@@ -954,10 +815,10 @@ async def handle_universal_analysis(update: Update, context: ContextTypes.DEFAUL
     else:
         # В режиме проверки калорий проверяем лимит для пользователей без подписки (кроме админов)
         if not is_admin(user.id):
-            subscription = check_user_subscription(user.id)
             if not subscription['is_active']:
-                daily_checks = get_daily_calorie_checks_count(user.id)
+                daily_checks = await asyncio.to_thread(get_daily_calorie_checks_count, user.id)
                 if daily_checks >= 3:
+                    cancel_photo_prefetch(update, context)
                     limit_msg = f"❌ **Лимит использований исчерпан**\n\n"
                     limit_msg += f"Вы использовали функцию 'Узнать калории' {daily_checks}/3 раз сегодня.\n\n"
                     limit_msg += f"⏰ **Счетчик сбрасывается в полночь**\n\n"
@@ -977,16 +838,18 @@ async def handle_universal_analysis(update: Update, context: ContextTypes.DEFAUL
     
     # Проверяем, ожидается ли дополнительный текст для фото + текст
     if context.user_data.get('waiting_for_photo_text_additional'):
+        cancel_photo_prefetch(update, context)
         await bf.handle_photo_text_additional_analysis(update, context)
         return
     elif context.user_data.get('waiting_for_photo_text_check_additional'):
+        cancel_photo_prefetch(update, context)
         await bf.handle_photo_text_check_additional_analysis(update, context)
         return
     
     # Определяем тип данных
     if message.photo:
-        # Проверяем, есть ли текст вместе с фото
-        if message.caption and message.caption.strip():
+        # Проверяем, есть ли текст вместе с фото (подпись альбома учитывается в общем анализе фото)
+        if message.caption and message.caption.strip() and not message.media_group_id:
             # Фото + текст - уточненный анализ
             logger.info(f"Photo with text analysis for user {user.id}: '{message.caption[:50]}...'")
             if context.user_data.get('save_mode'):
@@ -1046,10 +909,10 @@ async def handle_universal_analysis(update: Update, context: ContextTypes.DEFAUL
 
 __all__.append('handle_universal_analysis')
 
+@callback_router.route("check_calories")
 async def handle_check_calories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Узнать калории' - сразу показывает интерфейс универсального анализа"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -1066,6 +929,7 @@ async def handle_check_calories(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Проверяем подписку
         access_info = check_subscription_access(user.id)
+        remember_subscription_access(context, access_info)
         
         # Если подписка неактивна, проверяем лимит использований
         if not access_info['has_access']:
@@ -1152,17 +1016,28 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
     
     try:
         # Отправляем запрос к языковой модели
-        analysis_result = await analyze_food_text(description)
+        # Ответ ИИ показываем по мере генерации, итоговый разбор - по полному тексту
+        stream_editor = ProgressiveMessageEditor(processing_msg, "🔄 Анализирую описание блюда...")
+        try:
+            analysis = await analyze_food_text(
+                description, user_id=user.id,
+                priority=await get_flow_ai_request_priority(
+                    context, user.id, is_check_mode=context.user_data.get('check_mode', False)
+                ),
+                on_partial_text=stream_editor.update
+            )
+        finally:
+            await stream_editor.finish()
         
-        if analysis_result and is_valid_analysis(analysis_result):
-            # Удаляем пояснения из анализа
-            analysis_result = remove_explanations_from_analysis(analysis_result)
+        if analysis and analysis.is_valid:
+            # Текст результата уже без пояснений
+            analysis_result = analysis.text
             
             # Логируем результат анализа для отладки
             logger.info(f"Analysis result for '{description}': {analysis_result}")
             
-            # Парсим результат анализа для извлечения БЖУ
-            calories, protein, fat, carbs = extract_macros_from_analysis(analysis_result)
+            # Анализ уже разобран - подтверждение возьмет готовые числа
+            calories, protein, fat, carbs = analysis.macros
             
             # Если не удалось извлечь калории, пробуем использовать вес из описания
             if not calories:
@@ -1171,12 +1046,12 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
                 if weight_grams:
                     logger.info(f"Extracted weight from description: {weight_grams}г")
                     # Ищем калорийность на 100г в анализе
-                    calories_per_100g = extract_calories_per_100g_from_analysis(analysis_result)
+                    calories_per_100g = analysis.calories_per_100g
                     if calories_per_100g:
                         calories = int((calories_per_100g * weight_grams) / 100)
                         logger.info(f"Calculated total calories: {calories} from {calories_per_100g} ккал/100г × {weight_grams}г")
             
-            dish_name = extract_dish_name_from_analysis(analysis_result) or description[:50]
+            dish_name = analysis.dish_name or description[:50]
             
             # Проверяем комбинированный режим
             if context.user_data.get('waiting_for_text_after_photo') or context.user_data.get('waiting_for_check_text_after_photo'):
@@ -1268,9 +1143,9 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
             if is_check_mode and not is_auto_save:
                 # Режим проверки калорий - показываем результат с кнопками подтверждения
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, PendingAnalysis.from_result(
+                    analysis, 'text', dish_name, calories=calories
+                ))
                 context.user_data['waiting_for_text_confirmation'] = True
                 context.user_data['check_mode'] = True
                 
@@ -1289,9 +1164,9 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
             else:
                 # Режим добавления блюда - показываем результат с кнопками подтверждения
                 # Сохраняем данные анализа для подтверждения
-                context.user_data['original_analysis'] = analysis_result
-                context.user_data['original_calories'] = calories
-                context.user_data['original_dish_name'] = dish_name
+                store_pending_analysis(context.user_data, PendingAnalysis.from_result(
+                    analysis, 'text', dish_name, description=description, calories=calories
+                ))
                 context.user_data['waiting_for_text_confirmation'] = True
                 context.user_data['save_mode'] = True
                 
@@ -1344,7 +1219,7 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
                 #         "Не удалось сохранить данные о приеме пищи. Попробуйте еще раз.",
                 #         reply_markup=get_main_menu_keyboard()
                 #     )
-        elif analysis_result:
+        elif analysis:
             # ИИ вернул результат, но не смог определить калории
             await processing_msg.edit_text(
                 "❌ **Анализ не удался**\n\n"
@@ -1393,10 +1268,10 @@ async def handle_food_text_analysis(update: Update, context: ContextTypes.DEFAUL
 
 __all__.append('handle_food_text_analysis')
 
+@callback_router.route(prefixes=("meal_",))
 async def handle_meal_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора приема пищи"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -1446,10 +1321,10 @@ async def handle_meal_selection(update: Update, context: ContextTypes.DEFAULT_TY
 
 __all__.append('handle_meal_selection')
 
+@callback_router.route("profile")
 async def handle_profile_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Профиль' - вызывает команду /profile"""
     query = update.callback_query
-    await query.answer()
     
     # Получаем информацию о пользователе
     user = update.effective_user
@@ -1488,10 +1363,10 @@ async def handle_profile_callback(update: Update, context: ContextTypes.DEFAULT_
 
 __all__.append('handle_profile_callback')
 
+@callback_router.route("stats_today")
 async def handle_stats_today_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика за сегодня'"""
     query = update.callback_query
-    await query.answer()
     
     # Вызываем функцию статистики
     from handlers.profile import show_meal_statistics
@@ -1499,10 +1374,10 @@ async def handle_stats_today_callback(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_stats_today_callback')
 
+@callback_router.route("statistics")
 async def handle_statistics_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика' - показывает меню статистики"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
@@ -1535,10 +1410,10 @@ async def handle_statistics_callback(update: Update, context: ContextTypes.DEFAU
 
 __all__.append('handle_statistics_callback')
 
+@callback_router.route("stats_yesterday")
 async def handle_stats_yesterday_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика за вчера'"""
     query = update.callback_query
-    await query.answer()
     
     # Пока что перенаправляем на статистику за сегодня
     # TODO: Реализовать статистику за вчера
@@ -1547,10 +1422,10 @@ async def handle_stats_yesterday_callback(update: Update, context: ContextTypes.
 
 __all__.append('handle_stats_yesterday_callback')
 
+@callback_router.route("stats_week")
 async def handle_stats_week_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Статистика за неделю'"""
     query = update.callback_query
-    await query.answer()
     
     # Пока что перенаправляем на статистику за сегодня
     # TODO: Реализовать статистику за неделю
@@ -1559,19 +1434,17 @@ async def handle_stats_week_callback(update: Update, context: ContextTypes.DEFAU
 
 __all__.append('handle_stats_week_callback')
 
+@callback_router.route("confirm_analysis")
 async def handle_confirm_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима добавления блюда"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Получаем сохраненные данные анализа
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по фото')
+    pending = get_pending_analysis(context.user_data)
     
-    if not original_analysis:
+    if pending is None:
         await query.edit_message_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -1580,39 +1453,35 @@ async def handle_confirm_analysis(update: Update, context: ContextTypes.DEFAULT_
     
     # Очищаем состояния
     context.user_data.pop('waiting_for_photo_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
+    pop_pending_analysis(context.user_data)
     context.user_data.pop('save_mode', None)
     context.user_data.pop('analysis_supplemented', None)
-    context.user_data.pop('calories_display', None)
     
     # Сохраняем в базу данных
     try:
         meal_name = context.user_data.get('meal_name_name', 'Прием пищи')
         meal_type = context.user_data.get('meal_name', 'meal_breakfast')
         
-        logger.info(f"Confirming analysis for user {user.id}: meal_type={meal_type}, meal_name={meal_name}, dish_name={original_dish_name}, calories={original_calories}")
-        
-        # Извлекаем БЖУ из анализа
-        from services.food_analysis_service import extract_macros_from_analysis
-        calories_from_analysis, protein, fat, carbs = extract_macros_from_analysis(original_analysis)
+        logger.info(f"Confirming analysis for user {user.id}: meal_type={meal_type}, meal_name={meal_name}, dish_name={pending.dish_name}, calories={pending.calories}")
         
         success = add_meal(
             telegram_id=user.id,
             meal_type=meal_type,
             meal_name=meal_name,
-            dish_name=original_dish_name,
-            calories=original_calories,
-            protein=protein,
-            fat=fat,
-            carbs=carbs,
-            analysis_type="photo"
+            dish_name=pending.dish_name,
+            calories=pending.calories,
+            protein=pending.protein,
+            fat=pending.fat,
+            carbs=pending.carbs,
+            analysis_type=pending.source
         )
         
         if success:
             logger.info(f"Meal saved successfully for user {user.id}")
-            meal_info = f"**🍽️ {meal_name}**\n\n{original_analysis}"
+            # Дополненный анализ содержит несколько блоков - в базу продуктов его не берем
+            if not pending.supplemented:
+                food_knowledge_base.learn_in_background(pending.result, telegram_id=user.id)
+            meal_info = f"**🍽️ {meal_name}**\n\n{pending.display_text}"
             cleaned_meal_info = clean_markdown_text(meal_info)
             
             await query.edit_message_text(
@@ -1638,10 +1507,10 @@ async def handle_confirm_analysis(update: Update, context: ContextTypes.DEFAULT_
 
 __all__.append('handle_confirm_analysis')
 
+@callback_router.route("add_to_analysis")
 async def handle_add_to_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима добавления блюда"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('analysis_supplemented', False):
@@ -1680,19 +1549,17 @@ async def handle_add_to_analysis(update: Update, context: ContextTypes.DEFAULT_T
 
 __all__.append('handle_add_to_analysis')
 
+@callback_router.route("confirm_check_analysis")
 async def handle_confirm_check_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима проверки калорий"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Получаем сохраненные данные анализа
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по фото')
+    pending = pop_pending_analysis(context.user_data)
     
-    if not original_analysis:
+    if pending is None:
         await query.edit_message_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -1701,18 +1568,14 @@ async def handle_confirm_check_analysis(update: Update, context: ContextTypes.DE
     
     # Очищаем состояния
     context.user_data.pop('waiting_for_photo_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
     context.user_data.pop('check_mode', None)
     context.user_data.pop('check_analysis_supplemented', None)
-    context.user_data.pop('calories_display', None)
     
     # Записываем использование функции
     add_calorie_check(user.id, 'photo')
     
     # Показываем финальный результат
-    cleaned_result = clean_markdown_text(original_analysis)
+    cleaned_result = clean_markdown_text(pending.display_text)
     result_text = f"🔍 **Анализ калорий**\n\n{cleaned_result}\n\nℹ️ **Данные НЕ сохранены в статистику**"
     
     await query.edit_message_text(
@@ -1725,19 +1588,17 @@ async def handle_confirm_check_analysis(update: Update, context: ContextTypes.DE
 
 __all__.append('handle_confirm_check_analysis')
 
+@callback_router.route("confirm_check_text_analysis")
 async def handle_confirm_check_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима проверки калорий (текст)"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Получаем сохраненные данные анализа
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по описанию')
+    pending = pop_pending_analysis(context.user_data)
     
-    if not original_analysis:
+    if pending is None:
         await query.edit_message_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -1746,18 +1607,14 @@ async def handle_confirm_check_text_analysis(update: Update, context: ContextTyp
     
     # Очищаем состояния
     context.user_data.pop('waiting_for_text_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
     context.user_data.pop('check_mode', None)
     context.user_data.pop('check_analysis_supplemented', None)
-    context.user_data.pop('calories_display', None)
     
     # Записываем использование функции
     add_calorie_check(user.id, 'text')
     
     # Показываем финальный результат
-    cleaned_result = clean_markdown_text(original_analysis)
+    cleaned_result = clean_markdown_text(pending.display_text)
     result_text = f"🔍 **Анализ калорий**\n\n{cleaned_result}\n\nℹ️ **Данные НЕ сохранены в статистику**"
     
     await query.edit_message_text(
@@ -1770,19 +1627,17 @@ async def handle_confirm_check_text_analysis(update: Update, context: ContextTyp
 
 __all__.append('handle_confirm_check_text_analysis')
 
+@callback_router.route("confirm_text_analysis")
 async def handle_confirm_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима добавления блюда (текст)"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     # Получаем сохраненные данные анализа
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по описанию')
+    pending = get_pending_analysis(context.user_data)
     
-    if not original_analysis:
+    if pending is None:
         await query.edit_message_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -1791,38 +1646,34 @@ async def handle_confirm_text_analysis(update: Update, context: ContextTypes.DEF
     
     # Очищаем состояния
     context.user_data.pop('waiting_for_text_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
+    pop_pending_analysis(context.user_data)
     context.user_data.pop('save_mode', None)
-    context.user_data.pop('calories_display', None)
     
     # Сохраняем в базу данных
     try:
         meal_name = context.user_data.get('meal_name_name', 'Прием пищи')
         meal_type = context.user_data.get('meal_name', 'meal_breakfast')
         
-        logger.info(f"Confirming text analysis for user {user.id}: meal_type={meal_type}, meal_name={meal_name}, dish_name={original_dish_name}, calories={original_calories}")
-        
-        # Извлекаем БЖУ из анализа
-        from services.food_analysis_service import extract_macros_from_analysis
-        calories_from_analysis, protein, fat, carbs = extract_macros_from_analysis(original_analysis)
+        logger.info(f"Confirming text analysis for user {user.id}: meal_type={meal_type}, meal_name={meal_name}, dish_name={pending.dish_name}, calories={pending.calories}")
         
         success = add_meal(
             telegram_id=user.id,
             meal_type=meal_type,
             meal_name=meal_name,
-            dish_name=original_dish_name,
-            calories=original_calories,
-            protein=protein,
-            fat=fat,
-            carbs=carbs,
-            analysis_type="text"
+            dish_name=pending.dish_name,
+            calories=pending.calories,
+            protein=pending.protein,
+            fat=pending.fat,
+            carbs=pending.carbs,
+            analysis_type=pending.source
         )
         
         if success:
             logger.info(f"Meal saved successfully for user {user.id}")
-            meal_info = f"**🍽️ {meal_name}**\n\n{original_analysis}"
+            # Дополненный анализ содержит несколько блоков - в базу продуктов его не берем
+            if not pending.supplemented:
+                food_knowledge_base.learn_in_background(pending.result, pending.description, telegram_id=user.id)
+            meal_info = f"**🍽️ {meal_name}**\n\n{pending.display_text}"
             cleaned_meal_info = clean_markdown_text(meal_info)
             
             await query.edit_message_text(
@@ -1848,10 +1699,10 @@ async def handle_confirm_text_analysis(update: Update, context: ContextTypes.DEF
 
 __all__.append('handle_confirm_text_analysis')
 
+@callback_router.route("add_to_text_analysis")
 async def handle_add_to_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима добавления блюда (текст)"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('text_analysis_supplemented', False):
@@ -1890,10 +1741,10 @@ async def handle_add_to_text_analysis(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_add_to_text_analysis')
 
+@callback_router.route("add_to_check_text_analysis")
 async def handle_add_to_check_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима проверки калорий (текст)"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('check_text_analysis_supplemented', False):
@@ -1932,21 +1783,18 @@ async def handle_add_to_check_text_analysis(update: Update, context: ContextType
 
 __all__.append('handle_add_to_check_text_analysis')
 
+@callback_router.route("cancel_text_analysis")
 async def handle_cancel_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Отменить' для текстового анализа"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем все состояния
     context.user_data.pop('waiting_for_text_confirmation', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
+    pop_pending_analysis(context.user_data)
     context.user_data.pop('save_mode', None)
     context.user_data.pop('check_mode', None)
     context.user_data.pop('text_analysis_supplemented', None)
     context.user_data.pop('check_text_analysis_supplemented', None)
-    context.user_data.pop('calories_display', None)
     
     await query.edit_message_text(
         "❌ **Анализ отменен**\n\n"
@@ -1957,10 +1805,10 @@ async def handle_cancel_text_analysis(update: Update, context: ContextTypes.DEFA
 
 __all__.append('handle_cancel_text_analysis')
 
+@callback_router.route("add_to_check_analysis")
 async def handle_add_to_check_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима проверки калорий"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('check_analysis_supplemented', False):
@@ -2015,15 +1863,13 @@ async def handle_additional_text_analysis(update: Update, context: ContextTypes.
         return
     
     # Получаем оригинальный анализ
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по фото')
+    pending = get_pending_analysis(context.user_data)
     
-    logger.info(f"Original analysis length: {len(original_analysis) if original_analysis else 0}")
+    logger.info(f"Pending analysis: {pending!r}")
     logger.info(f"Additional text: '{additional_text}'")
     
-    if not original_analysis or not original_analysis.strip():
-        logger.error(f"Original analysis is empty or None: '{original_analysis}'")
+    if pending is None:
+        logger.error("Pending analysis not found")
         await message.reply_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -2038,40 +1884,23 @@ async def handle_additional_text_analysis(update: Update, context: ContextTypes.
     )
     
     try:
-        # Создаем комбинированный запрос
-        combined_prompt = f"Исходный анализ фото:\n{original_analysis}\n\nДополнительная информация от пользователя:\n{additional_text}\n\nНа основе исходного анализа и дополнительной информации, предоставь уточненный расчет калорий и БЖУ."
-        
-        logger.info(f"Combined prompt length: {len(combined_prompt)}")
-        logger.info(f"Combined prompt preview: {combined_prompt[:200]}...")
+        # В запрос уходят только числа показанного анализа и уточнение
+        previous_result = pending.to_prompt()
+        logger.info(f"Supplement request: previous result '{previous_result}'")
         
         # Анализируем дополнительный текст с помощью специальной функции
-        additional_analysis = await analyze_food_supplement(combined_prompt)
+        additional_analysis = await analyze_food_supplement(previous_result, additional_text, user_id=update.effective_user.id)
         
-        if additional_analysis and is_valid_analysis(additional_analysis):
-            # Объединяем оригинальный анализ с дополнительным
-            combined_analysis = f"{original_analysis}\n\n**📝 Дополнения:**\n{additional_text}\n\n**🔄 Уточненный расчет:**\n{additional_analysis}"
-            
-            # Извлекаем новые калории из дополненного анализа
-            new_calories = extract_calories_from_analysis(additional_analysis)
-            if new_calories and new_calories > 0:
-                # Используем новые калории
-                final_calories = new_calories
-                calories_display = f"{original_calories} → {new_calories} ккал"
-            else:
-                # Используем оригинальные калории
-                final_calories = original_calories
-                calories_display = f"{original_calories} ккал"
-            
-            # Обновляем сохраненные данные
-            context.user_data['original_analysis'] = combined_analysis
-            context.user_data['original_calories'] = final_calories
-            context.user_data['calories_display'] = calories_display
+        if additional_analysis and additional_analysis.is_valid:
+            # Уточненный расчет уже разобран; без калорий в нем остаются исходные числа
+            pending.supplement(additional_text, additional_analysis)
+            calories_display = pending.calories_display
             
             # Очищаем состояние ожидания дополнительного текста
             context.user_data.pop('waiting_for_additional_text', None)
             
             # Показываем обновленный результат с кнопками
-            cleaned_result = clean_markdown_text(combined_analysis)
+            cleaned_result = clean_markdown_text(pending.display_text)
             result_text = f"**🍽️ {context.user_data.get('meal_name_name', 'Прием пищи')}**\n\n{cleaned_result}\n\n📊 **Калорийность:** {calories_display}"
             
             await processing_msg.edit_text(
@@ -2124,15 +1953,13 @@ async def handle_check_additional_text_analysis(update: Update, context: Context
         return
     
     # Получаем оригинальный анализ
-    original_analysis = context.user_data.get('original_analysis', '')
-    original_calories = context.user_data.get('original_calories', 0)
-    original_dish_name = context.user_data.get('original_dish_name', 'Блюдо по фото')
+    pending = get_pending_analysis(context.user_data)
     
-    logger.info(f"Original analysis length: {len(original_analysis) if original_analysis else 0}")
+    logger.info(f"Pending analysis: {pending!r}")
     logger.info(f"Additional text: '{additional_text}'")
     
-    if not original_analysis or not original_analysis.strip():
-        logger.error(f"Original analysis is empty or None: '{original_analysis}'")
+    if pending is None:
+        logger.error("Pending analysis not found")
         await message.reply_text(
             "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
             reply_markup=get_main_menu_keyboard_for_user(update)
@@ -2147,40 +1974,23 @@ async def handle_check_additional_text_analysis(update: Update, context: Context
     )
     
     try:
-        # Создаем комбинированный запрос
-        combined_prompt = f"Исходный анализ фото:\n{original_analysis}\n\nДополнительная информация от пользователя:\n{additional_text}\n\nНа основе исходного анализа и дополнительной информации, предоставь уточненный расчет калорий и БЖУ."
-        
-        logger.info(f"Combined prompt length: {len(combined_prompt)}")
-        logger.info(f"Combined prompt preview: {combined_prompt[:200]}...")
+        # В запрос уходят только числа показанного анализа и уточнение
+        previous_result = pending.to_prompt()
+        logger.info(f"Supplement request: previous result '{previous_result}'")
         
         # Анализируем дополнительный текст с помощью специальной функции
-        additional_analysis = await analyze_food_supplement(combined_prompt)
+        additional_analysis = await analyze_food_supplement(previous_result, additional_text, user_id=update.effective_user.id)
         
-        if additional_analysis and is_valid_analysis(additional_analysis):
-            # Объединяем оригинальный анализ с дополнительным
-            combined_analysis = f"{original_analysis}\n\n**📝 Дополнения:**\n{additional_text}\n\n**🔄 Уточненный расчет:**\n{additional_analysis}"
-            
-            # Извлекаем новые калории из дополненного анализа
-            new_calories = extract_calories_from_analysis(additional_analysis)
-            if new_calories and new_calories > 0:
-                # Используем новые калории
-                final_calories = new_calories
-                calories_display = f"{original_calories} → {new_calories} ккал"
-            else:
-                # Используем оригинальные калории
-                final_calories = original_calories
-                calories_display = f"{original_calories} ккал"
-            
-            # Обновляем сохраненные данные
-            context.user_data['original_analysis'] = combined_analysis
-            context.user_data['original_calories'] = final_calories
-            context.user_data['calories_display'] = calories_display
+        if additional_analysis and additional_analysis.is_valid:
+            # Уточненный расчет уже разобран; без калорий в нем остаются исходные числа
+            pending.supplement(additional_text, additional_analysis)
+            calories_display = pending.calories_display
             
             # Очищаем состояние ожидания дополнительного текста
             context.user_data.pop('waiting_for_check_additional_text', None)
             
             # Показываем обновленный результат с кнопками
-            cleaned_result = clean_markdown_text(combined_analysis)
+            cleaned_result = clean_markdown_text(pending.display_text)
             result_text = f"🔍 **Анализ калорий**\n\n{cleaned_result}\n\n📊 **Калорийность:** {calories_display}\n\nℹ️ **Данные НЕ будут сохранены в статистику**"
             
             await processing_msg.edit_text(
@@ -2217,20 +2027,18 @@ async def handle_check_additional_text_analysis(update: Update, context: Context
 
 __all__.append('handle_check_additional_text_analysis')
 
+@callback_router.route("confirm_photo_text_analysis")
 async def handle_confirm_photo_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима добавления блюда (фото + текст)"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
     try:
         # Получаем сохраненные данные анализа
-        original_analysis = context.user_data.get('original_analysis')
-        original_calories = context.user_data.get('original_calories')
-        original_dish_name = context.user_data.get('original_dish_name')
+        pending = get_pending_analysis(context.user_data)
         
-        if not original_analysis:
+        if pending is None:
             await query.edit_message_text(
                 "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
                 reply_markup=InlineKeyboardMarkup([
@@ -2239,21 +2047,6 @@ async def handle_confirm_photo_text_analysis(update: Update, context: ContextTyp
             )
             return
         
-        # Получаем данные из контекста (если есть дополнения) или извлекаем из анализа
-        from services.food_analysis_service import extract_macros_from_analysis, clean_markdown_text, extract_dish_name_from_analysis
-        
-        # Проверяем, есть ли сохраненные БЖУ в контексте (после дополнения)
-        if 'original_protein' in context.user_data:
-            calories = context.user_data.get('original_calories', 0)
-            protein = context.user_data.get('original_protein', 0)
-            fat = context.user_data.get('original_fat', 0)
-            carbs = context.user_data.get('original_carbs', 0)
-            dish_name = context.user_data.get('original_dish_name', 'Блюдо')
-        else:
-            # Извлекаем данные из анализа
-            calories, protein, fat, carbs = extract_macros_from_analysis(original_analysis)
-            dish_name = extract_dish_name_from_analysis(original_analysis) or original_dish_name
-        
         # Получаем выбранный прием пищи
         meal_type = context.user_data.get('meal_name', 'meal_breakfast')
         meal_name = context.user_data.get('meal_name_name', 'Завтрак')
@@ -2264,11 +2057,11 @@ async def handle_confirm_photo_text_analysis(update: Update, context: ContextTyp
             telegram_id=user.id,
             meal_type=meal_type,
             meal_name=meal_name,
-            dish_name=dish_name,
-            calories=calories,
-            protein=protein,
-            fat=fat,
-            carbs=carbs,
+            dish_name=pending.dish_name,
+            calories=pending.calories,
+            protein=pending.protein,
+            fat=pending.fat,
+            carbs=pending.carbs,
             analysis_type="photo_text"
         )
         
@@ -2277,15 +2070,10 @@ async def handle_confirm_photo_text_analysis(update: Update, context: ContextTyp
             context.user_data.pop('waiting_for_photo_text_confirmation', None)
             context.user_data.pop('waiting_for_photo_text', None)
             context.user_data.pop('waiting_for_photo_text_additional', None)
-            context.user_data.pop('original_analysis', None)
-            context.user_data.pop('original_calories', None)
-            context.user_data.pop('original_dish_name', None)
-            context.user_data.pop('original_protein', None)
-            context.user_data.pop('original_fat', None)
-            context.user_data.pop('original_carbs', None)
+            pop_pending_analysis(context.user_data)
             context.user_data.pop('save_mode', None)
             
-            cleaned_result = clean_markdown_text(original_analysis)
+            cleaned_result = clean_markdown_text(pending.display_text)
             result_text = f"✅ Блюдо добавлено в статистику!\n\n🍽️ {meal_name}\n\n{cleaned_result}"
             
             await query.edit_message_text(
@@ -2315,10 +2103,10 @@ async def handle_confirm_photo_text_analysis(update: Update, context: ContextTyp
 
 __all__.append('handle_confirm_photo_text_analysis')
 
+@callback_router.route("add_to_photo_text_analysis")
 async def handle_add_to_photo_text_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима добавления блюда (фото + текст)"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('photo_text_additional_used', False):
@@ -2352,22 +2140,17 @@ async def handle_add_to_photo_text_analysis(update: Update, context: ContextType
 
 __all__.append('handle_add_to_photo_text_analysis')
 
+@callback_router.route("confirm_photo_text_check_analysis")
 async def handle_confirm_photo_text_check_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Все верно?' для режима проверки калорий (фото + текст)"""
     query = update.callback_query
-    await query.answer()
     
     # Очищаем состояния
     context.user_data.pop('waiting_for_photo_text_confirmation', None)
     context.user_data.pop('waiting_for_photo_text', None)
     context.user_data.pop('waiting_for_photo_text_additional', None)
     context.user_data.pop('waiting_for_photo_text_check_additional', None)
-    context.user_data.pop('original_analysis', None)
-    context.user_data.pop('original_calories', None)
-    context.user_data.pop('original_dish_name', None)
-    context.user_data.pop('original_protein', None)
-    context.user_data.pop('original_fat', None)
-    context.user_data.pop('original_carbs', None)
+    pop_pending_analysis(context.user_data)
     context.user_data.pop('check_mode', None)
     
     await query.edit_message_text(
@@ -2380,10 +2163,10 @@ async def handle_confirm_photo_text_check_analysis(update: Update, context: Cont
 
 __all__.append('handle_confirm_photo_text_check_analysis')
 
+@callback_router.route("add_to_photo_text_check_analysis")
 async def handle_add_to_photo_text_check_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Дополнить' для режима проверки калорий (фото + текст)"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, не использовал ли пользователь уже возможность дополнения
     if context.user_data.get('photo_text_check_additional_used', False):
@@ -2435,8 +2218,8 @@ async def handle_photo_text_additional_analysis(update: Update, context: Context
             return
         
         # Получаем оригинальный анализ
-        original_analysis = context.user_data.get('original_analysis')
-        if not original_analysis:
+        pending = get_pending_analysis(context.user_data)
+        if pending is None:
             await message.reply_text(
                 "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
                 reply_markup=InlineKeyboardMarkup([
@@ -2445,64 +2228,18 @@ async def handle_photo_text_additional_analysis(update: Update, context: Context
             )
             return
         
-        # Создаем уточненный запрос
-        from api_client import api_client
-        
-        # Сначала анализируем фото (используем кэш)
-        photo_analysis = original_analysis
-        
-        # Создаем объединенный промпт
-        combined_prompt = f"""
-Исходный анализ фото:
-{photo_analysis}
-
-Дополнительная информация от пользователя:
-{additional_text}
-
-На основе анализа фото и дополнительной информации пользователя, предоставь уточненный анализ в следующем формате:
-
-🍽️ Анализ блюда:
-
-Название: [название блюда]
-Вес: [общий вес блюда]г
-Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
-
-📊 БЖУ на 100г:
-• Белки: [количество]г
-• Жиры: [количество]г  
-• Углеводы: [количество]г
-
-📈 Общее БЖУ в блюде:
-• Белки: [общее количество]г
-• Жиры: [общее количество]г
-• Углеводы: [общее количество]г
-
-Учти дополнительную информацию пользователя для более точного определения веса, ингредиентов и способа приготовления.
-"""
-        
-        # Отправляем уточненный запрос
-        async with api_client:
-            refined_analysis = await api_client.analyze_photo_with_text(None, combined_prompt)
+        # В запрос уходят только числа показанного анализа и уточнение: повторно
+        # анализировать фото не нужно, а прежний текст анализа не пересылается
+        refined_analysis = await analyze_food_supplement(
+            pending.to_prompt(), additional_text, user_id=update.effective_user.id
+        )
         
         if refined_analysis:
-            # Обновляем данные анализа
-            context.user_data['original_analysis'] = refined_analysis
-            
-            # Извлекаем данные из уточненного анализа
-            from services.food_analysis_service import extract_macros_from_analysis, clean_markdown_text, extract_dish_name_from_analysis
-            
-            calories, protein, fat, carbs = extract_macros_from_analysis(refined_analysis)
-            dish_name = extract_dish_name_from_analysis(refined_analysis) or 'Блюдо'
-            
-            # Обновляем сохраненные данные
-            context.user_data['original_calories'] = calories
-            context.user_data['original_dish_name'] = dish_name
-            context.user_data['original_protein'] = protein
-            context.user_data['original_fat'] = fat
-            context.user_data['original_carbs'] = carbs
+            # Уточненный анализ уже разобран и заменяет исходный
+            pending.supplement(additional_text, refined_analysis, replace_display=True)
             
             # Показываем уточненный результат
-            cleaned_result = clean_markdown_text(refined_analysis)
+            cleaned_result = clean_markdown_text(pending.display_text)
             result_text = f"✏️ Уточненный анализ\n\n{cleaned_result}"
             
             await message.reply_text(
@@ -2554,8 +2291,8 @@ async def handle_photo_text_check_additional_analysis(update: Update, context: C
             return
         
         # Получаем оригинальный анализ
-        original_analysis = context.user_data.get('original_analysis')
-        if not original_analysis:
+        pending = get_pending_analysis(context.user_data)
+        if pending is None:
             await message.reply_text(
                 "❌ Ошибка: данные анализа не найдены. Попробуйте еще раз.",
                 reply_markup=InlineKeyboardMarkup([
@@ -2564,64 +2301,18 @@ async def handle_photo_text_check_additional_analysis(update: Update, context: C
             )
             return
         
-        # Создаем уточненный запрос
-        from api_client import api_client
-        
-        # Сначала анализируем фото (используем кэш)
-        photo_analysis = original_analysis
-        
-        # Создаем объединенный промпт
-        combined_prompt = f"""
-Исходный анализ фото:
-{photo_analysis}
-
-Дополнительная информация от пользователя:
-{additional_text}
-
-На основе анализа фото и дополнительной информации пользователя, предоставь уточненный анализ в следующем формате:
-
-🍽️ Анализ блюда:
-
-Название: [название блюда]
-Вес: [общий вес блюда]г
-Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
-
-📊 БЖУ на 100г:
-• Белки: [количество]г
-• Жиры: [количество]г  
-• Углеводы: [количество]г
-
-📈 Общее БЖУ в блюде:
-• Белки: [общее количество]г
-• Жиры: [общее количество]г
-• Углеводы: [общее количество]г
-
-Учти дополнительную информацию пользователя для более точного определения веса, ингредиентов и способа приготовления.
-"""
-        
-        # Отправляем уточненный запрос
-        async with api_client:
-            refined_analysis = await api_client.analyze_photo_with_text(None, combined_prompt)
+        # В запрос уходят только числа показанного анализа и уточнение: повторно
+        # анализировать фото не нужно, а прежний текст анализа не пересылается
+        refined_analysis = await analyze_food_supplement(
+            pending.to_prompt(), additional_text, user_id=update.effective_user.id
+        )
         
         if refined_analysis:
-            # Обновляем данные анализа
-            context.user_data['original_analysis'] = refined_analysis
-            
-            # Извлекаем данные из уточненного анализа
-            from services.food_analysis_service import extract_macros_from_analysis, clean_markdown_text, extract_dish_name_from_analysis
-            
-            calories, protein, fat, carbs = extract_macros_from_analysis(refined_analysis)
-            dish_name = extract_dish_name_from_analysis(refined_analysis) or 'Блюдо'
-            
-            # Обновляем сохраненные данные
-            context.user_data['original_calories'] = calories
-            context.user_data['original_dish_name'] = dish_name
-            context.user_data['original_protein'] = protein
-            context.user_data['original_fat'] = fat
-            context.user_data['original_carbs'] = carbs
+            # Уточненный анализ уже разобран и заменяет исходный
+            pending.supplement(additional_text, refined_analysis, replace_display=True)
             
             # Показываем уточненный результат
-            cleaned_result = clean_markdown_text(refined_analysis)
+            cleaned_result = clean_markdown_text(pending.display_text)
             result_text = f"✏️ **Уточненный анализ**\n\n{cleaned_result}\n\nℹ️ **Данные НЕ будут сохранены в статистику**"
             
             await message.reply_text(
@@ -2658,10 +2349,10 @@ async def handle_photo_text_check_additional_analysis(update: Update, context: C
 
 __all__.append('handle_photo_text_check_additional_analysis')
 
+@callback_router.route("send_location")
 async def handle_send_location_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Отправить геолокацию'"""
     query = update.callback_query
-    await query.answer()
     
     await query.edit_message_text(
         "📍 **Отправьте геолокацию**\n\n"
@@ -2670,10 +2361,10 @@ async def handle_send_location_callback(update: Update, context: ContextTypes.DE
         parse_mode='Markdown'
     )
 
+@callback_router.route("manual_timezone")
 async def handle_manual_timezone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Выбрать часовой пояс вручную'"""
     query = update.callback_query
-    await query.answer()
     
     # Создаем клавиатуру с выбором полушария
     from constants import TIMEZONE_HEMISPHERES
@@ -2902,7 +2593,6 @@ async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         # Для callback query
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text(
             welcome_text,
             reply_markup=reply_markup,
@@ -2,6 +2,7 @@
 from ._shared import *
 from database import is_payment_processed, mark_payment_processed  # imports, constants, helpers
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 from handlers.menu import get_main_menu_keyboard_for_user
 
 __all__ = []
@@ -63,10 +64,10 @@ async def subscription_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 __all__.append('subscription_command')
 
+@callback_router.route(prefixes=("buy_",))
 async def handle_subscription_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает покупку подписки"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     subscription_type = query.data.replace('buy_', '')
@@ -1,6 +1,7 @@
 # Auto-generated module for profile handlers extracted from bot_functions.py
 from ._shared import *  # imports, constants, helpers
 import bot_functions as bf  # for cross-module handler calls
+from handlers.router import callback_router
 
 __all__ = []
 
@@ -15,10 +16,10 @@ async def send_not_registered_message(update: Update, context: ContextTypes.DEFA
 
 __all__.append('send_not_registered_message')
 
+@callback_router.route(prefixes=("tz_",))
 async def handle_timezone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора часового пояса"""
     query = update.callback_query
-    await query.answer()
     
     # Проверяем, есть ли данные пользователя
     if 'user_data' not in context.user_data:
@@ -310,7 +311,6 @@ __all__.append('addmeal_command')
 async def show_meal_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику по приемам пищи с БЖУ и прогресс-барами"""
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     
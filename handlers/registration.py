@@ -13,6 +13,7 @@ from constants import (
 )
 import utils
 from logging_config import get_logger
+from handlers.router import callback_router
 
 logger = get_logger(__name__)
 
@@ -252,6 +253,7 @@ async def handle_text_input_registration(update: Update, context: ContextTypes.D
 
 # ==================== CALLBACK HANDLERS ====================
 
+@callback_router.route("register")
 async def handle_register_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback кнопки регистрации"""
     query = update.callback_query
@@ -286,7 +288,6 @@ async def handle_register_callback(update: Update, context: ContextTypes.DEFAULT
 async def handle_gender_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора пола"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith('gender_'):
         # Проверяем, есть ли данные пользователя
@@ -311,7 +312,6 @@ async def handle_gender_callback(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_activity_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора уровня активности"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith('activity_'):
         # Проверяем, есть ли данные пользователя
@@ -356,7 +356,6 @@ async def handle_activity_callback(update: Update, context: ContextTypes.DEFAULT
 async def handle_goal_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик выбора цели"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith('goal_'):
         # Проверяем, есть ли данные пользователя
@@ -0,0 +1,159 @@
+"""
+Маршрутизация callback-запросов inline-кнопок
+
+Обработчики регистрируются декоратором в своих модулях:
+
+    @callback_router.route("confirm_analysis")
+    @callback_router.route(prefixes=("meal_",))
+
+Точные значения callback_data ищутся в словаре, параметризованные (meal_lunch, tz_...,
+reminder_...) - в префиксном дереве по символам данных, выбирается самый длинный
+зарегистрированный префикс. Время поиска зависит только от длины callback_data, но не
+от числа маршрутов. Для каждого маршрута считаются вызовы, ошибки и задержка обработки.
+"""
+import time
+from collections import deque
+from typing import Optional, Dict, Any, Deque, Callable, Awaitable, Iterable
+from telegram import Update
+from telegram.ext import ContextTypes
+from logging_config import get_logger
+from resilience import percentile
+
+logger = get_logger(__name__)
+
+CallbackHandler = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[Any]]
+
+
+class RouteStats:
+    """Вызовы, ошибки и задержка одного маршрута (скользящее окно последних вызовов)"""
+
+    def __init__(self, window: int = 200):
+        self.calls = 0
+        self.errors = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'p50': percentile(self.latencies, 0.5),
+            'p95': percentile(self.latencies, 0.95),
+        }
+
+
+class CallbackRoute:
+    """
+    Маршрут: обработчик и его статистика
+
+    По умолчанию router отвечает на callback до вызова обработчика, поэтому обработчики
+    (и вызываемые ими функции меню) query.answer() не вызывают - повторный ответ это лишний
+    запрос к Telegram. answer=False - обработчик сам отвечает на callback (например, с текстом
+    или show_alert), router не вызывает query.answer()
+    """
+
+    def __init__(self, name: str, handler: CallbackHandler, answer: bool = True):
+        self.name = name
+        self.handler = handler
+        self.answer = answer
+        self.stats = RouteStats()
+
+
+class _PrefixNode:
+    __slots__ = ('children', 'route')
+
+    def __init__(self):
+        self.children: Dict[str, '_PrefixNode'] = {}
+        self.route: Optional[CallbackRoute] = None
+
+
+class CallbackRouter:
+    """Таблица маршрутов callback_data: словарь точных значений и префиксное дерево"""
+
+    def __init__(self):
+        self._exact: Dict[str, CallbackRoute] = {}
+        self._prefixes = _PrefixNode()
+        self.routes: Dict[str, CallbackRoute] = {}
+
+    def add(self, handler: CallbackHandler, data: Iterable[str] = (), prefixes: Iterable[str] = (),
+            answer: bool = True):
+        """Регистрирует обработчик для точных значений data и префиксов prefixes"""
+        for value in data:
+            if value in self._exact:
+                raise ValueError(f"Callback data '{value}' is already routed to {self._exact[value].handler.__name__}")
+            self._exact[value] = self._new_route(value, handler, answer)
+        for prefix in prefixes:
+            if not prefix:
+                raise ValueError("Empty callback prefix")
+            node = self._prefixes
+            for char in prefix:
+                node = node.children.setdefault(char, _PrefixNode())
+            if node.route is not None:
+                raise ValueError(f"Callback prefix '{prefix}' is already routed to {node.route.handler.__name__}")
+            node.route = self._new_route(f"{prefix}*", handler, answer)
+
+    def _new_route(self, name: str, handler: CallbackHandler, answer: bool) -> CallbackRoute:
+        route = CallbackRoute(name, handler, answer)
+        self.routes[name] = route
+        return route
+
+    def route(self, *data: str, prefixes: Iterable[str] = (), answer: bool = True):
+        """Декоратор: регистрирует функцию и возвращает ее без изменений"""
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            self.add(handler, data, prefixes, answer)
+            return handler
+        return decorator
+
+    def resolve(self, data: Optional[str]) -> Optional[CallbackRoute]:
+        """Маршрут для callback_data: точное совпадение или самый длинный префикс"""
+        if not data:
+            return None
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        node = self._prefixes
+        for char in data:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.route is not None:
+                route = node.route
+        return route
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Вызывает обработчик маршрута; False, если маршрут для callback_data не найден"""
+        query = update.callback_query
+        route = self.resolve(query.data)
+        if route is None:
+            return False
+
+        if route.answer:
+            try:
+                await query.answer()
+            except Exception as e:
+                logger.warning(f"Failed to answer callback query: {e}")
+                # Продолжаем обработку даже если не удалось ответить на callback
+
+        logger.debug(f"Callback {query.data} from user {update.effective_user.id} -> {route.handler.__name__}")
+        stats = route.stats
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            await route.handler(update, context)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latencies.append(time.perf_counter() - started)
+        return True
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Статистика маршрутов, которые уже вызывались"""
+        return {name: route.stats.get_stats() for name, route in self.routes.items() if route.stats.calls}
+
+    def reset_stats(self):
+        for route in self.routes.values():
+            route.stats = RouteStats()
+
+
+# Глобальная таблица маршрутов
+callback_router = CallbackRouter()
@@ -1,7 +1,9 @@
 """
 Модуль для работы с подписками пользователей
 """
+import asyncio
 import logging
+import time
 from typing import Any
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import ContextTypes
@@ -17,6 +19,7 @@ from database import (
 from constants import SUBSCRIPTION_PRICES, SUBSCRIPTION_DESCRIPTIONS
 from config import BOT_TOKEN, TEST_MODE
 from logging_config import get_logger
+from performance_optimizations import PRIORITY_PREMIUM, PRIORITY_DEFAULT, PRIORITY_FREE_CHECK
 
 logger = get_logger(__name__)
 
@@ -45,6 +48,42 @@ def check_subscription_access(telegram_id: int) -> dict:
         return {'has_access': False, 'subscription_type': 'error', 'expires_at': None}
 
 
+# Статус подписки для приоритета запросов к ИИ запоминается в user_data на время сценария,
+# чтобы не читать базу перед каждым запросом к модели
+PRIORITY_ACCESS_KEY = 'ai_priority_access'
+PRIORITY_ACCESS_TTL = 300  # секунд
+
+
+def _priority_for_access(has_access: bool, is_check_mode: bool) -> int:
+    """Приоритет запроса к ИИ: подписчики впереди, бесплатные проверки калорий - в конце очереди"""
+    if has_access:
+        return PRIORITY_PREMIUM
+    return PRIORITY_FREE_CHECK if is_check_mode else PRIORITY_DEFAULT
+
+
+def remember_subscription_access(context: ContextTypes.DEFAULT_TYPE, access_info: dict):
+    """Запоминает статус подписки, проверенный в начале сценария, для приоритета запросов к ИИ"""
+    context.user_data[PRIORITY_ACCESS_KEY] = (access_info['has_access'], time.monotonic())
+
+
+async def get_flow_ai_request_priority(context: ContextTypes.DEFAULT_TYPE, telegram_id: int,
+                                       is_check_mode: bool = False) -> int:
+    """
+    Приоритет запроса к ИИ для текущего сценария
+
+    База читается (в отдельном потоке) только если статус подписки еще не запомнен
+    или устарел; остальные запросы сценария берут его из user_data.
+    """
+    cached = context.user_data.get(PRIORITY_ACCESS_KEY)
+    if cached is None or time.monotonic() - cached[1] > PRIORITY_ACCESS_TTL:
+        access_info = await asyncio.to_thread(check_subscription_access, telegram_id)
+        remember_subscription_access(context, access_info)
+        has_access = access_info['has_access']
+    else:
+        has_access = cached[0]
+    return _priority_for_access(has_access, is_check_mode)
+
+
 def get_subscription_message(access_info: dict) -> str:
     """Возвращает сообщение о статусе подписки"""
     if access_info['has_access']:
@@ -232,7 +271,6 @@ async def create_payment_invoice(user_id: int, subscription_type: str, price: in
 async def handle_subscription_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик покупки подписки"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     
@@ -254,7 +292,6 @@ async def handle_subscription_purchase(update: Update, context: ContextTypes.DEF
 async def handle_activate_trial_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик активации триального периода"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     await activate_trial_subscription(user_id, query)
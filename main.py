@@ -10,11 +10,12 @@ from bot_functions import (
     handle_callback_query, handle_photo, handle_voice, handle_location,
     handle_pre_checkout_query, handle_successful_payment
 )
-from handlers.misc import handle_stats_today_callback
-from reminder_commands import reminder_settings_command, handle_reminder_callback
+from reminder_commands import reminder_settings_command
 from error_handlers import error_handler
 from logging_config import setup_logging, get_logger
 from scheduler import setup_scheduler, start_scheduler, stop_scheduler
+from cache_manager import shared_cache_backend
+from api_client import api_client
 
 # Настройка логирования
 setup_logging(
@@ -69,9 +70,7 @@ def main():
         application.add_handler(CommandHandler("addmeal", addmeal_command))
         application.add_handler(CommandHandler("addvoice", addvoice_command))
         
-        # Добавляем обработчик callback запросов (более специфичные обработчики идут первыми)
-        application.add_handler(CallbackQueryHandler(handle_reminder_callback, pattern="^reminder_|^timezone_"))
-        application.add_handler(CallbackQueryHandler(handle_stats_today_callback, pattern="^stats_today$"))
+        # Добавляем обработчик callback запросов (кнопки распределяются по таблице маршрутов handlers/router.py)
         application.add_handler(CallbackQueryHandler(handle_callback_query))
         
         # Добавляем обработчики платежей
@@ -103,8 +102,22 @@ def main():
             """Устанавливаем команды бота после инициализации"""
             await app.bot.set_my_commands(commands)
             logger.info("Bot commands menu configured")
+            
+            # Общая HTTP-сессия для запросов к ИИ живет столько же, сколько приложение
+            await api_client.start()
+            
+            # Общий кэш между репликами: запускаем прием инвалидаций
+            if shared_cache_backend:
+                await shared_cache_backend.start()
+        
+        async def post_shutdown(app):
+            """Освобождаем ресурсы после остановки бота"""
+            await api_client.close()
+            if shared_cache_backend:
+                await shared_cache_backend.close()
         
         application.post_init = post_init
+        application.post_shutdown = post_shutdown
         
         application.run_polling(
             allowed_updates=["message", "callback_query", "pre_checkout_query"],
@@ -0,0 +1,120 @@
+"""
+Структурированный результат анализа блюда
+
+ИИ в режиме structured output возвращает JSON по ANALYSIS_JSON_SCHEMA, он один раз
+разбирается в AnalysisResult, а текст для пользователя собирается локально по шаблону.
+Ответ в текстовом формате разбирает services/analysis_parser.py в тот же AnalysisResult.
+Клиент API, сервисы и PendingAnalysis передают друг другу сам объект, а не его текст.
+"""
+import json
+from dataclasses import dataclass, asdict
+from typing import Optional, Dict, Any, Tuple
+
+# Плоская схема: меньше токенов в ответе, общее БЖУ считается локально из значений на 100г
+ANALYSIS_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "dish_name": {"type": "string", "description": "Название блюда на русском"},
+        "weight_g": {"type": "number", "description": "Общий вес блюда в граммах"},
+        "calories_total": {"type": "number", "description": "Калорийность всего блюда, ккал"},
+        "calories_per_100g": {"type": "number"},
+        "protein_per_100g": {"type": "number"},
+        "fat_per_100g": {"type": "number"},
+        "carbs_per_100g": {"type": "number"},
+    },
+    "required": [
+        "dish_name", "weight_g", "calories_total",
+        "calories_per_100g", "protein_per_100g", "fat_per_100g", "carbs_per_100g"
+    ],
+    "additionalProperties": False,
+}
+
+# response_format для chat/completions
+ANALYSIS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "food_analysis", "strict": True, "schema": ANALYSIS_JSON_SCHEMA},
+}
+
+
+@dataclass(frozen=True, slots=True)
+class AnalysisResult:
+    """
+    Результат анализа блюда: итоговые калории и БЖУ, БЖУ на 100г и текст для показа
+
+    Неизменяемый: один объект безопасно отдавать из кэша нескольким обработчикам.
+    Значения, которых не было в текстовом ответе ИИ, остаются None (БЖУ - 0).
+    """
+    dish_name: Optional[str]
+    weight: Optional[float]
+    calories: Optional[int]
+    calories_per_100g: Optional[int] = None
+    protein: float = 0.0
+    fat: float = 0.0
+    carbs: float = 0.0
+    macros_per_100g: Optional[Tuple[float, float, float]] = None
+    # Текст анализа без пояснений ИИ (для structured-ответа - собранный по шаблону)
+    text: str = ""
+    is_valid: bool = True
+
+    @classmethod
+    def from_per_100g(cls, dish_name: str, weight: float, calories: int, calories_per_100g: Optional[int],
+                      protein_per_100g: float, fat_per_100g: float, carbs_per_100g: float) -> "AnalysisResult":
+        """Результат по БЖУ на 100г: итоговое БЖУ вычисляется по весу, текст собирается по шаблону"""
+        per_100g = (protein_per_100g, fat_per_100g, carbs_per_100g)
+        protein, fat, carbs = (round(value * weight / 100, 1) for value in per_100g)
+        text = render_analysis_text(dish_name, weight, calories, per_100g, (protein, fat, carbs))
+        return cls(dish_name, weight, calories, calories_per_100g, protein, fat, carbs, per_100g, text)
+
+    @classmethod
+    def from_json(cls, content: str) -> "AnalysisResult":
+        """Разбирает ответ ИИ по ANALYSIS_JSON_SCHEMA; при некорректных данных бросает ValueError"""
+        try:
+            data = json.loads(content)
+            dish_name = str(data["dish_name"]).strip()
+            weight = float(data["weight_g"])
+            calories = round(float(data["calories_total"]))
+            calories_per_100g = round(float(data["calories_per_100g"]))
+            per_100g = [round(float(data[key]), 1) for key in ("protein_per_100g", "fat_per_100g", "carbs_per_100g")]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid structured analysis: {e}") from e
+
+        if not dish_name or weight <= 0 or not 0 < calories < 10000 or any(value < 0 for value in per_100g):
+            raise ValueError(f"Implausible structured analysis: {data}")
+        return cls.from_per_100g(dish_name, weight, calories, calories_per_100g or None, *per_100g)
+
+    @property
+    def macros(self) -> Tuple[int, float, float, float]:
+        """Итог для всего блюда: (калории, белки, жиры, углеводы)"""
+        return self.calories or 0, self.protein, self.fat, self.carbs
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Словарь для JSON-кэша (общий L2 хранит записи в JSON)"""
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "AnalysisResult":
+        per_100g = data.get('macros_per_100g')
+        return cls(**{**data, 'macros_per_100g': tuple(per_100g) if per_100g else None})
+
+
+# Пустой результат для текста, который не удалось разобрать
+EMPTY_ANALYSIS = AnalysisResult(None, None, None, is_valid=False)
+
+
+def render_analysis_text(dish_name: str, weight: float, calories: int,
+                         per_100g: Tuple[float, float, float], totals: Tuple[float, float, float]) -> str:
+    """Текст анализа в привычном пользователю формате"""
+    return (
+        "🍽️ Анализ блюда:\n\n"
+        f"Название: {dish_name}\n"
+        f"Вес: {weight:g}г\n"
+        f"Калорийность: {calories} ккал\n\n"
+        "📊 БЖУ на 100г:\n"
+        f"• Белки: {per_100g[0]:g}г\n"
+        f"• Жиры: {per_100g[1]:g}г\n"
+        f"• Углеводы: {per_100g[2]:g}г\n\n"
+        "📈 Общее БЖУ в блюде:\n"
+        f"• Белки: {totals[0]:g}г\n"
+        f"• Жиры: {totals[1]:g}г\n"
+        f"• Углеводы: {totals[2]:g}г"
+    )
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Выбор обработчика callback-запроса: прежняя цепочка if/elif против таблицы маршрутов
+
+Для всех callback_data, которые создают кнопки бота (точные значения и параметризованные -
+meal_, tz_, reminder_, timezone_, admin_...:id, buy_...), измеряется время выбора обработчика:
+- прежним способом - последовательными сравнениями в порядке цепочки handle_callback_query
+  (для каждой кнопки печатается число сравнений до нужной ветки);
+- через handlers/router.py - словарь точных значений и префиксное дерево.
+Затем весь набор прогоняется через CallbackRouter.dispatch с обработчиками-заглушками и
+печатаются счетчики маршрутов.
+
+Использование: python perf/bench_callbacks.py [--rounds 20000]
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import tempfile
+import time
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+
+# Все callback_data кнопок бота
+CALLBACK_SET = [
+    "register", "help", "main_menu", "subscription", "buy_subscription", "terms",
+    "gender_male", "gender_female", "activity_minimal", "activity_light", "activity_moderate",
+    "activity_high", "activity_very_high", "goal_lose_weight", "goal_maintain", "goal_gain_weight",
+    "send_location", "manual_timezone", "tz_other", "tz_group_3", "tz_hemisphere_eastern",
+    "tz_hemisphere_western", "tz_back_to_hemispheres", "tz_europe_moscow", "reset_confirm", "add_dish",
+    "check_calories", "menu_from_meal_selection", "profile", "back_to_main", "meal_breakfast", "meal_lunch",
+    "meal_dinner", "meal_snack", "analyze_photo", "analyze_voice", "analyze_photo_text", "check_photo",
+    "check_voice", "check_photo_text", "statistics", "stats_today", "stats_yesterday", "stats_week",
+    "admin_stats", "admin_users", "admin_meals", "admin_broadcast", "broadcast_create", "broadcast_stats",
+    "broadcast_confirm", "broadcast_cancel", "admin_subscriptions", "admin_check_subscription",
+    "admin_activate_trial:123456789", "admin_activate_premium:123456789",
+    "admin_deactivate_subscription:123456789", "admin_back", "admin_panel", "buy_premium_7_days",
+    "separator", "admin_star_balance", "admin_ai_health", "admin_ai_health_reset", "cancel_analysis",
+    "confirm_analysis", "add_to_analysis", "confirm_check_analysis", "add_to_check_analysis",
+    "confirm_photo_text_analysis", "add_to_photo_text_analysis", "confirm_photo_text_check_analysis",
+    "add_to_photo_text_check_analysis", "confirm_text_analysis", "add_to_text_analysis",
+    "confirm_check_text_analysis", "add_to_check_text_analysis", "cancel_text_analysis",
+    "reminder_settings", "reminder_timezone", "reminder_enable", "reminder_disable", "reminder_info",
+    "reminder_test", "timezone_Europe_Moscow",
+]
+
+# Ветки прежней цепочки handle_callback_query в исходном порядке; reminder_/timezone_ и
+# stats_today перехватывали отдельные CallbackQueryHandler с regex до цепочки
+LEGACY_CHAIN = (
+    [lambda d: d.startswith('reminder_') or d.startswith('timezone_'), lambda d: d == "stats_today"]
+    + [lambda d, v=v: d == v for v in (
+        "register", "help", "main_menu", "subscription", "buy_subscription", "terms")]
+    + [lambda d, p=p: d.startswith(p) for p in ('gender_', 'activity_', 'goal_')]
+    + [lambda d: d == "send_location", lambda d: d == "manual_timezone",
+       lambda d: (d.startswith('tz_') or d == 'tz_other' or d.startswith('tz_group_')
+                  or d.startswith('tz_hemisphere_') or d == 'tz_back_to_hemispheres')]
+    + [lambda d, v=v: d == v for v in (
+        "reset_confirm", "add_dish", "check_calories", "addmeal", "menu_from_meal_selection",
+        "profile", "back_to_main")]
+    + [lambda d: d.startswith('meal_')]
+    + [lambda d, v=v: d == v for v in (
+        "analyze_photo", "analyze_text", "analyze_voice", "analyze_photo_text", "check_photo", "check_text",
+        "check_voice", "check_photo_text", "statistics", "stats_today", "stats_yesterday", "stats_week",
+        "admin_stats", "admin_users", "admin_meals", "admin_broadcast", "broadcast_create", "broadcast_stats",
+        "broadcast_confirm", "broadcast_cancel", "admin_subscriptions", "admin_check_subscription",
+        "admin_manage_subscription")]
+    + [lambda d, p=p: d.startswith(p + ':') for p in (
+        'admin_activate_trial', 'admin_activate_premium', 'admin_deactivate_subscription')]
+    + [lambda d, v=v: d == v for v in ("admin_back", "admin_panel", "buy_subscription")]
+    + [lambda d: d.startswith("buy_"), lambda d: d == "separator", lambda d: d == "admin_star_balance",
+       lambda d: d in ("admin_ai_health", "admin_ai_health_reset")]
+    + [lambda d, v=v: d == v for v in (
+        "cancel_analysis", "confirm_analysis", "add_to_analysis", "confirm_check_analysis",
+        "add_to_check_analysis", "confirm_photo_text_analysis", "add_to_photo_text_analysis",
+        "confirm_photo_text_check_analysis", "add_to_photo_text_check_analysis", "confirm_text_analysis",
+        "add_to_text_analysis", "confirm_check_text_analysis", "add_to_check_text_analysis",
+        "cancel_text_analysis")]
+)
+
+
+def legacy_resolve(data: str) -> int:
+    """Номер ветки прежней цепочки (-1 - неизвестная кнопка)"""
+    for index, matches in enumerate(LEGACY_CHAIN):
+        if matches(data):
+            return index
+    return -1
+
+
+def time_per_lookup(resolve, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in CALLBACK_SET:
+            resolve(data)
+    return (time.perf_counter() - started) / (rounds * len(CALLBACK_SET))
+
+
+async def noop_handler(update, context):
+    pass
+
+
+async def noop_answer():
+    pass
+
+
+async def run_dispatch(router, rounds: int) -> float:
+    user = SimpleNamespace(id=1)
+    updates = [SimpleNamespace(callback_query=SimpleNamespace(data=data, answer=noop_answer), effective_user=user)
+               for data in CALLBACK_SET]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            await router.dispatch(update, None)
+    return (time.perf_counter() - started) / (rounds * len(updates))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время выбора обработчика callback-запроса")
+    parser.add_argument('--rounds', type=int, default=20000, help='Проходов по всему набору callback_data')
+    args = parser.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    import bot_functions  # noqa: F401 - модули обработчиков регистрируют свои маршруты
+    from handlers.router import callback_router, CallbackRouter
+
+    unrouted = [data for data in CALLBACK_SET if callback_router.resolve(data) is None]
+    if unrouted:
+        print(f"Нет маршрута: {', '.join(unrouted)}")
+    comparisons = [legacy_resolve(data) + 1 for data in CALLBACK_SET]
+    print(f"Кнопок: {len(CALLBACK_SET)}, маршрутов: {len(callback_router.routes)}, веток прежней цепочки: "
+          f"{len(LEGACY_CHAIN)}; сравнений до ветки: среднее {sum(comparisons) / len(comparisons):.1f}, "
+          f"максимум {max(comparisons)}")
+
+    legacy = time_per_lookup(legacy_resolve, args.rounds)
+    routed = time_per_lookup(callback_router.resolve, args.rounds)
+    print(f"Цепочка if/elif: {legacy * 1e6:.2f}мкс на кнопку")
+    print(f"Таблица маршрутов: {routed * 1e6:.2f}мкс на кнопку ({legacy / routed:.1f}x)")
+
+    # Та же таблица с обработчиками-заглушками: накладные расходы dispatch и счетчики маршрутов
+    router = CallbackRouter()
+    for name, route in callback_router.routes.items():
+        if name.endswith('*'):
+            router.add(noop_handler, prefixes=(name[:-1],), answer=route.answer)
+        else:
+            router.add(noop_handler, (name,), answer=route.answer)
+    per_dispatch = asyncio.run(run_dispatch(router, max(1, args.rounds // 10)))
+    print(f"CallbackRouter.dispatch с заглушками: {per_dispatch * 1e6:.2f}мкс на кнопку")
+    stats = router.get_stats()
+    busiest = sorted(stats.items(), key=lambda item: item[1]['calls'], reverse=True)[:5]
+    print("Счетчики маршрутов: " + ", ".join(f"{name} {item['calls']}" for name, item in busiest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Сравнение хвостовой задержки запросов к vision-модели с хеджированием и без
+
+Поднимает локальную заглушку chat/completions с "тяжелым хвостом" задержек
+(большинство ответов быстрые, небольшая доля - очень медленные), выполняет одинаковую
+нагрузку с выключенным и включенным хеджированием и печатает p50/p99 и долю
+дополнительных запросов.
+
+Использование: python perf/bench_hedging.py [количество_запросов]
+"""
+
+import sys
+import os
+import asyncio
+import random
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+os.environ.setdefault("USER_AI_REQUESTS_PER_MINUTE", "0")
+os.environ.setdefault("OPENAI_VISION_RPM", "100000")
+os.environ.setdefault("OPENAI_VISION_TPM", "100000000")
+
+from aiohttp import web
+
+FAST_LATENCY = 0.05
+SLOW_LATENCY = 1.0
+SLOW_FRACTION = 0.03
+CONCURRENCY = 10
+
+async def start_stub_server(rng: random.Random):
+    """Заглушка OpenAI: в SLOW_FRACTION случаев отвечает в 20 раз медленнее"""
+    async def chat_completions(request: web.Request) -> web.Response:
+        await asyncio.sleep(SLOW_LATENCY if rng.random() < SLOW_FRACTION else FAST_LATENCY)
+        return web.json_response({"choices": [{"message": {"content": "ok"}}]})
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1/"
+
+async def run_scenario(total_requests: int, hedging: bool):
+    """Выполняет total_requests запросов к vision через api_client и возвращает задержки"""
+    from api_client import api_client
+    from resilience import RequestHedger, percentile
+    import resilience
+    import api_client as api_client_module
+
+    hedger = RequestHedger('vision', hedging, resilience.AI_HEDGE_MAX_EXTRA)
+    resilience.vision_hedger = hedger
+    api_client_module.vision_hedger = hedger
+
+    runner, base_url = await start_stub_server(random.Random(42))
+    api_client.base_url = base_url
+    await api_client.start()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+
+    async def one_request(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await api_client._make_request(
+                "POST", f"{base_url}chat/completions", endpoint='vision',
+                json={"model": api_client.vision_model, "messages": [{"role": "user", "content": f"photo {i}"}]}
+            )
+            latencies.append(time.perf_counter() - started)
+
+    try:
+        await asyncio.gather(*(one_request(i) for i in range(total_requests)))
+    finally:
+        await api_client.close()
+        await runner.cleanup()
+
+    stats = hedger.get_stats()
+    print(f"{'С хеджированием' if hedging else 'Без хеджирования'}: "
+          f"p50 {percentile(latencies, 0.5) * 1000:.0f}мс, p99 {percentile(latencies, 0.99) * 1000:.0f}мс, "
+          f"дополнительных запросов {stats['hedge_rate']:.1%} (второй быстрее: {stats['hedge_wins']})")
+    return percentile(latencies, 0.99), stats['hedge_rate']
+
+async def run_benchmark(total_requests: int):
+    from resilience import AI_HEDGE_MAX_EXTRA
+    baseline_p99, _ = await run_scenario(total_requests, hedging=False)
+    hedged_p99, hedge_rate = await run_scenario(total_requests, hedging=True)
+    print(f"Снижение p99: {(1 - hedged_p99 / baseline_p99):.0%}")
+    return hedge_rate <= AI_HEDGE_MAX_EXTRA + 1 / total_requests
+
+def main():
+    total_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ok = asyncio.run(run_benchmark(total_requests))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
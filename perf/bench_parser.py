@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Сравнение однопроходного разбора анализа с прежними функциями извлечения
+
+Для каждого ответа из корпуса (perf/data/analysis_corpus.json) обработчик раньше
+вызывал is_valid_analysis, extract_calories_from_analysis, extract_dish_name_from_analysis,
+extract_macros_from_analysis и remove_explanations_from_analysis - каждая заново разбирала
+текст некомпилированными выражениями. Скрипт сравнивает эту цепочку (копия прежней
+реализации ниже) с parse_analysis: без кэша (каждый текст разбирается заново) и с кэшем,
+а также проверяет, что извлеченные значения совпадают.
+
+Использование: python perf/bench_parser.py [повторов]
+"""
+
+import sys
+import os
+import json
+import re
+import tempfile
+import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "analysis_corpus.json")
+
+
+# ==================== ПРЕЖНЯЯ РЕАЛИЗАЦИЯ ====================
+
+def legacy_is_valid_analysis(analysis_text):
+    return bool(analysis_text and len(analysis_text) > 20 and ('калори' in analysis_text.lower() or 'ккал' in analysis_text.lower()))
+
+
+def legacy_extract_calories(analysis_text):
+    for pattern in (r'Калорийность:\s*(\d+)\s*ккал\s*$', r'Общая калорийность:\s*(\d+)\s*ккал',
+                    r'Калорийность блюда:\s*(\d+)\s*ккал', r'Всего калорий:\s*(\d+)\s*ккал'):
+        match = re.search(pattern, analysis_text, re.IGNORECASE | re.MULTILINE)
+        if match:
+            calories = int(match.group(1))
+            if 0 < calories < 10000:
+                return calories
+    for pattern in (r'калорийность.*?(\d+)\s*ккал', r'(\d+)\s*ккал'):
+        matches = re.findall(pattern, analysis_text, re.IGNORECASE)
+        if matches:
+            calories = int(matches[-1] if isinstance(matches[-1], str) else matches[-1][0])
+            if 0 < calories < 10000:
+                return calories
+    return None
+
+
+def legacy_extract_dish_name(analysis_text):
+    match = re.search(r'Название:\s*(.+?)(?:\n|$)', analysis_text)
+    return match.group(1).strip() if match else None
+
+
+def legacy_extract_macros(analysis_text):
+    calories = legacy_extract_calories(analysis_text) or 0
+    protein = fat = carbs = 0.0
+    general = re.search(r'📈 Общее БЖУ в блюде:(.*?)(?=\n\n|\Z|Обратите внимание)', analysis_text, re.IGNORECASE | re.DOTALL)
+    if general:
+        section = general.group(1)
+        match = re.search(r'• Белки:\s*([\d,]+(?:\.\d+)?)', section)
+        protein = float(match.group(1).replace(',', '.')) if match else 0.0
+        match = re.search(r'• Жиры:\s*([\d,]+(?:\.\d+)?)', section)
+        fat = float(match.group(1).replace(',', '.')) if match else 0.0
+        match = re.search(r'• Углеводы:\s*([\d,]+(?:\.\d+)?)', section)
+        carbs = float(match.group(1).replace(',', '.')) if match else 0.0
+    if protein == 0.0:
+        match = re.search(r'• Белки:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
+        protein = float(match.group(1).replace(',', '.')) if match else 0.0
+    if fat == 0.0:
+        match = re.search(r'• Жиры:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
+        fat = float(match.group(1).replace(',', '.')) if match else 0.0
+    if carbs == 0.0:
+        match = re.search(r'• Углеводы:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
+        carbs = float(match.group(1).replace(',', '.')) if match else 0.0
+    return calories, protein, fat, carbs
+
+
+def legacy_remove_explanations(text):
+    skip_patterns = [r'примечани', r'рекомендац', r'совет', r'обрати внимание', r'важно']
+    return '\n'.join(line for line in text.split('\n')
+                     if not any(re.search(pattern, line.lower()) for pattern in skip_patterns))
+
+
+def legacy_pipeline(text):
+    return (legacy_is_valid_analysis(text), legacy_extract_calories(text), legacy_extract_dish_name(text),
+            legacy_extract_macros(text), legacy_remove_explanations(text))
+
+
+# ==================== ОДНОПРОХОДНЫЙ РАЗБОР ====================
+
+def parser_pipeline(text):
+    from services.analysis_parser import parse_analysis
+    parsed = parse_analysis(text)
+    return parsed.is_valid, parsed.calories, parsed.dish_name, parsed.macros, parsed.text
+
+
+def main():
+    from services.analysis_parser import _parse_cached
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with open(CORPUS_PATH, encoding='utf-8') as corpus_file:
+        corpus = json.load(corpus_file)
+
+    mismatches = 0
+    for text in corpus:
+        legacy, parsed = legacy_pipeline(text), parser_pipeline(text)
+        if legacy != parsed:
+            mismatches += 1
+            print(f"Расхождение для '{text[:40]}...':\n  было: {legacy[:4]}\n  стало: {parsed[:4]}")
+
+    def run_legacy():
+        for text in corpus:
+            legacy_pipeline(text)
+
+    def run_parser_cold():
+        _parse_cached.cache_clear()
+        for text in corpus:
+            parser_pipeline(text)
+
+    def run_parser_warm():
+        for text in corpus:
+            parser_pipeline(text)
+
+    per_response = lambda seconds: seconds / (repeats * len(corpus)) * 1e6
+    legacy_time = per_response(min(timeit.repeat(run_legacy, number=repeats, repeat=3)))
+    cold_time = per_response(min(timeit.repeat(run_parser_cold, number=repeats, repeat=3)))
+    warm_time = per_response(min(timeit.repeat(run_parser_warm, number=repeats, repeat=3)))
+
+    print(f"Корпус: {len(corpus)} ответов, повторов: {repeats}, расхождений: {mismatches}")
+    print(f"Прежние функции (5 вызовов): {legacy_time:.1f} мкс на ответ")
+    print(f"parse_analysis без кэша:     {cold_time:.1f} мкс ({legacy_time / cold_time:.1f}x)")
+    print(f"parse_analysis из кэша:      {warm_time:.1f} мкс ({legacy_time / warm_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Задержка обработки фото: от получения обновления до первой правки с результатом
+
+Поднимает perf/mock_server.py, создает пользователей с подпиской и отправляет через
+handle_universal_analysis сообщения с фото (после выбора приема пищи). По журналу вызовов
+Bot API заглушки для каждого фото измеряется время от начала обработки обновления до
+сообщения "Обрабатываю..." (sendMessage) и до первой правки с результатом анализа
+(editMessageText с кнопками). Задержка Bot API и скачивания файлов задается
+--telegram-latency, время запроса к SQLite - --db-latency (синхронная пауза внутри
+соединения, как у медленного диска). С --album N каждый прием пищи отправляется альбомом из N фото
+(обновления с общим media_group_id приходят почти одновременно) - дополнительно печатается число
+запросов к модели и сообщений об обработке на прием пищи.
+
+Использование: python perf/bench_photo_pipeline.py [--users 10] [--photos 3] [--album 1] [--telegram-latency fixed:0.08]
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockConfig, start_mock_server
+from load_e2e import BOT_TOKEN, USER_ID_BASE, free_port, configure_environment, percentile, SyntheticUpdates
+
+
+def install_db_latency(database_module, delay: float):
+    """Добавляет синхронную паузу к каждому соединению с SQLite"""
+    original = database_module.get_db_connection
+
+    @contextmanager
+    def slow_connection():
+        time.sleep(delay)
+        with original() as conn:
+            yield conn
+
+    database_module.get_db_connection = slow_connection
+
+
+async def run_benchmark(args, port: int):
+    logging.getLogger().setLevel(logging.ERROR)
+    import database
+    if args.db_latency > 0:
+        install_db_latency(database, args.db_latency)
+
+    from telegram.ext import Application, MessageHandler, CallbackQueryHandler, filters
+    import bot_functions as bf
+    from api_client import api_client
+
+    config = MockConfig(openai_latency=args.openai_latency, telegram_latency=args.telegram_latency, seed=1)
+    runner, server, base_url = await start_mock_server(config, port=port)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{base_url}/bot")
+        .base_file_url(f"{base_url}/file/bot")
+        .concurrent_updates(True)
+        .build()
+    )
+    application.add_handler(CallbackQueryHandler(bf.handle_callback_query))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.VOICE | (filters.TEXT & ~filters.COMMAND),
+                                           bf.handle_universal_analysis))
+
+    user_ids = [USER_ID_BASE + i for i in range(args.users)]
+    for user_id in user_ids:
+        database.create_user(user_id, f"Load{user_id}", "male", 30, 180, 80, "moderate", 2500)
+        database.activate_premium_subscription(user_id, 30)
+
+    await application.initialize()
+    await api_client.start()
+    updates = SyntheticUpdates(application.bot)
+    server.bot_events = []
+    # (начало обработки, chat_id) для каждого фото
+    photo_starts = []
+
+    async def user_session(user_id: int):
+        for i in range(args.photos):
+            await application.process_update(updates.callback(user_id, "meal_lunch"))
+            album = {"media_group_id": f"album-{user_id}-{i}"} if args.album > 1 else {}
+            messages = []
+            for j in range(args.album):
+                file_id = f"photo-{user_id}-{i}-{j}"
+                messages.append(updates.message(user_id, photo=[{
+                    "file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 1280, "height": 960,
+                    "file_size": 40000
+                }], **album))
+            started = time.perf_counter()
+            photo_starts.append((started, user_id))
+            # Фото альбома Telegram доставляет отдельными обновлениями почти одновременно
+            await asyncio.gather(*(application.process_update(message) for message in messages))
+            await application.process_update(updates.callback(user_id, "confirm_analysis"))
+
+    try:
+        await asyncio.gather(*(user_session(user_id) for user_id in user_ids))
+    finally:
+        await api_client.close()
+        await application.shutdown()
+        await runner.cleanup()
+
+    events_by_chat = defaultdict(list)
+    for at, method, params in server.bot_events:
+        events_by_chat[int(params.get('chat_id') or 0)].append((at, method, params))
+
+    to_status, to_result = [], []
+    for started, chat_id in photo_starts:
+        events = [event for event in events_by_chat[chat_id] if event[0] >= started]
+        status = next((at for at, method, _ in events if method == 'sendMessage'), None)
+        result = next((at for at, method, params in events
+                       if method == 'editMessageText' and params.get('reply_markup')), None)
+        if status is not None:
+            to_status.append(status - started)
+        if result is not None:
+            to_result.append(result - started)
+
+    meals = len(photo_starts)
+    if args.album > 1:
+        print(f"Альбомы по {args.album} фото: запросов к модели на прием пищи "
+              f"{(server.calls['chat/completions'] + server.calls['chat/completions:stream']) / meals:.1f}, "
+              f"сообщений об обработке {server.calls['bot:sendMessage'] / meals:.1f}, "
+              f"правок сообщений {server.calls['bot:editMessageText'] / meals:.1f}")
+    print(f"Приемов пищи: {meals}, Bot API {args.telegram_latency}, OpenAI {args.openai_latency}, "
+          f"SQLite +{args.db_latency * 1000:.0f}мс на соединение")
+    print(f"До сообщения об обработке: p50 {percentile(to_status, 0.5) * 1000:.0f}мс, "
+          f"p95 {percentile(to_status, 0.95) * 1000:.0f}мс")
+    print(f"До результата: p50 {percentile(to_result, 0.5) * 1000:.0f}мс, "
+          f"p95 {percentile(to_result, 0.95) * 1000:.0f}мс ({len(to_result)} из {len(photo_starts)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка обработки фото до первой правки с результатом")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--photos', type=int, default=3, help='Фото на пользователя (по очереди)')
+    parser.add_argument('--album', type=int, default=1, help='Фото в одном приеме пищи (альбом)')
+    parser.add_argument('--telegram-latency', default='fixed:0.08', help='Задержка Bot API и скачивания файлов')
+    parser.add_argument('--openai-latency', default='fixed:0.8', help='Задержка chat/completions')
+    parser.add_argument('--db-latency', type=float, default=0.005, help='Пауза на соединение с SQLite, с')
+    args = parser.parse_args()
+    port = free_port()
+    configure_environment(port)
+    asyncio.run(run_benchmark(args, port))
+
+
+if __name__ == "__main__":
+    main()
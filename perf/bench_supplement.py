@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Сравнение размера и задержки запроса на дополнение анализа: полный текст против разницы
+
+Раньше дополнение отправлялось как текстовый анализ с полным текстом показанного анализа
+внутри (analyze_text). Теперь уходят только числа показанного результата и уточнение
+(analyze_supplement). Для каждого ответа из корпуса (perf/data/analysis_corpus.json)
+выполняется один раунд дополнения обоими способами через локальную заглушку OpenAI, задержка
+которой растет с числом некэшированных токенов промпта. Печатаются средние токены промпта
+(оценка заглушки) и задержка на раунд.
+
+Использование: python perf/bench_supplement.py [--prompt-token-latency 0.0005] [--openai-latency fixed:0.3]
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+os.environ.setdefault("USER_AI_REQUESTS_PER_MINUTE", "0")
+
+from mock_server import MockConfig, start_mock_server
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "analysis_corpus.json")
+
+CORRECTIONS = [
+    "Большая порция, примерно 400г",
+    "Без масла, домашний рецепт",
+    "2 куска, с добавлением сыра",
+    "Половина порции",
+]
+
+
+def legacy_prompt(analysis_text: str, correction: str) -> str:
+    """Запрос дополнения в прежнем виде: полный текст показанного анализа и уточнение"""
+    return (f"Исходный анализ фото:\n{analysis_text}\n\nДополнительная информация от пользователя:\n{correction}"
+            "\n\nНа основе исходного анализа и дополнительной информации, предоставь уточненный расчет калорий и БЖУ.")
+
+
+async def run_round(name: str, template, requests):
+    """Выполняет запросы по очереди; возвращает (средние токены промпта, средняя задержка)"""
+    requests_before, tokens_before = template.requests, template.prompt_tokens
+    latencies = []
+    for request in requests:
+        started = time.perf_counter()
+        result = await request()
+        latencies.append(time.perf_counter() - started)
+        if not result:
+            print(f"{name}: пустой ответ")
+    count = template.requests - requests_before
+    avg_tokens = (template.prompt_tokens - tokens_before) / count if count else 0.0
+    avg_latency = sum(latencies) / len(latencies)
+    print(f"{name}: {avg_tokens:.0f} токенов промпта, задержка {avg_latency * 1000:.0f}мс на раунд")
+    return avg_tokens, avg_latency
+
+
+async def run_benchmark(args):
+    from api_client import api_client
+    from config import ANALYSIS_OUTPUT_FORMAT
+    from prompts import prompt_registry
+    from services.pending_analysis import PendingAnalysis
+
+    with open(CORPUS_PATH, encoding='utf-8') as corpus_file:
+        corpus = json.load(corpus_file)
+    pending = [PendingAnalysis.from_analysis(text, 'photo', 'Блюдо по фото') for text in corpus]
+    corrections = [CORRECTIONS[i % len(CORRECTIONS)] for i in range(len(corpus))]
+
+    runner, _, base_url = await start_mock_server(MockConfig(
+        openai_latency=args.openai_latency, prompt_token_latency=args.prompt_token_latency
+    ))
+    api_client.base_url = f"{base_url}/v1/"
+    await api_client.start()
+    try:
+        legacy_tokens, legacy_latency = await run_round(
+            "Полный текст анализа", prompt_registry.analysis('text', ANALYSIS_OUTPUT_FORMAT),
+            [lambda item=item, correction=correction: api_client.analyze_text(legacy_prompt(item.analysis_text, correction))
+             for item, correction in zip(pending, corrections)]
+        )
+        delta_tokens, delta_latency = await run_round(
+            "Только числа и уточнение", prompt_registry.analysis('supplement', ANALYSIS_OUTPUT_FORMAT),
+            [lambda item=item, correction=correction: api_client.analyze_supplement(item.to_prompt(), correction)
+             for item, correction in zip(pending, corrections)]
+        )
+    finally:
+        await api_client.close()
+        await runner.cleanup()
+
+    print(f"Формат ответа: {ANALYSIS_OUTPUT_FORMAT}, ответов в корпусе: {len(corpus)}")
+    print(f"Экономия на раунд: {legacy_tokens - delta_tokens:.0f} токенов промпта "
+          f"({1 - delta_tokens / legacy_tokens:.0%}), {(legacy_latency - delta_latency) * 1000:.0f}мс задержки")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Токены и задержка запроса на дополнение анализа")
+    parser.add_argument('--openai-latency', default='fixed:0.3', help='Базовая задержка chat/completions')
+    parser.add_argument('--prompt-token-latency', type=float, default=0.0005,
+                        help='Задержка на некэшированный токен промпта, с')
+    asyncio.run(run_benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Сравнение стратегий распознавания речи: по очереди, гонка сервисов и запуск резерва по порогу
+
+Поднимает локальную заглушку Whisper и AssemblyAI. У Whisper "тяжелый хвост" задержек
+(большинство ответов быстрые, часть - очень медленные), AssemblyAI отвечает стабильно,
+но медленнее типичного Whisper. Одинаковая нагрузка выполняется со стратегиями sequential,
+race и hedge; печатаются p50/p95 итоговой задержки, задержка и доля побед каждого сервиса
+и число запросов к резервному сервису.
+
+Использование: python perf/bench_transcription.py [количество_сообщений]
+"""
+
+import sys
+import os
+import asyncio
+import random
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("ASSEMBLYAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+os.environ.setdefault("OPENAI_WHISPER_RPM", "100000")
+
+from mock_server import MockConfig, start_mock_server
+
+CONCURRENCY = 5
+HEDGE_DELAY = 2.0
+
+
+class HeavyTailLatency:
+    """Задержка Whisper: в slow_fraction случаев медленный ответ"""
+
+    def __init__(self, fast: float = 0.8, slow: float = 6.0, slow_fraction: float = 0.1):
+        self.fast, self.slow, self.slow_fraction = fast, slow, slow_fraction
+
+    def sample(self, rng: random.Random) -> float:
+        return self.slow if rng.random() < self.slow_fraction else rng.uniform(0.6, 1.0) * self.fast
+
+
+async def run_scenario(strategy: str, total: int):
+    import voice_handler as voice_module
+    from api_client import api_client
+    from resilience import circuit_breakers, percentile
+
+    config = MockConfig(assemblyai_latency="uniform:1.5,2.5", seed=42)
+    config.whisper_latency = HeavyTailLatency()
+    runner, server, base_url = await start_mock_server(config)
+    handler = voice_module.voice_handler
+    handler.openai_base_url = f"{base_url}/v1"
+    handler.assemblyai_base_url = f"{base_url}/v2"
+    orchestrator = voice_module.TranscriptionOrchestrator(strategy, HEDGE_DELAY)
+    voice_module.transcription_orchestrator = orchestrator
+    circuit_breakers.reset_all()
+
+    await api_client.start()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+
+    async def one_message(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            text = await handler._transcribe_audio(b'OggS' + random.Random(i).randbytes(4000))
+            latencies.append(time.perf_counter() - started)
+            if not text or text == "VOICE_TRANSCRIPTION_UNAVAILABLE":
+                print(f"{strategy}: сообщение {i} не распознано")
+
+    try:
+        await asyncio.gather(*(one_message(i) for i in range(total)))
+    finally:
+        await api_client.close()
+        await runner.cleanup()
+
+    stats = orchestrator.get_stats()
+    print(f"{strategy}: p50 {percentile(latencies, 0.5):.2f}с, p95 {percentile(latencies, 0.95):.2f}с, "
+          f"запросов к AssemblyAI: {server.calls['assemblyai:transcript']}, опросов статуса: {server.calls['assemblyai:poll']}")
+    for name, provider in stats['providers'].items():
+        print(f"  {name}: запусков {provider['requests']}, побед {provider['wins']} ({provider['win_rate']:.0%}), "
+              f"отменено {provider['cancelled']}, p50 {provider['p50']:.2f}с, p95 {provider['p95']:.2f}с")
+
+
+async def run_benchmark(total: int):
+    for strategy in ('sequential', 'hedge', 'race'):
+        await run_scenario(strategy, total)
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    asyncio.run(run_benchmark(total))
+
+
+if __name__ == "__main__":
+    main()
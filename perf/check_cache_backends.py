@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Проверка общих (L2) бэкендов кэша на двух репликах
+
+Две реплики TwoTierCache работают через один бэкенд: Redis-заглушку perf/mock_redis.py
+(AUTH, SELECT, GET, SET с EX, DEL, PUBLISH/SUBSCRIBE) и SQLite-файл. Проверяется:
+- запись одной реплики читается другой из L2;
+- перезапись и удаление рассылают инвалидацию - другая реплика не отдает старое значение из L1;
+- запись истекает по TTL;
+- для Redis - переподключение команд и подписки после обрыва соединений и отмена GET
+  посреди обмена: следующий GET должен вернуть значение своего ключа, а не ответ отмененного.
+
+Использование: python perf/check_cache_backends.py [--backend redis|sqlite|all]
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+
+from cache_backends import RedisCacheBackend, SQLiteCacheBackend  # noqa: E402
+from cache_manager import CacheManager, TwoTierCache  # noqa: E402
+from mock_redis import start_mock_redis  # noqa: E402
+
+
+async def wait_for(condition, timeout: float) -> bool:
+    """Ждет, пока condition() станет истинным (инвалидации доходят асинхронно)"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if await condition():
+            return True
+        await asyncio.sleep(0.02)
+    return await condition()
+
+
+async def flush(*caches: TwoTierCache):
+    """Дожидается фоновых записей в L2"""
+    for cache in caches:
+        if cache._pending:
+            await asyncio.gather(*cache._pending)
+
+
+async def check_replicas(name: str, backend_a, backend_b, propagation: float, expect) -> bool:
+    """Общий сценарий: чтение из L2, инвалидация перезаписи и удаления, истечение TTL"""
+    await backend_a.start()
+    await backend_b.start()
+    replica_a = TwoTierCache('transcription', CacheManager(default_ttl=60), backend_a)
+    replica_b = TwoTierCache('transcription', CacheManager(default_ttl=60), backend_b)
+    try:
+        replica_a.set('voice:1', 'первая расшифровка')
+        await flush(replica_a)
+        expect(f"{name}: чтение записи другой реплики из L2",
+               await replica_b.aget('voice:1') == 'первая расшифровка' and replica_b.l2_hits == 1)
+
+        # У реплики B значение уже в L1: без инвалидации она отдавала бы его до истечения TTL
+        replica_a.set('voice:1', 'исправленная расшифровка')
+        await flush(replica_a)
+        expect(f"{name}: инвалидация при перезаписи",
+               await wait_for(lambda: _equals(replica_b.aget('voice:1'), 'исправленная расшифровка'), propagation))
+        expect(f"{name}: своя перезапись не сбрасывает L1",
+               replica_a.get('voice:1') == 'исправленная расшифровка')
+
+        replica_a.delete('voice:1')
+        await flush(replica_a)
+        expect(f"{name}: инвалидация при удалении",
+               await wait_for(lambda: _equals(replica_b.aget('voice:1'), None), propagation))
+
+        replica_a.set('voice:2', 'короткая запись', ttl=1)
+        await flush(replica_a)
+        expect(f"{name}: запись с TTL читается до истечения", await backend_b.get('transcription:voice:2') is not None)
+        await asyncio.sleep(1.2)
+        expect(f"{name}: запись истекает по TTL", await backend_b.get('transcription:voice:2') is None)
+    finally:
+        await backend_a.close()
+        await backend_b.close()
+    return True
+
+
+async def _equals(awaitable, expected) -> bool:
+    return await awaitable == expected
+
+
+async def check_redis(expect):
+    server, state, url = await start_mock_redis(password='secret')
+    # Непустая база проверяет SELECT, пароль - AUTH
+    url = url[:-1] + '2'
+    try:
+        await check_replicas('redis', RedisCacheBackend(url), RedisCacheBackend(url), 1.0, expect)
+        expect("redis: каждая запись и удаление публикуют инвалидацию",
+               state.commands['PUBLISH'] == state.commands['SET'] + state.commands['DEL'])
+        expect("redis: данные лежат в базе SELECT", set(state.databases) <= {2})
+
+        # Обрыв соединений: команды переподключаются сразу, подписка - с задержкой
+        backend_a, backend_b = RedisCacheBackend(url), RedisCacheBackend(url)
+        await backend_a.start()
+        await backend_b.start()
+        replica_a = TwoTierCache('transcription', CacheManager(default_ttl=60), backend_a)
+        replica_b = TwoTierCache('transcription', CacheManager(default_ttl=60), backend_b)
+        try:
+            replica_a.set('voice:3', 'до обрыва')
+            await flush(replica_a)
+            await replica_b.aget('voice:3')
+            state.drop_connections()
+            await asyncio.sleep(1.5)
+            replica_a.set('voice:3', 'после обрыва')
+            await flush(replica_a)
+            expect("redis: переподключение после обрыва",
+                   await wait_for(lambda: _equals(replica_b.aget('voice:3'), 'после обрыва'), 3.0))
+        finally:
+            await backend_a.close()
+            await backend_b.close()
+
+        # Отмена GET до получения ответа (как PhotoPrefetch.cancel()): непрочитанный ответ
+        # не должен достаться следующей команде на том же соединении
+        backend = RedisCacheBackend(url)
+        try:
+            await backend.set('analysis:a', 'анализ A', 60)
+            await backend.set('analysis:b', 'анализ B', 60)
+            state.get_delay = 0.2
+            cancelled = asyncio.create_task(backend.get('analysis:a'))
+            await asyncio.sleep(0.05)
+            cancelled.cancel()
+            await asyncio.gather(cancelled, return_exceptions=True)
+            state.get_delay = 0.0
+            entry = await backend.get('analysis:b')
+            expect("redis: после отмены GET следующий GET возвращает свой ключ",
+                   entry is not None and entry[0] == 'анализ B')
+        finally:
+            state.get_delay = 0.0
+            await backend.close()
+        print("Команды Redis: " + ", ".join(f"{name} {count}" for name, count in sorted(state.commands.items())))
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+async def check_sqlite(expect):
+    path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    await check_replicas('sqlite', SQLiteCacheBackend(path, poll_interval=0.1),
+                         SQLiteCacheBackend(path, poll_interval=0.1), 1.0, expect)
+
+
+async def run(backends) -> bool:
+    failures = []
+
+    def expect(title: str, ok: bool):
+        print(f"{'✅' if ok else '❌'} {title}")
+        if not ok:
+            failures.append(title)
+
+    if 'redis' in backends:
+        await check_redis(expect)
+    if 'sqlite' in backends:
+        await check_sqlite(expect)
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка общих бэкендов кэша")
+    parser.add_argument('--backend', choices=['redis', 'sqlite', 'all'], default='all')
+    args = parser.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.ERROR)
+    backends = ('redis', 'sqlite') if args.backend == 'all' else (args.backend,)
+    ok = asyncio.run(run(backends))
+    print("✅ Проверка пройдена" if ok else "❌ Проверка не пройдена")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
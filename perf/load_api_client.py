@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка общей HTTP-сессии APIClient
+
+Поднимает локальную заглушку chat/completions, запускает много параллельных
+анализов текста (как при concurrent_updates) и проверяет, что:
+- соединения переиспользуются (число TCP-соединений не превышает limit_per_host);
+- ни один запрос не упал из-за закрытия сессии другим запросом.
+
+Использование: python perf/load_api_client.py [количество_запросов]
+"""
+
+import sys
+import os
+import asyncio
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py требует ключи - для локальной проверки подойдут заглушки
+os.environ.setdefault("BOT_TOKEN", "load-test")
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_test.db"))
+
+from aiohttp import web
+
+STUB_ANALYSIS = (
+    "🍽️ Анализ блюда:\n\n"
+    "Название: Гречка\n"
+    "Вес: 200г\n"
+    "Калорийность: 220 ккал\n\n"
+    "📊 БЖУ на 100г:\n• Белки: 4.2г\n• Жиры: 1.1г\n• Углеводы: 21.3г\n\n"
+    "📈 Общее БЖУ в блюде:\n• Белки: 8.4г\n• Жиры: 2.2г\n• Углеводы: 42.6г"
+)
+
+async def start_stub_server(connections: set, latency: float):
+    """Заглушка OpenAI: отвечает с задержкой и запоминает клиентские соединения"""
+    async def chat_completions(request: web.Request) -> web.Response:
+        connections.add(request.transport.get_extra_info('peername'))
+        await asyncio.sleep(latency)
+        return web.json_response({"choices": [{"message": {"content": STUB_ANALYSIS}}]})
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1/"
+
+async def run_load_test(total_requests: int, latency: float = 0.05):
+    """Запускает параллельные запросы через общий api_client и печатает итоги"""
+    from api_client import api_client
+    from services.food_analysis_service import analyze_food_text
+    from performance_optimizations import ai_admission
+
+    connections = set()
+    runner, base_url = await start_stub_server(connections, latency)
+    api_client.base_url = base_url
+    # Проверяем переиспользование соединений, а не отказы очереди: вся нагрузка должна дождаться слота
+    ai_admission.max_queue_depth = total_requests
+
+    await api_client.start()
+    limit = api_client.session.connector.limit_per_host
+    try:
+        # Разные описания, чтобы обойти кэши и дойти до HTTP
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(analyze_food_text(f"тестовое блюдо номер {i} без веса") for i in range(total_requests)),
+            return_exceptions=True
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        await api_client.close()
+        await runner.cleanup()
+
+    failed = [r for r in results if not isinstance(r, str)]
+    print(f"Запросов: {total_requests}, успешно: {total_requests - len(failed)}, ошибок: {len(failed)}")
+    print(f"TCP-соединений к серверу: {len(connections)} (limit_per_host={limit})")
+    print(f"Время: {elapsed:.2f}с, {total_requests / elapsed:.0f} запросов/с")
+
+    ok = not failed and len(connections) <= limit
+    print("✅ Соединения переиспользуются, сессия не закрывается между запросами" if ok else "❌ Проверка не пройдена")
+    return ok
+
+def main():
+    total_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ok = asyncio.run(run_load_test(total_requests))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
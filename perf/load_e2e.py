@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Сквозная нагрузочная проверка бота без реальных OpenAI и Telegram
+
+Поднимает perf/mock_server.py, направляет в него APIClient, VoiceHandler и Bot API,
+создает N пользователей с подпиской и прогоняет через обработчики бота синтетические
+Update: выбор приема пищи -> фото / текст / голос (handle_universal_analysis) ->
+подтверждение анализа (confirm_analysis / confirm_text_analysis). Все пользователи
+работают параллельно, как при concurrent_updates. На каждое нажатие кнопки бот должен
+отвечать одним answerCallbackQuery.
+
+Отчет: пропускная способность, p50/p95/p99 по сценариям, ошибки, работа с SQLite
+(число и время соединений, блокировки) и задержка event loop - синхронные вызовы БД
+внутри обработчиков останавливают обработку всех остальных обновлений.
+
+Использование: python perf/load_e2e.py --users 50 --iterations 4 --mix text=0.5,photo=0.4,voice=0.1
+Код выхода 1, если доля ошибок больше --max-error-rate (для CI).
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockConfig, start_mock_server, add_mock_arguments, config_from_args
+
+BOT_TOKEN = "123456:load-test"
+USER_ID_BASE = 7_000_000
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def configure_environment(port: int):
+    """config.py читает окружение при импорте - настраиваем его до импорта модулей бота"""
+    os.environ["BOT_TOKEN"] = BOT_TOKEN
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+    os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "load_e2e.db"))
+    os.environ["BASE_URL"] = f"http://127.0.0.1:{port}/v1/"
+    # Нагрузка одного пользователя выше реальной - снимаем пользовательские лимиты
+    os.environ.setdefault("USER_AI_REQUESTS_PER_MINUTE", "0")
+    os.environ.setdefault("AI_MAX_QUEUE_DEPTH", "100000")
+
+def percentile(samples, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(fraction * len(ordered) + 0.999999) - 1))]
+
+class DatabaseProbe:
+    """Считает соединения с SQLite, время их удержания и ошибки блокировки"""
+
+    def __init__(self):
+        self.hold_times = []
+        self.locked_errors = 0
+
+    def install(self, database_module):
+        original = database_module.get_db_connection
+
+        @contextmanager
+        def timed_connection():
+            started = time.perf_counter()
+            try:
+                with original() as conn:
+                    yield conn
+            except sqlite3.OperationalError as e:
+                if 'locked' in str(e):
+                    self.locked_errors += 1
+                raise
+            finally:
+                self.hold_times.append(time.perf_counter() - started)
+
+        database_module.get_db_connection = timed_connection
+
+class ErrorLogProbe(logging.Handler):
+    """Считает ошибки, которые обработчики бота перехватили и только записали в лог"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.messages = defaultdict(int)
+
+    def emit(self, record: logging.LogRecord):
+        # Сообщения самой заглушки (aiohttp.server) к боту не относятся
+        if record.name.startswith('aiohttp'):
+            return
+        self.messages[record.getMessage()[:120]] += 1
+
+class LoopLagProbe:
+    """Измеряет, насколько event loop опаздывает с пробуждением таймера"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - started - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+class SyntheticUpdates:
+    """Генератор Update в формате Bot API"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+        self.message_id = 0
+        self.callbacks = 0
+
+    def _base(self, user_id: int):
+        self.update_id += 1
+        self.message_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "language_code": "ru"}
+        message = {"message_id": self.message_id, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": user}
+        return user, message
+
+    def message(self, user_id: int, **content):
+        from telegram import Update
+        _, message = self._base(user_id)
+        message.update(content)
+        return Update.de_json({"update_id": self.update_id, "message": message}, self.bot)
+
+    def callback(self, user_id: int, data: str):
+        from telegram import Update
+        user, message = self._base(user_id)
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "MockBot"}
+        message["text"] = "..."
+        self.callbacks += 1
+        return Update.de_json({"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id), "from": user, "chat_instance": str(user_id), "data": data, "message": message
+        }}, self.bot)
+
+def parse_mix(value: str):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'text', 'photo', 'voice'}
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return mix
+
+async def run_load_test(args, mock_config: MockConfig, port: int) -> bool:
+    # Обработчики бота перехватывают исключения - ошибки видны только в логе
+    logging.getLogger().setLevel(logging.WARNING if args.verbose else logging.ERROR)
+    error_log = ErrorLogProbe()
+    logging.getLogger().addHandler(error_log)
+
+    import database
+    probe = DatabaseProbe()
+    probe.install(database)
+
+    from telegram.ext import Application, MessageHandler, CallbackQueryHandler, filters
+    import bot_functions as bf
+    from api_client import api_client
+    from voice_handler import voice_handler
+    from performance_optimizations import ai_admission
+
+    runner, server, base_url = await start_mock_server(mock_config, port=port)
+    voice_handler.openai_base_url = f"{base_url}/v1"
+    voice_handler.assemblyai_base_url = f"{base_url}/v2"
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{base_url}/bot")
+        .base_file_url(f"{base_url}/file/bot")
+        .concurrent_updates(True)
+        .build()
+    )
+    application.add_handler(CallbackQueryHandler(bf.handle_callback_query))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.VOICE | (filters.TEXT & ~filters.COMMAND),
+                                           bf.handle_universal_analysis))
+
+    user_ids = [USER_ID_BASE + i for i in range(args.users)]
+    for user_id in user_ids:
+        database.create_user(user_id, f"Load{user_id}", "male", 30, 180, 80, "moderate", 2500)
+        database.activate_premium_subscription(user_id, 30)
+    meals_before = database.get_meals_count()
+
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    confirmations = 0
+
+    await application.initialize()
+    await api_client.start()
+    updates = SyntheticUpdates(application.bot)
+    loop_probe = LoopLagProbe()
+    loop_probe.start()
+
+    async def process(update) -> bool:
+        try:
+            await application.process_update(update)
+            return True
+        except Exception as e:
+            errors['exception'] += 1
+            print(f"Ошибка обработки: {type(e).__name__}: {e}")
+            return False
+
+    async def user_session(user_id: int):
+        nonlocal confirmations
+        for iteration in range(args.iterations):
+            scenario = rng.choices(list(mix), weights=list(mix.values()))[0]
+            await process(updates.callback(user_id, "meal_lunch"))
+            if scenario == 'text':
+                # Уникальные описания - чтобы запросы доходили до ИИ, а не до кэшей
+                message = updates.message(user_id, text=f"гречка с курицей, порция {user_id}-{iteration}")
+                confirm = "confirm_text_analysis"
+            elif scenario == 'photo':
+                file_id = f"photo-{user_id}-{iteration}"
+                message = updates.message(user_id, photo=[{
+                    "file_id": file_id, "file_unique_id": f"u-{file_id}", "width": 1280, "height": 960,
+                    "file_size": 40000
+                }])
+                confirm = "confirm_analysis"
+            else:
+                file_id = f"voice-{user_id}-{iteration}"
+                message = updates.message(user_id, voice={
+                    "file_id": file_id, "file_unique_id": f"u-{file_id}", "duration": 3,
+                    "mime_type": "audio/ogg", "file_size": 16000
+                })
+                confirm = "confirm_text_analysis"
+
+            started = time.perf_counter()
+            ok = await process(message)
+            if ok and confirm:
+                ok = await process(updates.callback(user_id, confirm))
+                confirmations += ok
+            latencies[scenario].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(user_session(user_id) for user_id in user_ids))
+    finally:
+        elapsed = time.perf_counter() - started
+        await loop_probe.stop()
+        await api_client.close()
+        await application.shutdown()
+        await runner.cleanup()
+
+    meals_saved = database.get_meals_count() - meals_before
+    missing = max(0, confirmations - meals_saved)
+    errors['meal_not_saved'] += missing
+    errors['logged_error'] += sum(error_log.messages.values())
+    errors = {name: count for name, count in errors.items() if count}
+    total = sum(len(values) for values in latencies.values())
+    error_count = sum(errors.values())
+
+    print(f"\nПользователей: {args.users}, сценариев: {total}, время: {elapsed:.2f}с, "
+          f"{total / elapsed:.1f} сценариев/с")
+    for scenario, values in sorted(latencies.items()):
+        print(f"• {scenario}: {len(values)} шт, p50 {percentile(values, 0.5):.2f}с, "
+              f"p95 {percentile(values, 0.95):.2f}с, p99 {percentile(values, 0.99):.2f}с")
+    print(f"Сохранено приемов пищи: {meals_saved} (подтверждений анализа: {confirmations})")
+    print(f"Ошибки: {errors if error_count else 'нет'}")
+    for message, count in sorted(error_log.messages.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {count} x {message}")
+
+    hold = probe.hold_times
+    print(f"\nSQLite: {len(hold)} соединений, удержание p50 {percentile(hold, 0.5) * 1000:.1f}мс, "
+          f"p95 {percentile(hold, 0.95) * 1000:.1f}мс, макс {max(hold, default=0) * 1000:.1f}мс, "
+          f"суммарно {sum(hold):.2f}с ({sum(hold) / elapsed:.0%} времени прогона), "
+          f"ошибок блокировки: {probe.locked_errors}")
+    lags = loop_probe.lags
+    print(f"Задержка event loop: p50 {percentile(lags, 0.5) * 1000:.1f}мс, p99 {percentile(lags, 0.99) * 1000:.1f}мс, "
+          f"макс {max(lags, default=0) * 1000:.1f}мс")
+
+    for model, stats in ai_admission.get_stats().items():
+        print(f"Очередь {model}: ожидание среднее {stats['avg_wait']:.2f}с, p95 {stats['p95_wait']:.2f}с, "
+              f"отклонено {stats['rejected']}")
+    mock_stats = server.get_stats()
+    print(f"\nЗаглушка: {mock_stats['calls']}")
+    if mock_stats['injected_errors']:
+        print(f"Внесенные ошибки: {mock_stats['injected_errors']}")
+
+    # На каждое нажатие кнопки - ровно один answerCallbackQuery (отвечает router)
+    answers = mock_stats['calls'].get('bot:answerCallbackQuery', 0)
+    if answers != updates.callbacks:
+        print(f"❌ answerCallbackQuery: {answers} на {updates.callbacks} нажатий кнопок")
+
+    error_rate = error_count / total if total else 1.0
+    ok = error_rate <= args.max_error_rate and answers == updates.callbacks
+    if error_rate > args.max_error_rate:
+        print(f"❌ Доля ошибок {error_rate:.1%} больше {args.max_error_rate:.1%}")
+    print("✅ Проверка пройдена" if ok else "❌ Проверка не пройдена")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозная нагрузочная проверка бота на заглушках")
+    parser.add_argument('--users', type=int, default=20, help='Число одновременных пользователей')
+    parser.add_argument('--iterations', type=int, default=3, help='Сценариев на пользователя')
+    parser.add_argument('--mix', default='text=0.5,photo=0.4,voice=0.1', help='Доли сценариев')
+    parser.add_argument('--max-error-rate', type=float, default=0.0, help='Допустимая доля ошибок')
+    parser.add_argument('--verbose', action='store_true', help='Показывать предупреждения бота')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    port = free_port()
+    configure_environment(port)
+    ok = asyncio.run(run_load_test(args, config_from_args(args), port))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
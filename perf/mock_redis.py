@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка Redis для проверки RedisCacheBackend
+
+Понимает протокол RESP и подмножество команд, которым пользуется cache_backends.py:
+AUTH, SELECT, PING, GET, SET (с EX/PX), DEL, PUBLISH, SUBSCRIBE. Команды одного пакета
+(pipelining) обрабатываются по порядку. Ключи хранятся отдельно для каждой базы SELECT,
+истечение проверяется при чтении. Счетчик commands показывает, сколько команд пришло,
+get_delay задерживает ответ на GET (проверка отмены посреди обмена).
+
+Использование как отдельного сервера:
+    python perf/mock_redis.py --port 6380 [--password secret]
+Затем REDIS_URL=redis://:secret@127.0.0.1:6380/0 для бота. Из кода - start_mock_redis().
+"""
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+def encode_reply(value: Any) -> bytes:
+    """Ответ в формате RESP: str - простая строка, Exception - ошибка, bytes/None - bulk string"""
+    if isinstance(value, Exception):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, list):
+        return f"*{len(value)}\r\n".encode() + b''.join(encode_reply(item) for item in value)
+    return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    """Читает одну команду (массив bulk strings); None - клиент закрыл соединение"""
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline-команда (например, redis-cli PING)
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        header = await reader.readline()
+        length = int(header[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class MockRedis:
+    """Состояние заглушки: ключи по базам, подписчики каналов и счетчик команд"""
+
+    def __init__(self, password: Optional[str] = None):
+        self.password = password
+        self.databases: Dict[int, Dict[bytes, Tuple[bytes, Optional[float]]]] = {}
+        self.subscribers: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.commands: Counter = Counter()
+        self.connections: Set[asyncio.StreamWriter] = set()
+        self.get_delay = 0.0
+
+    def _lookup(self, db: int, key: bytes) -> Optional[bytes]:
+        entry = self.databases.get(db, {}).get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.databases[db][key]
+            return None
+        return value
+
+    def _set(self, db: int, args: List[bytes]) -> Any:
+        key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+        expires_at = None
+        for index, option in enumerate(options):
+            if option in (b'EX', b'PX'):
+                amount = int(args[2 + index + 1])
+                if amount <= 0:
+                    return ValueError("ERR invalid expire time in 'set' command")
+                expires_at = time.monotonic() + (amount if option == b'EX' else amount / 1000)
+        self.databases.setdefault(db, {})[key] = (value, expires_at)
+        return "OK"
+
+    def _publish(self, channel: bytes, message: bytes) -> int:
+        receivers = [writer for writer in self.subscribers.get(channel, ()) if not writer.is_closing()]
+        for writer in receivers:
+            writer.write(encode_reply([b'message', channel, message]))
+        return len(receivers)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        db = 0
+        authenticated = self.password is None
+        self.connections.add(writer)
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].upper().decode()
+                self.commands[name] += 1
+                if name == 'AUTH':
+                    authenticated = args[-1].decode() == self.password
+                    reply = "OK" if authenticated else ValueError("WRONGPASS invalid password")
+                elif not authenticated:
+                    reply = ValueError("NOAUTH Authentication required.")
+                elif name == 'PING':
+                    reply = "PONG"
+                elif name == 'SELECT':
+                    db = int(args[1])
+                    reply = "OK"
+                elif name == 'GET':
+                    if self.get_delay:
+                        await asyncio.sleep(self.get_delay)
+                    reply = self._lookup(db, args[1])
+                elif name == 'SET':
+                    reply = self._set(db, args[1:])
+                elif name == 'DEL':
+                    reply = sum(1 for key in args[1:] if self.databases.get(db, {}).pop(key, None) is not None)
+                elif name == 'PUBLISH':
+                    reply = self._publish(args[1], args[2])
+                elif name == 'SUBSCRIBE':
+                    for count, channel in enumerate(args[1:], start=1):
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(encode_reply([b'subscribe', channel, count]))
+                    await writer.drain()
+                    continue
+                else:
+                    reply = ValueError(f"ERR unknown command '{name}'")
+                writer.write(encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError - остановка event loop при открытых клиентских соединениях
+            pass
+        finally:
+            for writers in self.subscribers.values():
+                writers.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+
+    def drop_connections(self):
+        """Рвет все клиентские соединения (проверка переподключения)"""
+        for writer in list(self.connections):
+            writer.close()
+
+
+async def start_mock_redis(password: Optional[str] = None, host: str = '127.0.0.1', port: int = 0):
+    """Запускает заглушку в текущем event loop; возвращает (asyncio-сервер, состояние, REDIS_URL)"""
+    state = MockRedis(password)
+    server = await asyncio.start_server(state.handle_client, host, port)
+    port = server.sockets[0].getsockname()[1]
+    auth = f":{password}@" if password else ""
+    return server, state, f"redis://{auth}{host}:{port}/0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Redis (RESP)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    parser.add_argument('--password', default=None)
+    args = parser.parse_args()
+
+    async def serve():
+        server, _, url = await start_mock_redis(args.password, args.host, args.port)
+        print(f"Mock Redis: {url}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
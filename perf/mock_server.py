@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка OpenAI и Telegram Bot API для нагрузочных проверок
+
+Имитирует:
+- POST /v1/chat/completions - обычный, structured (response_format) и потоковый (stream) ответ;
+- POST /v1/audio/transcriptions - распознавание речи;
+- POST /v2/upload, POST /v2/transcript, GET /v2/transcript/<id> - AssemblyAI (результат готов
+  через задержку распознавания, до этого статус processing);
+- /bot<token>/<method> - методы Bot API (getMe, getFile, sendMessage, editMessageText, ...);
+- GET /file/bot<token>/<path> - скачивание файлов (фото генерируется по пути, голос - случайные байты).
+
+Задержки задаются распределениями (fixed:0.05, uniform:0.05,0.3, lognormal:0.8,0.5 - медиана
+и sigma), ошибки - долей ответов 500 и 429 (с Retry-After) отдельно для OpenAI и Telegram.
+Токены промпта оцениваются по длине сообщений и возвращаются в usage; при заданной цене
+токена (--prompt-token-latency) задержка chat/completions растет с некэшированной частью промпта.
+
+Использование как отдельного сервера:
+    python perf/mock_server.py --port 8081 --openai-latency lognormal:0.8,0.5 --openai-error-rate 0.02
+Затем BASE_URL=http://127.0.0.1:8081/v1/ для бота. Из кода - start_mock_server(MockConfig(...)).
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import math
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# Pillow необязателен: без него отдается минимальный JPEG без изображения
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+STUB_ANALYSIS = {
+    "dish_name": "Гречка с курицей",
+    "weight_g": 250,
+    "calories_total": 400,
+    "calories_per_100g": 160,
+    "protein_per_100g": 12.5,
+    "fat_per_100g": 4.0,
+    "carbs_per_100g": 18.5,
+}
+
+STUB_ANALYSIS_TEXT = (
+    "🍽️ Анализ блюда:\n\n"
+    "Название: Гречка с курицей\n"
+    "Вес: 250г\n"
+    "Калорийность: 400 ккал\n\n"
+    "📊 БЖУ на 100г:\n• Белки: 12,5г\n• Жиры: 4г\n• Углеводы: 18,5г\n\n"
+    "📈 Общее БЖУ в блюде:\n• Белки: 31,3г\n• Жиры: 10г\n• Углеводы: 46,3г"
+)
+
+STUB_TRANSCRIPTION = "гречка с курицей двести пятьдесят грамм"
+
+# Оценка токенизатора: около 4 байт UTF-8 на токен (2 символа кириллицы, 4 латиницы)
+BYTES_PER_TOKEN = 4
+IMAGE_TOKENS = 255
+# Провайдер кэширует префикс промпта блоками по 128 токенов, начиная с 1024
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK = 128
+
+# Минимальный корректный заголовок JPEG - для валидации по сигнатуре этого достаточно
+FALLBACK_JPEG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00' + b'\x00' * 512 + b'\xff\xd9'
+
+
+class LatencyModel:
+    """Распределение задержки ответа: fixed:S, uniform:MIN,MAX или lognormal:MEDIAN,SIGMA (секунды)"""
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, params = spec.partition(':')
+        self.kind = kind
+        self.params = [float(value) for value in params.split(',') if value]
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.spec = spec
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == 'fixed':
+            return self.params[0] if self.params else 0.0
+        if self.kind == 'uniform':
+            return rng.uniform(self.params[0], self.params[1])
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text.encode('utf-8')) / BYTES_PER_TOKEN)
+
+
+def estimate_prompt_usage(payload: Dict[str, Any]) -> Dict[str, int]:
+    """Оценка токенов промпта; кэшированной считается часть системного сообщения"""
+    prompt_tokens = system_tokens = 0
+    for message in payload.get('messages', []):
+        content = message.get('content', '')
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        tokens = sum(estimate_tokens(part.get('text', '')) if part.get('type') == 'text' else IMAGE_TOKENS
+                     for part in parts)
+        prompt_tokens += tokens
+        if message.get('role') == 'system':
+            system_tokens += tokens
+    cached_tokens = 0
+    if prompt_tokens >= PROMPT_CACHE_MIN_TOKENS:
+        cached_tokens = system_tokens // PROMPT_CACHE_BLOCK * PROMPT_CACHE_BLOCK
+    return {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens}
+
+
+class MockConfig:
+    """Параметры заглушки: задержки и доля ошибок для OpenAI и Telegram"""
+
+    def __init__(self, openai_latency: str = "fixed:0.05", whisper_latency: str = "fixed:0.1",
+                 telegram_latency: str = "fixed:0.005", openai_error_rate: float = 0.0,
+                 openai_rate_limit_rate: float = 0.0, telegram_error_rate: float = 0.0,
+                 stream_chunks: int = 8, seed: Optional[int] = None,
+                 prompt_token_latency: float = 0.0, assemblyai_latency: str = "fixed:1.0"):
+        self.openai_latency = LatencyModel(openai_latency)
+        self.whisper_latency = LatencyModel(whisper_latency)
+        self.assemblyai_latency = LatencyModel(assemblyai_latency)
+        self.telegram_latency = LatencyModel(telegram_latency)
+        self.openai_error_rate = openai_error_rate
+        self.openai_rate_limit_rate = openai_rate_limit_rate
+        self.telegram_error_rate = telegram_error_rate
+        self.stream_chunks = max(1, stream_chunks)
+        # Секунд на некэшированный токен промпта (время обработки промпта моделью)
+        self.prompt_token_latency = prompt_token_latency
+        self.rng = random.Random(seed)
+
+
+class MockServer:
+    """Обработчики заглушки и счетчики запросов"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = config.rng
+        self.calls: Counter = Counter()
+        self.injected_errors: Counter = Counter()
+        self.message_id = 0
+        # Задания AssemblyAI: id -> момент готовности результата
+        self.transcripts: Dict[str, float] = {}
+        # Вызовы Bot API с отметкой времени (perf_counter при получении): для замеров
+        # задержки от обновления до ответа пользователю; None - не записывать
+        self.bot_events: Optional[List[Tuple[float, str, Dict[str, Any]]]] = None
+
+    # --- OpenAI ---
+
+    def _inject_openai_error(self, route: str) -> Optional[web.Response]:
+        roll = self.rng.random()
+        if roll < self.config.openai_rate_limit_rate:
+            self.injected_errors[f"{route}:429"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached (mock)"}},
+                                     status=429, headers={"Retry-After": "1"})
+        if roll < self.config.openai_rate_limit_rate + self.config.openai_error_rate:
+            self.injected_errors[f"{route}:500"] += 1
+            return web.json_response({"error": {"message": "Internal error (mock)"}}, status=500)
+        return None
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.calls['chat/completions'] += 1
+        payload = await request.json()
+        prompt_usage = estimate_prompt_usage(payload)
+        uncached_tokens = prompt_usage['prompt_tokens'] - prompt_usage['cached_tokens']
+        await asyncio.sleep(self.config.openai_latency.sample(self.rng)
+                            + uncached_tokens * self.config.prompt_token_latency)
+        error = self._inject_openai_error('chat/completions')
+        if error is not None:
+            return error
+
+        structured = bool(payload.get('response_format'))
+        content = json.dumps(STUB_ANALYSIS, ensure_ascii=False) if structured else STUB_ANALYSIS_TEXT
+        completion_tokens = estimate_tokens(content)
+        usage = {"prompt_tokens": prompt_usage['prompt_tokens'], "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_usage['prompt_tokens'] + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": prompt_usage['cached_tokens']}}
+        if not payload.get('stream'):
+            return web.json_response({
+                "id": "chatcmpl-mock", "object": "chat.completion", "model": payload.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.calls['chat/completions:stream'] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        step = max(1, math.ceil(len(content) / self.config.stream_chunks))
+        for start in range(0, len(content), step):
+            chunk = {"choices": [{"index": 0, "delta": {"content": content[start:start + step]}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(0.02)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def audio_transcriptions(self, request: web.Request) -> web.Response:
+        self.calls['audio/transcriptions'] += 1
+        await request.read()
+        await asyncio.sleep(self.config.whisper_latency.sample(self.rng))
+        error = self._inject_openai_error('audio/transcriptions')
+        if error is not None:
+            return error
+        return web.Response(text=STUB_TRANSCRIPTION)
+
+    # --- AssemblyAI ---
+
+    async def assemblyai_upload(self, request: web.Request) -> web.Response:
+        self.calls['assemblyai:upload'] += 1
+        body = await request.read()
+        return web.json_response({"upload_url": f"mock://upload/{hashlib.md5(body).hexdigest()}"})
+
+    async def assemblyai_transcript(self, request: web.Request) -> web.Response:
+        self.calls['assemblyai:transcript'] += 1
+        await request.json()
+        transcript_id = f"transcript-{len(self.transcripts) + 1}"
+        self.transcripts[transcript_id] = time.monotonic() + self.config.assemblyai_latency.sample(self.rng)
+        return web.json_response({"id": transcript_id, "status": "queued"})
+
+    async def assemblyai_status(self, request: web.Request) -> web.Response:
+        self.calls['assemblyai:poll'] += 1
+        ready_at = self.transcripts.get(request.match_info['transcript_id'])
+        if ready_at is None:
+            return web.json_response({"error": "Transcript not found (mock)"}, status=404)
+        if time.monotonic() < ready_at:
+            return web.json_response({"status": "processing"})
+        return web.json_response({"status": "completed", "text": STUB_TRANSCRIPTION})
+
+    # --- Telegram Bot API ---
+
+    async def _read_params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        return params
+
+    def _message(self, params: Dict[str, Any], text: Optional[str] = None) -> Dict[str, Any]:
+        self.message_id += 1
+        message_id = int(params.get('message_id') or self.message_id)
+        chat_id = int(params.get('chat_id') or 0)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "MockBot", "username": "mock_bot"},
+            "text": text if text is not None else params.get('text', ''),
+        }
+
+    async def bot_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[f"bot:{method}"] += 1
+        params = await self._read_params(request)
+        if self.bot_events is not None:
+            self.bot_events.append((time.perf_counter(), method, params))
+        await asyncio.sleep(self.config.telegram_latency.sample(self.rng))
+        if method != 'getMe' and self.rng.random() < self.config.telegram_error_rate:
+            self.injected_errors[f"bot:{method}:429"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests (mock)",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "MockBot", "username": "mock_bot",
+                      "can_join_groups": False, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == 'getFile':
+            file_id = params.get('file_id', '')
+            kind = 'voice' if file_id.startswith('voice') else 'photos'
+            extension = 'oga' if kind == 'voice' else 'jpg'
+            result = {"file_id": file_id, "file_unique_id": f"u-{file_id}", "file_size": 40000,
+                      "file_path": f"{kind}/{file_id}.{extension}"}
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto', 'editMessageReplyMarkup'):
+            result = self._message(params)
+        else:
+            # answerCallbackQuery, deleteMessage, sendChatAction и прочие методы без данных
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def bot_file(self, request: web.Request) -> web.Response:
+        path = request.match_info['path']
+        self.calls['file'] += 1
+        await asyncio.sleep(self.config.telegram_latency.sample(self.rng))
+        if path.startswith('voice/'):
+            data = b'OggS' + random.Random(path).randbytes(16000)
+            return web.Response(body=data, content_type='audio/ogg')
+        return web.Response(body=render_photo(path), content_type='image/jpeg')
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'calls': dict(self.calls), 'injected_errors': dict(self.injected_errors)}
+
+
+def render_photo(path: str, size: Tuple[int, int] = (1280, 960)) -> bytes:
+    """JPEG с узором, зависящим от пути: разные файлы не совпадают в кэше похожих фото"""
+    if Image is None:
+        return FALLBACK_JPEG
+    rng = random.Random(hashlib.md5(path.encode('utf-8')).digest())
+    grid = Image.new('L', (9, 8))
+    grid.putdata([rng.randrange(256) for _ in range(72)])
+    image = Image.merge('RGB', [grid, grid.transpose(Image.FLIP_LEFT_RIGHT), grid.transpose(Image.FLIP_TOP_BOTTOM)])
+    output = io.BytesIO()
+    image.resize(size, Image.BILINEAR).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def create_app(config: MockConfig) -> Tuple[web.Application, MockServer]:
+    server = MockServer(config)
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app.router.add_post('/v1/chat/completions', server.chat_completions)
+    app.router.add_post('/v1/audio/transcriptions', server.audio_transcriptions)
+    app.router.add_post('/v2/upload', server.assemblyai_upload)
+    app.router.add_post('/v2/transcript', server.assemblyai_transcript)
+    app.router.add_get('/v2/transcript/{transcript_id}', server.assemblyai_status)
+    app.router.add_route('*', '/bot{token}/{method}', server.bot_method)
+    app.router.add_get('/file/bot{token}/{path:.+}', server.bot_file)
+    return app, server
+
+
+async def start_mock_server(config: MockConfig, host: str = '127.0.0.1', port: int = 0):
+    """Запускает заглушку в текущем event loop; возвращает (runner, server, базовый URL)"""
+    app, server = create_app(config)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, server, f"http://{host}:{port}"
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    """Параметры заглушки для командной строки (общие с нагрузочным сценарием)"""
+    parser.add_argument('--openai-latency', default='lognormal:0.8,0.4', help='Задержка chat/completions')
+    parser.add_argument('--whisper-latency', default='lognormal:1.0,0.3', help='Задержка audio/transcriptions')
+    parser.add_argument('--assemblyai-latency', default='lognormal:1.5,0.3', help='Время распознавания AssemblyAI')
+    parser.add_argument('--telegram-latency', default='fixed:0.01', help='Задержка Bot API и файлов')
+    parser.add_argument('--openai-error-rate', type=float, default=0.0, help='Доля ответов 500 от OpenAI')
+    parser.add_argument('--openai-429-rate', type=float, default=0.0, help='Доля ответов 429 от OpenAI')
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0, help='Доля ответов 429 от Bot API')
+    parser.add_argument('--prompt-token-latency', type=float, default=0.0,
+                        help='Дополнительная задержка chat/completions на некэшированный токен промпта, с')
+    parser.add_argument('--seed', type=int, default=None, help='Зерно генератора задержек и ошибок')
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(args.openai_latency, args.whisper_latency, args.telegram_latency,
+                      args.openai_error_rate, args.openai_429_rate, args.telegram_error_rate, seed=args.seed,
+                      prompt_token_latency=args.prompt_token_latency, assemblyai_latency=args.assemblyai_latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI и Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    app, _ = create_app(config_from_args(args))
+    print(f"OpenAI: BASE_URL=http://{args.host}:{args.port}/v1/")
+    print(f"Telegram: base_url=http://{args.host}:{args.port}/bot, base_file_url=http://{args.host}:{args.port}/file/bot")
+    web.run_app(app, host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@
 Дополнительные оптимизации производительности для бота Calorigram
 """
 import asyncio
+import heapq
+import itertools
 import time
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
 from functools import wraps
-from typing import Callable, Any
+from typing import Callable, Any, Optional, Dict, Deque, Tuple, List
 from logging_config import get_logger
+from config import (
+    OPENAI_CHAT_RPM, OPENAI_CHAT_TPM, OPENAI_VISION_RPM, OPENAI_VISION_TPM, OPENAI_WHISPER_RPM,
+    USER_AI_REQUESTS_PER_MINUTE, USER_AI_BURST,
+    AI_MAX_IN_FLIGHT, AI_MAX_IN_FLIGHT_PER_MODEL, AI_MAX_QUEUE_DEPTH
+)
 
 logger = get_logger(__name__)
 
@@ -39,32 +48,282 @@ def performance_monitor(func: Callable) -> Callable:
     
     return async_wrapper if asyncio.iscoroutinefunction(func) else sync_wrapper
 
-class RateLimiter:
-    """Класс для ограничения частоты запросов"""
-    
-    def __init__(self, max_requests: int, time_window: int):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = []
-    
-    def is_allowed(self) -> bool:
-        """Проверяет, можно ли выполнить запрос"""
-        now = time.time()
-        # Удаляем старые запросы
-        self.requests = [req_time for req_time in self.requests if now - req_time < self.time_window]
-        
-        if len(self.requests) < self.max_requests:
-            self.requests.append(now)
+class AsyncTokenBucket:
+    """Асинхронный token bucket: O(1) на запрос, ожидающие обслуживаются строго по очереди (FIFO)"""
+    
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None, name: str = ""):
+        self.name = name
+        self.rate = rate_per_minute / 60.0  # токенов в секунду
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+        self._wakeup_task: Optional[asyncio.Task] = None
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_acquire(self, amount: float = 1) -> bool:
+        """Забирает токены без ожидания; не обгоняет уже ожидающих"""
+        amount = min(amount, self.capacity)
+        self._refill()
+        if not self._waiters and self.tokens >= amount:
+            self.tokens -= amount
             return True
         return False
     
-    def get_wait_time(self) -> float:
-        """Возвращает время ожидания до следующего разрешенного запроса"""
-        if not self.requests:
-            return 0
+    async def acquire(self, amount: float = 1) -> float:
+        """Ждет, пока не наберется нужное число токенов; возвращает время ожидания в секундах"""
+        if self.try_acquire(amount):
+            return 0.0
         
-        oldest_request = min(self.requests)
-        return max(0, self.time_window - (time.time() - oldest_request))
+        started = time.monotonic()
+        amount = min(amount, self.capacity)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((amount, future))
+        if self._wakeup_task is None or self._wakeup_task.done():
+            self._wakeup_task = asyncio.create_task(self._wake_waiters())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Отмененное ожидание просто пропускается очередью; если токены уже
+            # были выданы, но запрос отменен - возвращаем их
+            if future.done() and not future.cancelled():
+                self.tokens = min(self.capacity, self.tokens + amount)
+            raise
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.info(f"Rate limit '{self.name}': waited {waited:.1f}s")
+        return waited
+    
+    async def _wake_waiters(self):
+        """Будит только первого в очереди, когда для него накопятся токены"""
+        while self._waiters:
+            amount, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            self._refill()
+            if self.tokens >= amount:
+                self._waiters.popleft()
+                self.tokens -= amount
+                future.set_result(None)
+                continue
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+    
+    @property
+    def queue_length(self) -> int:
+        return len(self._waiters)
+
+class AIRateLimiter:
+    """Лимиты запросов к ИИ: отдельные bucket'ы по эндпоинтам (RPM/TPM) и bucket на пользователя"""
+    
+    def __init__(self, endpoint_limits: Dict[str, Dict[str, float]], user_rpm: float, user_burst: float,
+                 max_users: int = 10000):
+        self.buckets: Dict[str, Dict[str, AsyncTokenBucket]] = {}
+        for endpoint, limits in endpoint_limits.items():
+            self.buckets[endpoint] = {
+                kind: AsyncTokenBucket(limit, name=f"{endpoint}:{kind}")
+                for kind, limit in limits.items() if limit and limit > 0
+            }
+        self.user_rpm = user_rpm
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.user_buckets: "OrderedDict[int, AsyncTokenBucket]" = OrderedDict()
+    
+    def _user_bucket(self, user_id: int) -> AsyncTokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            if len(self.user_buckets) >= self.max_users:
+                # Вытесняем давно неактивного пользователя
+                self.user_buckets.popitem(last=False)
+            bucket = AsyncTokenBucket(self.user_rpm, capacity=self.user_burst, name=f"user:{user_id}")
+            self.user_buckets[user_id] = bucket
+        else:
+            self.user_buckets.move_to_end(user_id)
+        return bucket
+    
+    async def acquire(self, endpoint: str, tokens: float = 0, user_id: Optional[int] = None) -> float:
+        """Ожидает разрешения на запрос; возвращает суммарное время ожидания"""
+        waited = 0.0
+        # Сначала честность между пользователями, затем общие лимиты аккаунта
+        if user_id is not None and self.user_rpm > 0:
+            waited += await self._user_bucket(user_id).acquire(1)
+        buckets = self.buckets.get(endpoint, {})
+        if 'rpm' in buckets:
+            waited += await buckets['rpm'].acquire(1)
+        if 'tpm' in buckets and tokens > 0:
+            waited += await buckets['tpm'].acquire(tokens)
+        return waited
+    
+    def try_acquire(self, endpoint: str, tokens: float = 0) -> bool:
+        """
+        Списывает RPM/TPM эндпоинта без ожидания (для дополнительных запросов вроде хеджирования);
+        False - токенов сейчас нет, ничего не списано
+        """
+        buckets = self.buckets.get(endpoint, {})
+        rpm, tpm = buckets.get('rpm'), buckets.get('tpm')
+        if rpm is not None and not rpm.try_acquire(1):
+            return False
+        if tpm is not None and tokens > 0 and not tpm.try_acquire(tokens):
+            if rpm is not None:
+                rpm.tokens = min(rpm.capacity, rpm.tokens + 1)
+            return False
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает остаток токенов и длину очередей по эндпоинтам"""
+        stats = {}
+        for endpoint, buckets in self.buckets.items():
+            for kind, bucket in buckets.items():
+                bucket._refill()
+                stats[f"{endpoint}_{kind}"] = {'available': int(bucket.tokens), 'queued': bucket.queue_length}
+        stats['tracked_users'] = len(self.user_buckets)
+        return stats
+
+# Приоритеты запросов к ИИ: меньше - раньше
+PRIORITY_CONFIRMATION = 0  # уточнение/дополнение уже показанного анализа
+PRIORITY_PREMIUM = 1       # пользователи с активной подпиской
+PRIORITY_DEFAULT = 2       # обычное добавление еды
+PRIORITY_FREE_CHECK = 3    # бесплатная проверка "Узнать калории"
+
+class AIOverloadedError(Exception):
+    """Очередь к модели переполнена - запрос отклонен сразу, без ожидания"""
+
+class _ModelBulkhead:
+    """Состояние одной модели: занятые слоты, очередь с приоритетами и метрики ожидания"""
+    
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.in_flight = 0
+        # Элемент очереди: [приоритет, порядковый номер, future, callback, последняя позиция, время постановки]
+        self.queue: List[list] = []
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_times: Deque[float] = deque(maxlen=500)
+    
+    def pending(self) -> List[list]:
+        """Ожидающие запросы в порядке обслуживания (отмененные пропускаются)"""
+        return [entry for entry in sorted(self.queue) if not entry[2].done()]
+
+class AdmissionController:
+    """Bulkhead перед APIClient: ограничение одновременных запросов на модель и очередь с приоритетами"""
+    
+    def __init__(self, default_limit: int, model_limits: Dict[str, int], max_queue_depth: int):
+        self.default_limit = default_limit
+        self.model_limits = model_limits
+        self.max_queue_depth = max_queue_depth
+        self.models: Dict[str, _ModelBulkhead] = {}
+        self._sequence = itertools.count()
+    
+    def _bulkhead(self, model: str) -> _ModelBulkhead:
+        bulkhead = self.models.get(model)
+        if bulkhead is None:
+            bulkhead = _ModelBulkhead(self.model_limits.get(model, self.default_limit))
+            self.models[model] = bulkhead
+        return bulkhead
+    
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_DEFAULT,
+                   on_queue_position: Optional[Callable[[int], Any]] = None):
+        """Занимает слот модели на время запроса; при полной очереди сразу бросает AIOverloadedError"""
+        bulkhead = self._bulkhead(model)
+        await self._acquire(bulkhead, model, priority, on_queue_position)
+        try:
+            yield
+        finally:
+            self._release(bulkhead)
+    
+    async def _acquire(self, bulkhead: _ModelBulkhead, model: str, priority: int,
+                       on_queue_position: Optional[Callable[[int], Any]]):
+        if bulkhead.in_flight < bulkhead.limit and not bulkhead.pending():
+            bulkhead.in_flight += 1
+            bulkhead.admitted += 1
+            bulkhead.wait_times.append(0.0)
+            return
+        
+        # Ждать в длинной очереди хуже, чем сразу получить отказ
+        pending = bulkhead.pending()
+        bulkhead.queue = pending
+        heapq.heapify(bulkhead.queue)
+        if len(pending) >= self.max_queue_depth:
+            bulkhead.rejected += 1
+            logger.warning(f"AI admission rejected for {model}: queue depth {len(pending)}")
+            worst = pending[-1]
+            if worst[0] <= priority:
+                raise AIOverloadedError(f"Queue for {model} is full")
+            # Более важный запрос вытесняет из очереди самый неприоритетный
+            worst[2].set_exception(AIOverloadedError(f"Queue for {model} is full"))
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), future, on_queue_position, None, time.monotonic()]
+        heapq.heappush(bulkhead.queue, entry)
+        self._notify_positions(bulkhead)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но запрос отменен - отдаем слот следующему
+                self._release(bulkhead)
+            else:
+                self._notify_positions(bulkhead)
+            raise
+        
+        waited = time.monotonic() - entry[5]
+        bulkhead.wait_times.append(waited)
+        if waited > 1:
+            logger.info(f"AI admission for {model}: waited {waited:.1f}s in queue")
+        self._report_position(entry, 0)
+    
+    def _release(self, bulkhead: _ModelBulkhead):
+        bulkhead.in_flight -= 1
+        while bulkhead.queue and bulkhead.in_flight < bulkhead.limit:
+            entry = heapq.heappop(bulkhead.queue)
+            if entry[2].done():
+                continue
+            bulkhead.in_flight += 1
+            bulkhead.admitted += 1
+            entry[2].set_result(None)
+        self._notify_positions(bulkhead)
+    
+    def _notify_positions(self, bulkhead: _ModelBulkhead):
+        """Сообщает ожидающим их новую позицию в очереди (только при изменении)"""
+        for position, entry in enumerate(bulkhead.pending(), start=1):
+            self._report_position(entry, position)
+    
+    @staticmethod
+    def _report_position(entry: list, position: int):
+        callback = entry[3]
+        # Позицию 0 ("ваша очередь") сообщаем только тем, кто действительно ждал
+        if callback is None or entry[4] == position or (position == 0 and entry[4] is None):
+            return
+        entry[4] = position
+        try:
+            result = callback(position)
+            if asyncio.iscoroutine(result):
+                task = asyncio.create_task(result)
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        except Exception as e:
+            logger.warning(f"Queue position callback failed: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает загрузку, длину очереди и время ожидания по моделям"""
+        stats = {}
+        for model, bulkhead in self.models.items():
+            waits = sorted(bulkhead.wait_times)
+            stats[model] = {
+                'limit': bulkhead.limit,
+                'in_flight': bulkhead.in_flight,
+                'queued': len(bulkhead.pending()),
+                'admitted': bulkhead.admitted,
+                'rejected': bulkhead.rejected,
+                'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0,
+                'max_wait': waits[-1] if waits else 0.0
+            }
+        return stats
 
 class MemoryOptimizer:
     """Класс для оптимизации использования памяти"""
@@ -147,6 +406,19 @@ class DatabaseOptimizer:
             logger.error(f"Error applying database optimizations: {e}")
 
 # Глобальные экземпляры для использования в приложении
-rate_limiter = RateLimiter(max_requests=10, time_window=60)  # 10 запросов в минуту
+ai_rate_limiter = AIRateLimiter(
+    endpoint_limits={
+        'chat': {'rpm': OPENAI_CHAT_RPM, 'tpm': OPENAI_CHAT_TPM},
+        'vision': {'rpm': OPENAI_VISION_RPM, 'tpm': OPENAI_VISION_TPM},
+        'whisper': {'rpm': OPENAI_WHISPER_RPM},
+    },
+    user_rpm=USER_AI_REQUESTS_PER_MINUTE,
+    user_burst=USER_AI_BURST
+)
+ai_admission = AdmissionController(
+    default_limit=AI_MAX_IN_FLIGHT,
+    model_limits=AI_MAX_IN_FLIGHT_PER_MODEL,
+    max_queue_depth=AI_MAX_QUEUE_DEPTH
+)
 memory_optimizer = MemoryOptimizer()
 db_optimizer = DatabaseOptimizer()
@@ -0,0 +1,197 @@
+"""
+Реестр промптов для анализа еды
+
+Каждый шаблон хранит неизменяемую часть запроса (системный промпт, параметры модели,
+response_format) и собирает каркас payload один раз. Статическое содержимое идет первым,
+чтобы на стороне провайдера срабатывало кэширование префикса промпта.
+Версия шаблона и хэш его текста входят в ключи кэша анализов: изменение промпта
+автоматически делает старые результаты недействительными.
+"""
+import hashlib
+import json
+from typing import Optional, Dict, Any, List
+from models.analysis import ANALYSIS_RESPONSE_FORMAT
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Формат ответа в текстовом режиме
+ANALYSIS_TEXT_FORMAT = """🍽️ Анализ блюда:
+
+Название: [название блюда]
+Вес: [общий вес блюда]г
+Калорийность: [ОБЩАЯ калорийность для всего количества] ккал
+
+📊 БЖУ на 100г:
+• Белки: [количество]г
+• Жиры: [количество]г
+• Углеводы: [количество]г
+
+📈 Общее БЖУ в блюде:
+• Белки: [общее количество]г
+• Жиры: [общее количество]г
+• Углеводы: [общее количество]г"""
+
+STANDARD_DISHES_REFERENCE = """Стандартные данные для популярных блюд (на 100г):
+Плов классический: 170-180 ккал, белки 7-8г, жиры 8-10г, углеводы 25-30г
+Гречка с мясом: 150-160 ккал, белки 8-10г, жиры 6-8г, углеводы 20-25г
+Борщ с мясом: 60-80 ккал, белки 4-5г, жиры 3-4г, углеводы 6-8г
+Используй эти данные как основу для расчета."""
+
+NUMBER_FORMAT_RULES = """НЕ добавляй никаких дополнительных пояснений, расчетов или объяснений!
+НЕ используй обратные слеши (\\) в числах!
+Используй запятую как десятичный разделитель: 0,3г вместо 0.3г"""
+
+
+class PromptTemplate:
+    """Версионированный шаблон запроса chat/completions"""
+
+    def __init__(self, name: str, version: int, system: str, max_tokens: int,
+                 temperature: float = 0.3, structured: bool = False):
+        self.name = name
+        self.version = version
+        self.system = system
+        self.structured = structured
+        # Каркас payload собирается один раз; системное сообщение - общий неизменяемый префикс
+        self._system_message = {"role": "system", "content": system}
+        self._skeleton: Dict[str, Any] = {"max_tokens": max_tokens, "temperature": temperature}
+        if structured:
+            self._skeleton["response_format"] = ANALYSIS_RESPONSE_FORMAT
+        # Хэш содержимого страхует от правки текста без повышения версии
+        digest = hashlib.sha1(json.dumps([system, self._skeleton], ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        self.cache_tag = f"{name}:v{version}:{digest.hexdigest()[:8]}"
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def build_payload(self, model: str, user_content: Any) -> Dict[str, Any]:
+        """Возвращает payload: общий каркас плюс пользовательская часть запроса"""
+        payload = dict(self._skeleton)
+        payload["model"] = model
+        payload["messages"] = [self._system_message, {"role": "user", "content": user_content}]
+        return payload
+
+    def record_usage(self, usage: Optional[Dict[str, Any]]):
+        """Учитывает фактический расход токенов промпта (и сколько из них взято из кэша провайдера)"""
+        if not usage:
+            return
+        self.requests += 1
+        self.prompt_tokens += usage.get('prompt_tokens', 0)
+        self.cached_tokens += (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'version': self.cache_tag,
+            'requests': self.requests,
+            'avg_prompt_tokens': self.prompt_tokens / self.requests if self.requests else 0.0,
+            'cached_fraction': self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        }
+
+
+class PromptRegistry:
+    """Реестр шаблонов по имени"""
+
+    def __init__(self, templates: List[PromptTemplate]):
+        self.templates = {template.name: template for template in templates}
+
+    def get(self, name: str) -> PromptTemplate:
+        return self.templates[name]
+
+    def analysis(self, kind: str, output_format: str) -> PromptTemplate:
+        """Шаблон анализа (image, album, text, photo_text, supplement) для формата ответа json или text"""
+        return self.templates[f"{kind}_{'json' if output_format == 'json' else 'text'}"]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {name: template.get_stats() for name, template in self.templates.items() if template.requests}
+
+
+prompt_registry = PromptRegistry([
+    PromptTemplate(
+        "image_text", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "Проанализируй изображение еды и предоставь информацию в следующем формате:\n\n"
+        f"{ANALYSIS_TEXT_FORMAT}\n\n{STANDARD_DISHES_REFERENCE}\n\n"
+        "ВАЖНО: Рассчитай калорийность для ВСЕГО видимого количества еды на фото, а не только для 100г!\n"
+        "НЕ добавляй никаких дополнительных пояснений, расчетов или объяснений!",
+        max_tokens=500
+    ),
+    PromptTemplate(
+        "image_json", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "Определи блюдо на фото, оцени общий вес всего видимого количества еды,\n"
+        "калорийность всего блюда и значения на 100г.\n"
+        f"{STANDARD_DISHES_REFERENCE}",
+        max_tokens=200, structured=True
+    ),
+    # Альбом: несколько фото одного приема пищи - один общий результат
+    PromptTemplate(
+        "album_text", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "Тебе прислали несколько фотографий одного приема пищи (разные ракурсы или разные блюда).\n"
+        "Не считай одну и ту же еду дважды, если она видна на нескольких фото. "
+        "Если есть описание пользователя - учти его.\n"
+        "Предоставь ОДИН общий результат для всей еды в следующем формате:\n\n"
+        f"{ANALYSIS_TEXT_FORMAT}\n\n{STANDARD_DISHES_REFERENCE}\n\n"
+        "ВАЖНО: Рассчитай калорийность для ВСЕГО количества еды на всех фото, а не только для 100г!\n"
+        "НЕ добавляй никаких дополнительных пояснений, расчетов или объяснений!",
+        max_tokens=500
+    ),
+    PromptTemplate(
+        "album_json", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "На нескольких фотографиях - один прием пищи (разные ракурсы или разные блюда).\n"
+        "Определи еду, не считая дважды то, что видно на нескольких фото, оцени общий вес,\n"
+        "калорийность всего приема пищи и значения на 100г. Если есть описание пользователя - учти его.\n"
+        f"{STANDARD_DISHES_REFERENCE}",
+        max_tokens=200, structured=True
+    ),
+    PromptTemplate(
+        "text_text", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "Проанализируй описание еды и предоставь информацию в следующем формате:\n\n"
+        f"{ANALYSIS_TEXT_FORMAT}\n\n{STANDARD_DISHES_REFERENCE}\n\n{NUMBER_FORMAT_RULES}",
+        max_tokens=500
+    ),
+    PromptTemplate(
+        "text_json", 1,
+        "Ты эксперт по анализу еды и подсчету калорий.\n"
+        "По описанию определи блюдо, его общий вес (если вес не указан - стандартная порция),\n"
+        "калорийность всего количества и значения на 100г.\n"
+        f"{STANDARD_DISHES_REFERENCE}",
+        max_tokens=200, structured=True
+    ),
+    PromptTemplate(
+        "photo_text_text", 1,
+        "Ты эксперт по анализу еды и подсчету калорий. Используй анализ фото как основу "
+        "и дополняй его информацией от пользователя для более точного результата.\n"
+        "Предоставь уточненный анализ в следующем формате:\n\n"
+        f"{ANALYSIS_TEXT_FORMAT}\n\n"
+        "Учти дополнительную информацию пользователя для более точного определения веса, "
+        "ингредиентов и способа приготовления.",
+        max_tokens=1000
+    ),
+    PromptTemplate(
+        "photo_text_json", 1,
+        "Ты эксперт по анализу еды и подсчету калорий. Используй анализ фото как основу "
+        "и уточни его информацией от пользователя: вес, ингредиенты, способ приготовления.",
+        max_tokens=200, structured=True
+    ),
+    # Уточнение показанного анализа: в запросе только краткий прежний результат и уточнение
+    PromptTemplate(
+        "supplement_text", 1,
+        "Ты эксперт по анализу еды и подсчету калорий. Тебе дан предыдущий результат анализа блюда "
+        "в кратком виде (название, вес, калорийность, общее БЖУ) и уточнение пользователя.\n"
+        "Пересчитай результат с учетом уточнения: вес, ингредиенты, способ приготовления. "
+        "Значения, которые уточнение не затрагивает, оставь прежними.\n"
+        "Предоставь уточненный анализ в следующем формате:\n\n"
+        f"{ANALYSIS_TEXT_FORMAT}\n\n{NUMBER_FORMAT_RULES}",
+        max_tokens=500
+    ),
+    PromptTemplate(
+        "supplement_json", 1,
+        "Ты эксперт по анализу еды и подсчету калорий. Тебе дан предыдущий результат анализа блюда "
+        "в кратком виде и уточнение пользователя. Пересчитай вес, калорийность всего блюда и значения "
+        "на 100г с учетом уточнения; значения, которые уточнение не затрагивает, оставь прежними.",
+        max_tokens=200, structured=True
+    ),
+])
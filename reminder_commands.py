@@ -13,6 +13,7 @@ from database import (
     get_user_by_telegram_id
 )
 from reminder_sender import send_test_reminder
+from handlers.router import callback_router
 
 logger = get_logger(__name__)
 
@@ -73,6 +74,8 @@ async def reminder_settings_command(update: Update, context: ContextTypes.DEFAUL
         parse_mode='Markdown'
     )
 
+# На callback отвечает сам обработчик
+@callback_router.route(prefixes=("reminder_", "timezone_"), answer=False)
 async def handle_reminder_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback запросов для настроек напоминаний"""
     query = update.callback_query
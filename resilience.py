@@ -0,0 +1,366 @@
+"""
+Устойчивость обращений к внешним API: повторы с джиттером, Retry-After,
+circuit breaker по эндпоинтам и общий бюджет времени на запрос пользователя
+"""
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+import aiohttp
+from config import (
+    MAX_API_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIMEOUT, AI_HEDGE_VISION, AI_HEDGE_MAX_EXTRA
+)
+from logging_config import get_logger
+from performance_optimizations import AIOverloadedError
+
+logger = get_logger(__name__)
+
+# Статусы, при которых повтор имеет смысл: таймауты, лимиты и сбои на стороне сервиса
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """Временная ошибка попытки; retry_after - пауза, запрошенная сервером"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, counts_as_failure: bool = True):
+        super().__init__(message)
+        self.retry_after = retry_after
+        # 429 - это наш лимит, а не недоступность сервиса: breaker его не учитывает
+        self.counts_as_failure = counts_as_failure
+
+
+class CircuitOpenError(AIOverloadedError):
+    """Circuit breaker разомкнут - запрос отклонен без обращения к сервису"""
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Пауза из заголовков Retry-After (секунды или HTTP-дата) / retry-after-ms"""
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_for_status(status: int, headers=None) -> Optional[RetryableError]:
+    """RetryableError для временных статусов, None - для остальных"""
+    if status not in RETRYABLE_STATUSES:
+        return None
+    return RetryableError(f"HTTP {status}", parse_retry_after(headers), counts_as_failure=status != 429)
+
+
+class RetryPolicy:
+    """Экспоненциальная пауза с декоррелированным джиттером (sleep = random(base, prev * 3))"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def next_delay(self, previous: float) -> float:
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+
+class Deadline:
+    """Бюджет времени на весь запрос пользователя, включая ожидание в очередях и повторы"""
+
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker: closed -> open после серии сбоев -> half_open после паузы
+
+    В состоянии half_open пропускается один пробный запрос: успех замыкает цепь,
+    сбой снова размыкает ее на recovery_timeout секунд.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.total_failures = 0
+        self.rejected = 0
+
+    def is_open(self) -> bool:
+        """Цепь разомкнута и пауза восстановления еще не прошла (без побочных эффектов)"""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас обращаться к сервису"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+            logger.info(f"Circuit '{self.name}' half-open: probing")
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit '{self.name}' closed")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit '{self.name}' opened after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def reset(self):
+        """Принудительно замыкает цепь (из админки)"""
+        self.record_success()
+
+    def get_stats(self) -> Dict[str, Any]:
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'total_failures': self.total_failures,
+            'rejected': self.rejected,
+            'retry_in': retry_in
+        }
+
+
+class CircuitBreakerRegistry:
+    """Circuit breaker'ы по имени эндпоинта, создаются при первом обращении"""
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, self.failure_threshold, self.recovery_timeout)
+            self.breakers[name] = breaker
+        return breaker
+
+    def reset_all(self):
+        for breaker in self.breakers.values():
+            breaker.reset()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: breaker.get_stats() for name, breaker in self.breakers.items()}
+
+
+def percentile(samples, fraction: float) -> float:
+    """Перцентиль выборки (ближайший ранг)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class RequestHedger:
+    """
+    Хеджирование запросов для снижения хвостовой задержки
+
+    Если попытка не завершилась за текущий p90 задержки (по скользящему окну последних
+    запросов), запускается вторая такая же; берется результат первой завершившейся,
+    другая отменяется. Доля дополнительных запросов ограничена max_extra_fraction.
+    Второй запрос расходует лимиты так же, как первый: если admit() не выдал на него
+    токены, хеджирование пропускается.
+    """
+
+    def __init__(self, name: str, enabled: bool, max_extra_fraction: float = 0.05,
+                 hedge_percentile: float = 0.9, window: int = 200, min_samples: int = 20):
+        self.name = name
+        self.enabled = enabled
+        self.max_extra_fraction = max_extra_fraction
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        # Задержки отдельных запросов - по ним выбирается момент хеджирования
+        self.latencies: Deque[float] = deque(maxlen=window)
+        # Итоговая задержка попыток с учетом хеджирования
+        self.observed: Deque[float] = deque(maxlen=1000)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_throttled = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд отправлять второй запрос (None - пока мало данных)"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return percentile(self.latencies, self.hedge_percentile)
+
+    def _take_budget(self) -> bool:
+        return self.hedges + 1 <= self.max_extra_fraction * self.requests
+
+    async def run(self, attempt: Callable[[float], Awaitable[Any]], timeout: float,
+                  admit: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Выполняет attempt(timeout) с возможным хеджированием
+
+        admit - неблокирующее списание лимитов на второй запрос (False - лимиты исчерпаны)
+        """
+        self.requests += 1
+        started = time.monotonic()
+        primary = asyncio.ensure_future(attempt(timeout))
+        tasks = {primary: started}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None and delay < timeout:
+                await asyncio.wait({primary}, timeout=delay)
+                if not primary.done() and self._take_budget():
+                    if admit is not None and not admit():
+                        self.hedges_throttled += 1
+                        logger.info(f"Skipping '{self.name}' hedge: rate limit exhausted")
+                    else:
+                        self.hedges += 1
+                        logger.info(f"Hedging '{self.name}' request after {delay:.2f}s")
+                        tasks[asyncio.ensure_future(attempt(timeout - delay))] = time.monotonic()
+
+            pending = set(tasks)
+            first_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        first_error = first_error or task.exception()
+                        continue
+                    # Порог хеджирования считается только по успешным ответам: быстрые отказы занизили бы p90
+                    finished = time.monotonic()
+                    self.latencies.append(finished - tasks[task])
+                    self.observed.append(finished - started)
+                    if task is not primary:
+                        self.hedge_wins += 1
+                    return task.result()
+            if first_error is None:
+                # Все попытки отменены - отмену и пробрасываем, а не TypeError от raise None
+                raise asyncio.CancelledError()
+            raise first_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def wrap(self, attempt: Callable[[float], Awaitable[Any]],
+             admit: Optional[Callable[[], bool]] = None) -> Callable[[float], Awaitable[Any]]:
+        """attempt с хеджированием (или без изменений, если хеджирование выключено)"""
+        if not self.enabled:
+            return attempt
+        return lambda timeout: self.run(attempt, timeout, admit)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_rate': self.hedges / self.requests if self.requests else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'hedges_throttled': self.hedges_throttled,
+            'hedge_delay': self.hedge_delay(),
+            'p99': percentile(self.observed, 0.99)
+        }
+
+
+async def call_with_retries(attempt: Callable[[float], Awaitable[Any]], breaker: CircuitBreaker,
+                            policy: RetryPolicy, deadline: Deadline, description: str = "") -> Any:
+    """
+    Выполняет attempt(таймаут_попытки) с повторами
+
+    attempt возвращает результат (в том числе None при неисправимой ошибке) или бросает
+    RetryableError / aiohttp.ClientError / asyncio.TimeoutError для повтора.
+    При разомкнутом breaker бросает CircuitOpenError, по исчерпании попыток или бюджета
+    времени возвращает None. Прочие исключения attempt (например, поврежденный JSON
+    в ответе) учитываются как сбой сервиса и пробрасываются без повтора.
+    """
+    delay = policy.base_delay
+    for attempt_number in range(1, policy.max_attempts + 1):
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Circuit '{breaker.name}' is open")
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            break
+
+        retry_after = None
+        try:
+            result = await asyncio.wait_for(attempt(timeout), timeout)
+        except RetryableError as e:
+            if e.counts_as_failure:
+                breaker.record_failure()
+            else:
+                # Попытка завершилась, пробный запрос half-open больше не выполняется
+                breaker.probe_in_flight = False
+            retry_after = e.retry_after
+            logger.warning(f"{description} attempt {attempt_number}/{policy.max_attempts} failed: {e}")
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            breaker.record_failure()
+            logger.warning(f"{description} attempt {attempt_number}/{policy.max_attempts} failed: {type(e).__name__} {e}")
+        except asyncio.CancelledError:
+            # Запрос отменен (проиграл хеджированию или гонке сервисов) - о сервисе это ничего не говорит
+            breaker.probe_in_flight = False
+            raise
+        except Exception:
+            # Без этого пробный запрос half-open остался бы "в полете" и цепь не замкнулась бы никогда
+            breaker.record_failure()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+        if attempt_number == policy.max_attempts:
+            break
+        delay = policy.next_delay(delay)
+        wait = max(delay, retry_after or 0.0)
+        if wait >= deadline.remaining():
+            logger.warning(f"{description}: deadline budget exhausted, giving up")
+            break
+        await asyncio.sleep(wait)
+    return None
+
+
+# Глобальные экземпляры
+retry_policy = RetryPolicy(MAX_API_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+circuit_breakers = CircuitBreakerRegistry(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIMEOUT)
+vision_hedger = RequestHedger('vision', AI_HEDGE_VISION, AI_HEDGE_MAX_EXTRA)
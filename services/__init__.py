@@ -4,6 +4,7 @@
 
 from services.food_analysis_service import (
     analyze_food_photo,
+    analyze_food_photos,
     analyze_food_text,
     analyze_food_supplement,
     transcribe_voice,
@@ -14,9 +15,12 @@ from services.food_analysis_service import (
     clean_markdown_text,
     remove_explanations_from_analysis,
 )
+from services.analysis_parser import parse_analysis
+from services.pending_analysis import PendingAnalysis
 
 __all__ = [
     'analyze_food_photo',
+    'analyze_food_photos',
     'analyze_food_text',
     'analyze_food_supplement',
     'transcribe_voice',
@@ -26,5 +30,7 @@ __all__ = [
     'is_valid_analysis',
     'clean_markdown_text',
     'remove_explanations_from_analysis',
+    'parse_analysis',
+    'PendingAnalysis',
 ]
 
@@ -0,0 +1,175 @@
+"""
+Однопроходный разбор текста анализа блюда
+
+Текст ответа ИИ разбирается один раз: строки просматриваются по порядку с заранее
+скомпилированными выражениями, значения раскладываются в AnalysisResult - тот же тип,
+что и у структурированного ответа. Результат кэшируется по тексту, поэтому повторные
+вызовы extract_* для одного анализа (обычно их несколько на одно сообщение) не разбирают
+текст заново; AnalysisResult неизменяемый, и общий объект из кэша безопасен.
+"""
+import re
+from functools import lru_cache
+from typing import Optional
+from logging_config import get_logger
+from models.analysis import AnalysisResult
+
+logger = get_logger(__name__)
+
+_NUMBER = r'(\d+(?:[.,]\d+)?)'
+
+# Строка вида "• Метка: значение" (маркеры списка и markdown-выделение допускаются)
+_LABELED_LINE = re.compile(r'^[\s•\-*]*(?P<label>[А-Яа-яЁё ]+?)\*{0,2}\s*:\*{0,2}\s*(?P<value>.*)$')
+_FIRST_NUMBER = re.compile(_NUMBER)
+_KCAL = re.compile(r'(\d+)\s*ккал', re.IGNORECASE)
+_WEIGHT = re.compile(_NUMBER + r'\s*(?:г|мл)')
+_PER_100G_KCAL = (
+    re.compile(r'(\d+)\s*ккал\s*(?:/|на)\s*100\s*г', re.IGNORECASE),
+    re.compile(r'100\s*г.*?(\d+)\s*ккал', re.IGNORECASE),
+)
+_EXPLANATION = re.compile(r'примечани|рекомендац|совет|обрати внимание|важно')
+_MULTISPACE = re.compile(r'  +')
+
+# Метки общей калорийности в порядке приоритета
+_CALORIE_LABELS = ('калорийность', 'общая калорийность', 'калорийность блюда', 'всего калорий')
+_MACRO_LABELS = {'белки': 0, 'жиры': 1, 'углеводы': 2}
+
+
+def _to_float(value: str) -> float:
+    return float(value.replace(',', '.'))
+
+
+def _parse_text(text: str) -> AnalysisResult:
+    lowered = text.lower()
+    is_valid = len(text) > 20 and ('калори' in lowered or 'ккал' in lowered)
+    dish_name = None
+    weight = None
+    calories_per_100g = None
+
+    calories_by_label = {}
+    fallback_calories = None
+    section = None
+    totals = [None, None, None]
+    first_totals = [None, None, None]
+    per_100g = [None, None, None]
+    # Пояснения встречаются редко: построчная фильтрация нужна, только если они есть
+    has_explanations = _EXPLANATION.search(lowered) is not None
+    kept_lines = []
+
+    for line in text.split('\n'):
+        line_lower = line.lower()
+        if has_explanations and not _EXPLANATION.search(line_lower):
+            kept_lines.append(line)
+
+        if not line.strip():
+            # Пустая строка закрывает раздел БЖУ
+            section = None
+            continue
+        if 'бжу на 100' in line_lower:
+            section = 'per_100g'
+            continue
+        if 'общее бжу' in line_lower:
+            section = 'total'
+            continue
+        if 'обратите внимание' in line_lower:
+            section = None
+
+        match = _LABELED_LINE.match(line)
+        label = match.group('label').strip().lower() if match else None
+        value = match.group('value') if match else ''
+
+        if label in _MACRO_LABELS:
+            number = _FIRST_NUMBER.search(value)
+            if number:
+                index = _MACRO_LABELS[label]
+                amount = _to_float(number.group(1))
+                if section == 'per_100g':
+                    if per_100g[index] is None:
+                        per_100g[index] = amount
+                elif section == 'total':
+                    if totals[index] is None:
+                        totals[index] = amount
+                elif first_totals[index] is None and 'на 100' not in line_lower:
+                    first_totals[index] = amount
+            continue
+
+        if label == 'название' and dish_name is None:
+            dish_name = value.strip() or None
+            continue
+        if label == 'вес' and weight is None:
+            weight_match = _WEIGHT.match(value.strip())
+            if weight_match and _to_float(weight_match.group(1)) > 0:
+                weight = _to_float(weight_match.group(1))
+            continue
+
+        if 'ккал' not in line_lower:
+            continue
+        if '100' in line_lower and calories_per_100g is None:
+            for pattern in _PER_100G_KCAL:
+                per_100g_match = pattern.search(line)
+                if per_100g_match and 0 < int(per_100g_match.group(1)) <= 1000:
+                    calories_per_100g = int(per_100g_match.group(1))
+                    break
+            if label not in _CALORIE_LABELS and ('на 100' in line_lower or '/100' in line_lower):
+                continue
+        if label in _CALORIE_LABELS and label not in calories_by_label:
+            kcal = _KCAL.search(value)
+            if kcal and 0 < int(kcal.group(1)) < 10000:
+                calories_by_label[label] = int(kcal.group(1))
+                continue
+        if 'калорийност' in line_lower:
+            kcal = _KCAL.findall(line)
+            if kcal and 0 < int(kcal[-1]) < 10000:
+                fallback_calories = int(kcal[-1])
+
+    for label in _CALORIE_LABELS:
+        if label in calories_by_label:
+            calories = calories_by_label[label]
+            break
+    else:
+        if fallback_calories is None:
+            # Последнее значение в ккал - обычно это общая калорийность
+            kcal = _KCAL.findall(text)
+            if kcal and 0 < int(kcal[-1]) < 10000:
+                fallback_calories = int(kcal[-1])
+        calories = fallback_calories
+
+    # Без раздела "Общее БЖУ" берем первые значения вне раздела "на 100г"
+    protein, fat, carbs = (
+        total if total is not None else (first if first is not None else 0.0)
+        for total, first in zip(totals, first_totals)
+    )
+    macros_per_100g = (per_100g[0], per_100g[1], per_100g[2]) if None not in per_100g else None
+    cleaned_text = '\n'.join(kept_lines) if has_explanations else text
+    return AnalysisResult(dish_name, weight, calories, calories_per_100g, protein, fat, carbs,
+                          macros_per_100g, cleaned_text, is_valid)
+
+
+@lru_cache(maxsize=2048)
+def _parse_cached(text: str) -> AnalysisResult:
+    return _parse_text(text)
+
+
+def parse_analysis(text: Optional[str]) -> Optional[AnalysisResult]:
+    """
+    Разбирает текст анализа (результат кэшируется по тексту)
+
+    Returns:
+        AnalysisResult или None для пустого текста
+    """
+    if not text or not isinstance(text, str):
+        return None
+    try:
+        return _parse_cached(text)
+    except Exception as e:
+        logger.error(f"Error parsing analysis: {e}")
+        return None
+
+
+def clean_markdown_text(text: str) -> str:
+    """Очищает текст от markdown разметки для отображения"""
+    if not text:
+        return ""
+    # Удаляем только markdown символы, сохраняя структуру текста
+    cleaned = text.replace('**', '').replace('__', '').replace('*', '').replace('_', '')
+    # Удаляем лишние пробелы ТОЛЬКО внутри строк, не трогая переносы
+    return '\n'.join(_MULTISPACE.sub(' ', line).strip() for line in cleaned.split('\n'))
@@ -1,12 +1,16 @@
 """
 Сервис для анализа еды через AI
 """
+import asyncio
 import logging
 import re
 from typing import Optional, Tuple
 from api_client import APIClient, api_client
+from performance_optimizations import AIOverloadedError, PRIORITY_DEFAULT, PRIORITY_CONFIRMATION
 from constants import MAX_IMAGE_SIZE
 from logging_config import get_logger
+from models.analysis import AnalysisResult
+from services.analysis_parser import parse_analysis, clean_markdown_text as clean_markdown
 
 logger = get_logger(__name__)
 
@@ -44,148 +48,50 @@ def extract_weight_from_description(description: str) -> Optional[float]:
 
 def extract_calories_per_100g_from_analysis(analysis_text: str) -> Optional[int]:
     """Извлекает калорийность на 100г из анализа"""
-    try:
-        # Ищем калорийность на 100г
-        patterns = [
-            r'Калорийность на 100г:\s*(\d+)\s*ккал',
-            r'на 100г:\s*(\d+)\s*ккал',
-            r'100г.*?(\d+)\s*ккал'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, analysis_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                calories = int(match.group(1))
-                if 0 < calories < 10000:  # Разумная проверка
-                    logger.info(f"Extracted calories per 100g: {calories} from pattern: {pattern}")
-                    return calories
-        
-        return None
-    except Exception as e:
-        logger.error(f"Error extracting calories per 100g: {e}")
-        return None
+    parsed = parse_analysis(analysis_text)
+    return parsed.calories_per_100g if parsed else None
 
 
 def extract_calories_from_analysis(analysis_text: str) -> Optional[int]:
     """Извлекает общую калорийность из анализа"""
-    try:
-        logger.info(f"Extracting calories from analysis text: {analysis_text[:100]}...")
-        
-        # Приоритетные паттерны
-        priority_patterns = [
-            # Точные паттерны с якорями
-            r'Калорийность:\s*(\d+)\s*ккал\s*$',
-            r'Общая калорийность:\s*(\d+)\s*ккал',
-            r'Калорийность блюда:\s*(\d+)\s*ккал',
-            r'Всего калорий:\s*(\d+)\s*ккал',
-        ]
-        
-        # Попытка извлечь по приоритетным паттернам
-        for pattern in priority_patterns:
-            match = re.search(pattern, analysis_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                calories = int(match.group(1))
-                if 0 < calories < 10000:
-                    logger.info(f"Extracted calories: {calories} from pattern: {pattern}")
-                    return calories
-        
-        # Запасные паттерны
-        fallback_patterns = [
-            r'калорийность.*?(\d+)\s*ккал',
-            r'(\d+)\s*ккал',
-        ]
-        
-        for pattern in fallback_patterns:
-            matches = re.findall(pattern, analysis_text, re.IGNORECASE)
-            if matches:
-                # Берем последнее значение (обычно это общая калорийность)
-                calories = int(matches[-1] if isinstance(matches[-1], str) else matches[-1][0])
-                if 0 < calories < 10000:
-                    logger.info(f"Extracted calories (fallback): {calories} from pattern: {pattern}")
-                    return calories
-        
+    parsed = parse_analysis(analysis_text)
+    if parsed is None or parsed.calories is None:
         logger.warning("Could not extract calories from analysis")
         return None
-        
-    except Exception as e:
-        logger.error(f"Error extracting calories: {e}")
-        return None
+    return parsed.calories
 
 
 def extract_macros_from_analysis(analysis_text: str) -> Tuple[int, float, float, float]:
     """Извлекает БЖУ из анализа ИИ - общие значения для всего блюда"""
-    try:
-        logger.info(f"Extracting macros from analysis text: {analysis_text[:100]}...")
-        
-        # Извлекаем калории
-        calories = extract_calories_from_analysis(analysis_text) or 0
-        
-        # Извлекаем БЖУ из раздела "Общее БЖУ в блюде" (это правильные значения для всего блюда)
-        protein = 0.0
-        fat = 0.0
-        carbs = 0.0
-        
-        # Ищем раздел "Общее БЖУ в блюде" и извлекаем из него значения
-        general_bju_match = re.search(r'📈 Общее БЖУ в блюде:(.*?)(?=\n\n|\Z|Обратите внимание)', analysis_text, re.IGNORECASE | re.DOTALL)
-        if general_bju_match:
-            general_bju_text = general_bju_match.group(1)
-            logger.info(f"Found general BJU section: {general_bju_text}")
-            
-            # Извлекаем белки из раздела "Общее БЖУ" - ищем первое число после "Белки:"
-            protein_match = re.search(r'• Белки:\s*([\d,]+(?:\.\d+)?)', general_bju_text)
-            if protein_match:
-                protein = float(protein_match.group(1).replace(',', '.'))
-                logger.info(f"Extracted protein from general BJU: {protein}")
-            
-            # Извлекаем жиры из раздела "Общее БЖУ" - ищем первое число после "Жиры:"
-            fat_match = re.search(r'• Жиры:\s*([\d,]+(?:\.\d+)?)', general_bju_text)
-            if fat_match:
-                fat = float(fat_match.group(1).replace(',', '.'))
-                logger.info(f"Extracted fat from general BJU: {fat}")
-            
-            # Извлекаем углеводы из раздела "Общее БЖУ" - ищем первое число после "Углеводы:"
-            carbs_match = re.search(r'• Углеводы:\s*([\d,]+(?:\.\d+)?)', general_bju_text)
-            if carbs_match:
-                carbs = float(carbs_match.group(1).replace(',', '.'))
-                logger.info(f"Extracted carbs from general BJU: {carbs}")
-        else:
-            logger.warning("No general BJU section found in analysis")
-        
-        # Если не нашли в разделе "Общее БЖУ", пробуем fallback паттерны
-        if protein == 0.0:
-            protein_match = re.search(r'• Белки:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
-            if protein_match:
-                protein = float(protein_match.group(1).replace(',', '.'))
-        
-        if fat == 0.0:
-            fat_match = re.search(r'• Жиры:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
-            if fat_match:
-                fat = float(fat_match.group(1).replace(',', '.'))
-        
-        if carbs == 0.0:
-            carbs_match = re.search(r'• Углеводы:\s*([\d,]+)г(?!.*?на 100г)', analysis_text, re.IGNORECASE)
-            if carbs_match:
-                carbs = float(carbs_match.group(1).replace(',', '.'))
-        
-        logger.info(f"Extracted macros (total for dish): {calories} kcal, {protein}g protein, {fat}g fat, {carbs}g carbs")
-        return calories, protein, fat, carbs
-        
-    except Exception as e:
-        logger.error(f"Error extracting macros from analysis: {e}")
-        return 0, 0.0, 0.0, 0.0
+    parsed = parse_analysis(analysis_text)
+    return parsed.macros if parsed else (0, 0.0, 0.0, 0.0)
+
+
+def extract_macros_per_100g_from_analysis(analysis_text: str) -> Optional[Tuple[float, float, float]]:
+    """Извлекает БЖУ на 100г из раздела "📊 БЖУ на 100г" """
+    parsed = parse_analysis(analysis_text)
+    return parsed.macros_per_100g if parsed else None
+
+
+def extract_total_weight_from_analysis(analysis_text: str) -> Optional[float]:
+    """Извлекает общий вес блюда из строки "Вес: Xг" анализа"""
+    parsed = parse_analysis(analysis_text)
+    return parsed.weight if parsed else None
+
+
+def build_analysis_result(dish_name: str, weight: float, calories: int,
+                          protein_100g: float, fat_100g: float, carbs_100g: float) -> AnalysisResult:
+    """Собирает результат анализа (с текстом в том же формате, что возвращает ИИ) по значениям на 100г"""
+    return AnalysisResult.from_per_100g(
+        dish_name, weight, calories, round(calories * 100 / weight) if weight else None,
+        protein_100g, fat_100g, carbs_100g
+    )
 
 
 def extract_dish_name_from_analysis(analysis_text: str) -> Optional[str]:
     """Извлекает название блюда из анализа"""
-    try:
-        pattern = r'Название:\s*(.+?)(?:\n|$)'
-        match = re.search(pattern, analysis_text)
-        if match:
-            return match.group(1).strip()
-        return None
-    except Exception as e:
-        logger.error(f"Error extracting dish name: {e}")
-        return None
+    parsed = parse_analysis(analysis_text)
+    return parsed.dish_name if parsed else None
 
 
 def parse_quantity_from_description(description: str) -> Tuple[float, str]:
@@ -225,54 +131,40 @@ def parse_quantity_from_description(description: str) -> Tuple[float, str]:
 
 def is_valid_analysis(analysis_text: str) -> bool:
     """Проверяет, валиден ли результат анализа"""
-    return bool(analysis_text and len(analysis_text) > 20 and ('калори' in analysis_text.lower() or 'ккал' in analysis_text.lower()))
+    parsed = parse_analysis(analysis_text)
+    return bool(parsed and parsed.is_valid)
 
 
 def clean_markdown_text(text: str) -> str:
     """Очищает текст от markdown разметки для отображения"""
-    if not text:
-        return ""
-    
-    # Удаляем только markdown символы, сохраняя структуру текста
-    cleaned = text.replace('**', '').replace('__', '').replace('*', '').replace('_', '')
-    
-    # Удаляем лишние пробелы ТОЛЬКО внутри строк, не трогая переносы
-    lines = cleaned.split('\n')
-    cleaned_lines = [re.sub(r'  +', ' ', line).strip() for line in lines]
-    
-    return '\n'.join(cleaned_lines)
+    return clean_markdown(text)
 
 
 def remove_explanations_from_analysis(text: str) -> str:
     """Удаляет пояснения из анализа, оставляя только данные"""
-    if not text:
-        return ""
-    
-    # Удаляем строки с пояснениями
-    lines = text.split('\n')
-    filtered_lines = []
-    
-    skip_patterns = [
-        r'примечани',
-        r'рекомендац',
-        r'совет',
-        r'обрати внимание',
-        r'важно',
-    ]
-    
-    for line in lines:
-        # Пропускаем строки с пояснениями
-        if any(re.search(pattern, line.lower()) for pattern in skip_patterns):
-            continue
-        filtered_lines.append(line)
-    
-    return '\n'.join(filtered_lines)
+    parsed = parse_analysis(text)
+    return parsed.text if parsed else ""
 
 
 # ==================== AI ANALYSIS FUNCTIONS ====================
 
-async def analyze_food_photo(image_data: bytes):
-    """Анализирует фото еды через AI"""
+async def get_cached_photo_analysis(file_unique_id: str) -> Optional[AnalysisResult]:
+    """Возвращает ранее полученный анализ фото по file_unique_id (без скачивания)"""
+    try:
+        return await api_client.get_cached_by_file_id(file_unique_id)
+    except Exception as e:
+        logger.error(f"Error reading cached photo analysis: {e}")
+        return None
+
+
+async def analyze_food_photo(image_data: bytes, file_unique_id: str = None, user_id: int = None,
+                             priority: int = PRIORITY_DEFAULT, on_queue_position=None,
+                             on_partial_text=None) -> Optional[AnalysisResult]:
+    """
+    Анализирует фото еды через AI
+    
+    on_queue_position получает позицию в очереди к модели, on_partial_text - текст ответа по мере генерации
+    """
     try:
         # Валидация размера изображения
         if not image_data:
@@ -286,17 +178,55 @@ async def analyze_food_photo(image_data: bytes):
         logger.info("Starting food photo analysis...")
         
         async with api_client:
-            result = await api_client.analyze_image(image_data)
+            result = await api_client.analyze_image(
+                image_data, file_unique_id=file_unique_id, user_id=user_id,
+                priority=priority, on_queue_position=on_queue_position, on_partial_text=on_partial_text
+            )
         
-        logger.info(f"Photo analysis successful, result length: {len(result) if result else 0}")
+        logger.info(f"Photo analysis successful, calories: {result.calories if result else None}")
         return result
         
+    except AIOverloadedError:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing food photo: {e}")
         return None
 
 
-async def analyze_food_photo_with_text(image_data: bytes, user_text: str):
+async def analyze_food_photos(images: list, description: str = None, user_id: int = None,
+                              priority: int = PRIORITY_DEFAULT, on_queue_position=None,
+                              on_partial_text=None) -> Optional[AnalysisResult]:
+    """
+    Анализирует альбом - несколько фото одного приема пищи - одним запросом к AI
+    
+    description - подпись к альбому, учитывается как уточнение пользователя
+    """
+    try:
+        if not images:
+            logger.error("Empty album provided")
+            return None
+        
+        description = description.strip()[:MAX_TEXT_LENGTH] if description else None
+        logger.info(f"Starting album analysis: {len(images)} photos, description={bool(description)}")
+        
+        async with api_client:
+            result = await api_client.analyze_images(
+                images, description=description, user_id=user_id, priority=priority,
+                on_queue_position=on_queue_position, on_partial_text=on_partial_text
+            )
+        
+        logger.info(f"Album analysis finished, calories: {result.calories if result else None}")
+        return result
+        
+    except AIOverloadedError:
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing album: {e}")
+        return None
+
+
+async def analyze_food_photo_with_text(image_data: bytes, user_text: str, user_id: int = None,
+                                       priority: int = PRIORITY_DEFAULT, on_partial_text=None) -> Optional[AnalysisResult]:
     """Анализирует фото + текст пользователя для уточненного анализа"""
     try:
         # Валидация входных данных
@@ -320,17 +250,22 @@ async def analyze_food_photo_with_text(image_data: bytes, user_text: str):
         logger.info(f"Starting photo+text analysis: image_size={len(image_data)} bytes, text='{user_text[:50]}...'")
         
         async with api_client:
-            result = await api_client.analyze_photo_with_text(image_data, user_text)
+            result = await api_client.analyze_photo_with_text(
+                image_data, user_text, user_id=user_id, priority=priority, on_partial_text=on_partial_text
+            )
         
-        logger.info(f"Photo+text analysis successful, result length: {len(result) if result else 0}")
+        logger.info(f"Photo+text analysis successful, calories: {result.calories if result else None}")
         return result
         
+    except AIOverloadedError:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing photo with text: {e}")
         return None
 
 
-async def analyze_food_text(description: str):
+async def analyze_food_text(description: str, user_id: int = None, priority: int = PRIORITY_DEFAULT,
+                            on_partial_text=None) -> Optional[AnalysisResult]:
     """Анализирует текстовое описание еды через AI"""
     try:
         # Валидация входных данных
@@ -350,39 +285,75 @@ async def analyze_food_text(description: str):
         
         logger.info(f"Starting text analysis for description: {description[:50]}...")
         
+        # Варианты того же продукта с другим количеством считаем локально
+        from services.text_analysis_cache import text_analysis_cache
+        from services.food_knowledge_base import food_knowledge_base
+        cached_result = await text_analysis_cache.get(description)
+        if cached_result:
+            food_knowledge_base.record_request('cache')
+            return cached_result
+        
+        # Известные продукты отвечаем из локальной базы
+        if not food_knowledge_base.loaded:
+            await asyncio.to_thread(food_knowledge_base.ensure_loaded)
+        local_result = food_knowledge_base.lookup(description)
+        if local_result:
+            food_knowledge_base.record_request('knowledge_base')
+            return local_result
+        
         async with api_client:
-            result = await api_client.analyze_text(description)
+            result = await api_client.analyze_text(
+                description, user_id=user_id, priority=priority, on_partial_text=on_partial_text
+            )
+        food_knowledge_base.record_request('api')
         
-        logger.info(f"Text analysis successful, result length: {len(result) if result else 0}")
+        if result and result.is_valid:
+            text_analysis_cache.store(description, result)
+        
+        logger.info(f"Text analysis successful, calories: {result.calories if result else None}")
         return result
         
+    except AIOverloadedError:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing food text: {e}")
         return None
 
 
-async def analyze_food_supplement(combined_prompt: str):
-    """Анализирует комбинированный промпт для дополнения анализа фото"""
+async def analyze_food_supplement(previous_result: str, additional_text: str,
+                                  user_id: int = None) -> Optional[AnalysisResult]:
+    """
+    Уточняет показанный анализ по дополнению пользователя
+
+    Args:
+        previous_result: Краткое представление показанного анализа (PendingAnalysis.to_prompt)
+        additional_text: Уточнение пользователя
+    """
     try:
         # Валидация входных данных
-        if not combined_prompt or not isinstance(combined_prompt, str):
-            logger.error(f"Invalid combined prompt provided: type={type(combined_prompt)}, value='{combined_prompt}'")
+        if not previous_result or not isinstance(previous_result, str):
+            logger.error(f"Invalid previous result provided: type={type(previous_result)}, value='{previous_result}'")
             return None
         
-        # Для дополнительного текста к фото используем более мягкую валидацию
-        if len(combined_prompt.strip()) < 3:
-            logger.error(f"Combined prompt too short: length={len(combined_prompt.strip())}, content='{combined_prompt.strip()}'")
+        # Для дополнительного текста используем более мягкую валидацию
+        if not additional_text or len(additional_text.strip()) < 3:
+            logger.error(f"Supplement text too short: '{additional_text}'")
             return None
             
         logger.info("Starting food supplement analysis...")
         
-        # Используем текстовый API endpoint для дополнений
+        # Пользователь уже ждет уточнения показанного анализа,
+        # поэтому запрос встает в начало очереди к модели
         async with api_client:
-            result = await api_client.analyze_text(combined_prompt)
+            result = await api_client.analyze_supplement(
+                previous_result, additional_text.strip(), user_id=user_id, priority=PRIORITY_CONFIRMATION
+            )
         
-        logger.info(f"Supplement analysis successful, result length: {len(result) if result else 0}")
+        logger.info(f"Supplement analysis successful, calories: {result.calories if result else None}")
         return result
         
+    except AIOverloadedError:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing food supplement: {e}")
         return None
@@ -0,0 +1,207 @@
+"""
+Локальная база продуктов, пополняемая подтвержденными анализами
+
+Значения на 100г хранятся в таблице food_items, в памяти строится триграммный
+индекс названий, чтобы уверенные совпадения отвечать без обращения к ИИ. Локально
+отвечаем только по продуктам, которые подтвердили несколько разных пользователей
+(или из начальных данных): одно подтверждение не становится ответом для всех.
+"""
+import asyncio
+import json
+import os
+import threading
+from typing import Optional, Dict, Any, Set, FrozenSet, Tuple
+from config import FOOD_SEED_PATH, FOOD_KB_MIN_SIMILARITY, FOOD_KB_MIN_CONFIRMATIONS
+from database import upsert_food_item, get_food_item, get_all_food_items
+from logging_config import get_logger
+from models.analysis import AnalysisResult
+from services.food_analysis_service import build_analysis_result
+from services.text_analysis_cache import (
+    normalize_food_name,
+    canonicalize_food_description,
+    extract_per_100g_values,
+)
+
+logger = get_logger(__name__)
+
+def _trigrams(name: str) -> Set[str]:
+    """Триграммы названия с отступами по краям"""
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class FoodKnowledgeBase:
+    """Триграммный индекс продуктов поверх таблицы food_items"""
+
+    def __init__(self, min_similarity: float = 0.8, min_confirmations: int = 3):
+        self.min_similarity = min_similarity
+        self.min_confirmations = min_confirmations
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.trigram_index: Dict[str, FrozenSet[str]] = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+        # Фоновые задачи learn_in_background (ссылки держим до завершения)
+        self._pending: Set[asyncio.Task] = set()
+        # Источник ответа на каждый текстовый запрос
+        self.request_stats = {'cache': 0, 'knowledge_base': 0, 'api': 0}
+
+    def _index_item(self, item: Dict[str, Any]):
+        """
+        Добавляет продукт в индекс (вызывается под блокировкой)
+        
+        learn работает в пуле потоков, а find - в event loop без блокировки: множества
+        триграмм не изменяются на месте, а заменяются новыми.
+        """
+        name = item['name']
+        if name not in self.items:
+            for trigram in _trigrams(name):
+                self.trigram_index[trigram] = self.trigram_index.get(trigram, frozenset()) | {name}
+        self.items[name] = item
+
+    def is_trusted(self, item: Dict[str, Any]) -> bool:
+        """Продукт из начальных данных или подтвержденный достаточным числом разных пользователей"""
+        return item.get('source') == 'seed' or (item.get('confirmed_users') or 0) >= self.min_confirmations
+
+    def import_seed_file(self, path: str) -> int:
+        """Импортирует начальные данные из JSON-списка {name, calories_100g, protein_100g, fat_100g, carbs_100g}"""
+        try:
+            with open(path, 'r', encoding='utf-8') as seed_file:
+                records = json.load(seed_file)
+        except Exception as e:
+            logger.error(f"Failed to read food seed file {path}: {e}")
+            return 0
+
+        imported = 0
+        for record in records:
+            try:
+                name = normalize_food_name(record['name'])
+                if name and upsert_food_item(
+                    name, record['name'], float(record['calories_100g']),
+                    float(record.get('protein_100g', 0)), float(record.get('fat_100g', 0)),
+                    float(record.get('carbs_100g', 0)), source='seed'
+                ):
+                    imported += 1
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping invalid seed record {record}: {e}")
+        logger.info(f"Imported {imported} food items from seed file {path}")
+        return imported
+
+    def ensure_loaded(self):
+        """Загружает таблицу в память при первом обращении"""
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            if FOOD_SEED_PATH and os.path.exists(FOOD_SEED_PATH):
+                self.import_seed_file(FOOD_SEED_PATH)
+            for item in get_all_food_items():
+                self._index_item(item)
+            self.loaded = True
+            logger.info(f"Food knowledge base loaded: {len(self.items)} items")
+
+    def find(self, name: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """Ищет продукт по нормализованному названию; возвращает (сходство, продукт)"""
+        if not name:
+            return None
+        item = self.items.get(name)
+        if item is not None:
+            return 1.0, item
+
+        # Сходство Жаккара по триграммам: считаем общие триграммы для каждого кандидата
+        query = _trigrams(name)
+        shared: Dict[str, int] = {}
+        for trigram in query:
+            for candidate in self.trigram_index.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        if not shared:
+            return None
+
+        best_name, best_score = None, 0.0
+        for candidate, common in shared.items():
+            score = common / (len(query) + len(_trigrams(candidate)) - common)
+            if score > best_score:
+                best_name, best_score = candidate, score
+        return best_score, self.items[best_name]
+
+    def lookup(self, description: str) -> Optional[AnalysisResult]:
+        """Возвращает анализ для описания с весом, если продукт уверенно найден в базе"""
+        canonical = canonicalize_food_description(description)
+        if canonical is None:
+            return None
+        key, amount = canonical
+        name = key.split(':', 1)[1]
+
+        match = self.find(name)
+        if match is None or match[0] < self.min_similarity:
+            return None
+        similarity, item = match
+        if not self.is_trusted(item):
+            logger.debug(f"Knowledge base item '{item['name']}' has {item.get('confirmed_users') or 0} confirmations, asking AI")
+            return None
+
+        logger.info(f"Text analysis served from knowledge base: '{name}' -> '{item['name']}' (similarity {similarity:.2f})")
+        return build_analysis_result(
+            item['display_name'],
+            amount,
+            round(item['calories_100g'] * amount / 100),
+            round(item['protein_100g'], 1),
+            round(item['fat_100g'], 1),
+            round(item['carbs_100g'], 1),
+        )
+
+    def learn(self, analysis: AnalysisResult, description: Optional[str] = None,
+              telegram_id: Optional[int] = None) -> bool:
+        """
+        Сохраняет значения на 100г из подтвержденного анализа (по названию блюда и описанию)
+        
+        Обращается к SQLite - из обработчиков вызывайте learn_in_background.
+        """
+        try:
+            values = extract_per_100g_values(analysis)
+            dish_name = analysis.dish_name
+            if values is None or not dish_name:
+                return False
+
+            names = {normalize_food_name(dish_name)}
+            if description:
+                names.add(normalize_food_name(description))
+            names.discard('')
+
+            for name in names:
+                if upsert_food_item(name, dish_name, values['calories_100g'], values['protein_100g'],
+                                    values['fat_100g'], values['carbs_100g'], telegram_id=telegram_id):
+                    item = get_food_item(name)
+                    if item:
+                        with self._lock:
+                            self._index_item(item)
+            return True
+        except Exception as e:
+            logger.error(f"Error learning food item: {e}")
+            return False
+
+    def learn_in_background(self, analysis: AnalysisResult, description: Optional[str] = None,
+                            telegram_id: Optional[int] = None):
+        """Запускает learn в пуле потоков, не задерживая ответ пользователю"""
+        task = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(self.learn, analysis, description, telegram_id)
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def record_request(self, source: str):
+        """Учитывает, откуда был получен ответ на текстовый запрос: cache, knowledge_base или api"""
+        self.request_stats[source] = self.request_stats.get(source, 0) + 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает размер базы и долю текстовых запросов, обслуженных локально"""
+        total = sum(self.request_stats.values())
+        local = self.request_stats['cache'] + self.request_stats['knowledge_base']
+        return {
+            'items': len(self.items),
+            'requests': dict(self.request_stats),
+            'local_fraction': local / total if total else 0.0
+        }
+
+# Глобальный экземпляр базы продуктов
+food_knowledge_base = FoodKnowledgeBase(min_similarity=FOOD_KB_MIN_SIMILARITY,
+                                        min_confirmations=FOOD_KB_MIN_CONFIRMATIONS)
@@ -0,0 +1,146 @@
+"""
+Анализ блюда, ожидающий подтверждения пользователем
+
+Ответ ИИ разбирается один раз - в клиенте API, обработчик получает готовый
+AnalysisResult. В context.user_data хранится компактный PendingAnalysis: сам результат,
+числа для записи в базу и готовый текст для показа. Подтверждение - только запись в
+базу, дополнение применяет уточненный AnalysisResult без разбора текста.
+"""
+from typing import Optional, Tuple, MutableMapping, Any
+from models.analysis import AnalysisResult, EMPTY_ANALYSIS
+from services.analysis_parser import parse_analysis
+
+# Ключ в context.user_data
+PENDING_ANALYSIS_KEY = 'pending_analysis'
+
+
+class PendingAnalysis:
+    """Числа анализа для записи в базу и текст для показа пользователю"""
+
+    __slots__ = (
+        'result', 'analysis_text', 'display_text', 'source', 'dish_name', 'weight',
+        'calories', 'protein', 'fat', 'carbs', 'description', 'initial_calories', 'supplemented'
+    )
+
+    def __init__(self, result: AnalysisResult, analysis_text: str, display_text: str, source: str,
+                 dish_name: str, weight: Optional[float], calories: int, protein: float, fat: float,
+                 carbs: float, description: Optional[str] = None, initial_calories: Optional[int] = None,
+                 supplemented: bool = False):
+        # result - последний результат ИИ (для базы продуктов), analysis_text - его текст,
+        # display_text - то, что видит пользователь (с блоком дополнений)
+        self.result = result
+        self.analysis_text = analysis_text
+        self.display_text = display_text
+        self.source = source
+        self.dish_name = dish_name
+        self.weight = weight
+        self.calories = calories
+        self.protein = protein
+        self.fat = fat
+        self.carbs = carbs
+        self.description = description
+        self.initial_calories = calories if initial_calories is None else initial_calories
+        self.supplemented = supplemented
+
+    @classmethod
+    def from_result(cls, result: AnalysisResult, source: str, default_dish_name: str,
+                    description: Optional[str] = None, calories: Optional[int] = None,
+                    analysis_text: Optional[str] = None) -> "PendingAnalysis":
+        """
+        Собирает ожидающий анализ из результата ИИ
+
+        Args:
+            result: Результат анализа
+            source: Тип анализа для статистики ('photo', 'text', 'photo_text', 'voice')
+            default_dish_name: Название, если в анализе его нет
+            description: Исходное описание пользователя (для базы продуктов)
+            calories: Калории, вычисленные обработчиком (например, по весу из описания)
+            analysis_text: Текст для показа, если он отличается от текста результата
+        """
+        text = analysis_text if analysis_text is not None else result.text
+        return cls(
+            result, text, text, source,
+            result.dish_name or default_dish_name, result.weight,
+            calories if calories is not None else (result.calories or 0),
+            result.protein, result.fat, result.carbs, description
+        )
+
+    @classmethod
+    def from_analysis(cls, analysis_text: str, source: str, default_dish_name: str,
+                      description: Optional[str] = None, calories: Optional[int] = None) -> "PendingAnalysis":
+        """Собирает ожидающий анализ из текста, составленного обработчиком (например, фото + текст)"""
+        result = parse_analysis(analysis_text) or EMPTY_ANALYSIS
+        return cls.from_result(result, source, default_dish_name, description, calories, analysis_text)
+
+    @property
+    def macros(self) -> Tuple[int, float, float, float]:
+        """(калории, белки, жиры, углеводы) для записи в базу"""
+        return self.calories, self.protein, self.fat, self.carbs
+
+    @property
+    def calories_display(self) -> str:
+        """Калорийность для показа: после дополнения - с исходным значением"""
+        if self.supplemented and self.calories != self.initial_calories:
+            return f"{self.initial_calories} → {self.calories} ккал"
+        return f"{self.calories} ккал"
+
+    def to_prompt(self) -> str:
+        """Краткое представление для уточняющего запроса: только числа, без текста анализа"""
+        parts = [f"блюдо: {self.dish_name}"]
+        if self.description:
+            parts.append(f"описание: {self.description}")
+        if self.weight:
+            parts.append(f"вес: {self.weight:g}г")
+        parts.append(f"калорийность: {self.calories} ккал")
+        parts.append(f"белки/жиры/углеводы: {self.protein:g}/{self.fat:g}/{self.carbs:g}г")
+        return "; ".join(parts)
+
+    def supplement(self, additional_text: str, refined: AnalysisResult, replace_display: bool = False) -> bool:
+        """
+        Применяет уточненный расчет ИИ
+
+        Args:
+            additional_text: Уточнения пользователя
+            refined: Результат ИИ с уточненным расчетом
+            replace_display: Показывать только уточненный анализ вместо исходного с дополнениями
+
+        Returns:
+            True, если в уточненном расчете найдены калории и числа обновлены
+        """
+        refined_text = refined.text
+        updated = bool(refined.calories)
+        if updated:
+            self.result = refined
+            self.dish_name = refined.dish_name or self.dish_name
+            self.weight = refined.weight or self.weight
+            self.calories, self.protein, self.fat, self.carbs = refined.macros
+            self.analysis_text = refined_text
+        if replace_display:
+            self.display_text = refined_text
+        else:
+            self.display_text = (
+                f"{self.display_text}\n\n**📝 Дополнения:**\n{additional_text}"
+                f"\n\n**🔄 Уточненный расчет:**\n{refined_text}"
+            )
+        self.supplemented = True
+        return updated
+
+    def __repr__(self) -> str:
+        return (f"PendingAnalysis(source={self.source!r}, dish_name={self.dish_name!r}, "
+                f"macros={self.macros}, supplemented={self.supplemented})")
+
+
+def store_pending_analysis(user_data: MutableMapping[str, Any], pending: PendingAnalysis) -> PendingAnalysis:
+    """Сохраняет анализ до подтверждения"""
+    user_data[PENDING_ANALYSIS_KEY] = pending
+    return pending
+
+
+def get_pending_analysis(user_data: MutableMapping[str, Any]) -> Optional[PendingAnalysis]:
+    """Возвращает ожидающий подтверждения анализ"""
+    return user_data.get(PENDING_ANALYSIS_KEY)
+
+
+def pop_pending_analysis(user_data: MutableMapping[str, Any]) -> Optional[PendingAnalysis]:
+    """Забирает анализ из состояния пользователя (подтверждение или отмена)"""
+    return user_data.pop(PENDING_ANALYSIS_KEY, None)
@@ -0,0 +1,203 @@
+"""
+Скачивание файлов пользователей из Telegram (фото и голосовые)
+
+Все обработчики скачивают файлы через один сервис: запросы идут через общую
+HTTP-сессию api_client (пул соединений, keep-alive), файл читается потоком в
+заранее выделенный буфер, а загрузка прерывается, как только превышен лимит
+размера или первые байты не похожи на ожидаемый формат. Число одновременных
+загрузок ограничено, задержка каждой загрузки попадает в статистику.
+"""
+import asyncio
+import time
+from collections import defaultdict, deque
+from typing import Optional, Dict, Any, Deque
+import aiohttp
+from telegram.error import TelegramError
+from api_client import api_client
+from config import TELEGRAM_DOWNLOAD_CONCURRENCY
+from logging_config import get_logger
+from resilience import percentile
+
+logger = get_logger(__name__)
+
+# Размер порции при потоковом скачивании
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Сколько первых байт нужно для определения формата
+SIGNATURE_SIZE = 12
+
+
+def is_image_signature(prefix: bytes) -> bool:
+    """JPEG, PNG, WebP или GIF по первым байтам файла"""
+    return (
+        prefix.startswith(b'\xff\xd8\xff')  # JPEG
+        or prefix.startswith(b'\x89PNG\r\n\x1a\n')  # PNG
+        or (prefix.startswith(b'RIFF') and prefix[8:12] == b'WEBP')  # WebP
+        or prefix.startswith((b'GIF87a', b'GIF89a'))  # GIF
+    )
+
+
+def is_audio_signature(prefix: bytes) -> bool:
+    """OGG (голосовые Telegram), MP3, WAV или M4A по первым байтам файла"""
+    return (
+        prefix.startswith(b'OggS')
+        or prefix.startswith(b'ID3') or prefix[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2')  # MP3
+        or (prefix.startswith(b'RIFF') and prefix[8:12] == b'WAVE')
+        or prefix[4:8] == b'ftyp'  # M4A/MP4
+    )
+
+
+SIGNATURE_CHECKS = {
+    'photo': is_image_signature,
+    'voice': is_audio_signature,
+}
+
+
+class FileDownloadError(Exception):
+    """
+    Файл не скачан
+
+    reason: 'status' (Telegram вернул ошибку), 'too_large' (превышен лимит размера),
+    'invalid_format' (первые байты не совпали с ожидаемым форматом), 'network'
+    """
+
+    def __init__(self, reason: str, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+
+
+class DownloadStats:
+    """Задержка и исходы загрузок одного типа файлов (скользящее окно последних загрузок)"""
+
+    def __init__(self, window: int = 200):
+        self.downloads = 0
+        self.total_bytes = 0
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.waits: Deque[float] = deque(maxlen=window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'downloads': self.downloads,
+            'failures': dict(self.failures),
+            'avg_bytes': self.total_bytes / self.downloads if self.downloads else 0.0,
+            'p50': percentile(self.latencies, 0.5),
+            'p95': percentile(self.latencies, 0.95),
+            'p95_wait': percentile(self.waits, 0.95),
+        }
+
+
+class TelegramFileService:
+    """Потоковое скачивание файлов Telegram с лимитом размера и проверкой формата"""
+
+    def __init__(self, max_concurrent: int = 8, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        self.max_concurrent = max(1, max_concurrent)
+        self.chunk_size = chunk_size
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.in_progress = 0
+        self._stats: Dict[str, DownloadStats] = {}
+
+    def _kind_stats(self, kind: str) -> DownloadStats:
+        if kind not in self._stats:
+            self._stats[kind] = DownloadStats()
+        return self._stats[kind]
+
+    @staticmethod
+    def _file_url(bot, file_path: str) -> str:
+        """Полный адрес файла; токен бота в нем есть, поэтому адрес не логируется"""
+        if file_path.startswith(('https://', 'http://')):
+            return file_path
+        return f"{bot.base_file_url}/{file_path}"
+
+    async def download(self, bot, file_id: str, kind: str, max_size: int,
+                       file_size: Optional[int] = None) -> bytes:
+        """
+        Скачивает файл Telegram в память
+
+        Args:
+            bot: Бот приложения (для get_file)
+            file_id: Идентификатор файла Telegram
+            kind: Тип файла для проверки формата и статистики ('photo', 'voice')
+            max_size: Максимальный размер файла в байтах
+            file_size: Размер из сообщения Telegram - файл больше лимита не запрашивается вовсе
+
+        Raises:
+            FileDownloadError: файл недоступен, слишком большой или неожиданного формата
+        """
+        stats = self._kind_stats(kind)
+        if file_size and file_size > max_size:
+            stats.failures['too_large'] += 1
+            raise FileDownloadError('too_large', f"{kind} file too large: {file_size} bytes")
+
+        queued = time.perf_counter()
+        async with self._semaphore:
+            started = time.perf_counter()
+            stats.waits.append(started - queued)
+            self.in_progress += 1
+            try:
+                telegram_file = await bot.get_file(file_id)
+                data = await self._read(self._file_url(bot, telegram_file.file_path), kind, max_size,
+                                        telegram_file.file_size or file_size)
+            except FileDownloadError as e:
+                stats.failures[e.reason] += 1
+                logger.error(f"Failed to download {kind} {file_id}: {e}")
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                stats.failures['network'] += 1
+                logger.error(f"Failed to download {kind} {file_id}: {type(e).__name__}: {e}")
+                raise FileDownloadError('network', f"{type(e).__name__}: {e}") from e
+            except TelegramError as e:
+                stats.failures['status'] += 1
+                logger.error(f"get_file failed for {kind} {file_id}: {e}")
+                raise FileDownloadError('status', str(e)) from e
+            finally:
+                self.in_progress -= 1
+
+        elapsed = time.perf_counter() - started
+        stats.downloads += 1
+        stats.total_bytes += len(data)
+        stats.latencies.append(elapsed)
+        logger.info(f"Downloaded {kind} {file_id}: {len(data)} bytes in {elapsed * 1000:.0f}ms")
+        return data
+
+    async def _read(self, url: str, kind: str, max_size: int, size_hint: Optional[int]) -> bytes:
+        """Читает тело ответа порциями в буфер, выделенный по известному размеру"""
+        async with api_client:
+            async with api_client.session.get(url) as response:
+                if response.status != 200:
+                    raise FileDownloadError('status', f"HTTP {response.status}", response.status)
+                size_hint = response.content_length or size_hint
+                if size_hint and size_hint > max_size:
+                    raise FileDownloadError('too_large', f"{kind} file too large: {size_hint} bytes")
+
+                check_signature = SIGNATURE_CHECKS.get(kind)
+                buffer = bytearray(size_hint or 0)
+                filled = 0
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    end = filled + len(chunk)
+                    if end > max_size:
+                        raise FileDownloadError('too_large', f"{kind} file too large: more than {max_size} bytes")
+                    # Срез за пределами буфера просто удлиняет его
+                    buffer[filled:end] = chunk
+                    if check_signature and filled < SIGNATURE_SIZE <= end:
+                        if not check_signature(bytes(buffer[:SIGNATURE_SIZE])):
+                            raise FileDownloadError('invalid_format', f"unexpected {kind} signature")
+                    filled = end
+
+                if check_signature and filled < SIGNATURE_SIZE and not check_signature(bytes(buffer[:filled])):
+                    raise FileDownloadError('invalid_format', f"unexpected {kind} signature")
+                del buffer[filled:]
+                return bytes(buffer)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика загрузок по типам файлов"""
+        return {
+            'max_concurrent': self.max_concurrent,
+            'in_progress': self.in_progress,
+            'kinds': {kind: stats.get_stats() for kind, stats in self._stats.items()},
+        }
+
+
+# Глобальный экземпляр сервиса
+telegram_files = TelegramFileService(TELEGRAM_DOWNLOAD_CONCURRENCY)
@@ -0,0 +1,179 @@
+"""
+Кэш текстовых анализов с нормализацией описания и пересчетом на количество
+
+"200г гречки", "гречка 200 гр" и "300г гречки" сводятся к одному ключу,
+в кэше хранятся значения на 100г, а ответ для нужного веса собирается локально.
+"""
+import re
+from typing import Optional, Dict, Any, Tuple
+from models.analysis import AnalysisResult
+from cache_manager import CacheManager, TwoTierCache, shared_cache_backend
+from config import ANALYSIS_OUTPUT_FORMAT
+from prompts import prompt_registry
+from logging_config import get_logger
+from services.food_analysis_service import parse_quantity_from_description, build_analysis_result
+
+logger = get_logger(__name__)
+
+# Количество с единицей массы/объема - вырезается из описания при нормализации
+QUANTITY_TOKEN_PATTERN = re.compile(
+    r'\d+(?:[.,]\d+)?\s*(?:килограмм\w*|кг|kg|грамм\w*|гр|г|gram\w*|миллилитр\w*|мл|ml|литр\w*|л|liter\w*)\b\.?',
+    re.IGNORECASE
+)
+WORD_PATTERN = re.compile(r'[а-яa-z]+')
+
+# Слова, не влияющие на состав блюда
+STOP_WORDS = {
+    'и', 'с', 'со', 'в', 'во', 'на', 'из', 'по', 'для', 'без', 'около', 'примерно',
+    'порция', 'порции', 'тарелка', 'тарелки', 'грамм', 'граммов', 'гр', 'г', 'мл',
+}
+
+# Окончания для грубого стемминга (от длинных к коротким)
+WORD_ENDINGS = (
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ых', 'их', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев',
+    'ы', 'и', 'а', 'я', 'у', 'ю', 'е', 'о', 'ь', 'й',
+)
+
+# Единицы, для которых возможен пересчет: единица -> (множитель к г/мл, семейство)
+SCALABLE_UNITS = {
+    'г': (1, 'g'),
+    'кг': (1000, 'g'),
+    'мл': (1, 'ml'),
+    'л': (1000, 'ml'),
+}
+
+def _stem(word: str) -> str:
+    """Отбрасывает типичное окончание, оставляя основу не короче 3 букв"""
+    for ending in WORD_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def normalize_food_name(text: str) -> str:
+    """Нормализует название: нижний регистр, без количеств и служебных слов, основы слов по алфавиту"""
+    text = QUANTITY_TOKEN_PATTERN.sub(' ', text.lower().replace('ё', 'е'))
+    tokens = sorted({_stem(word) for word in WORD_PATTERN.findall(text) if word not in STOP_WORDS})
+    return ' '.join(tokens)
+
+def canonicalize_food_description(description: str) -> Optional[Tuple[str, float]]:
+    """
+    Приводит описание к каноническому ключу
+
+    Returns:
+        (ключ, количество в г/мл) или None, если описание нельзя пересчитывать
+        (нет веса/объема, несколько количеств, остались другие числа)
+    """
+    if not description:
+        return None
+
+    text = description.lower().replace('ё', 'е')
+    quantity, unit = parse_quantity_from_description(text)
+    if unit not in SCALABLE_UNITS:
+        return None
+
+    # Количество должно быть ровно одно, иначе состав неоднозначен
+    if len(QUANTITY_TOKEN_PATTERN.findall(text)) != 1:
+        return None
+    remainder = QUANTITY_TOKEN_PATTERN.sub(' ', text)
+    if re.search(r'\d', remainder):
+        return None
+
+    name = normalize_food_name(remainder)
+    if not name:
+        return None
+
+    multiplier, family = SCALABLE_UNITS[unit]
+    amount = quantity * multiplier
+    if amount <= 0:
+        return None
+    return f"{family}:{name}", amount
+
+def extract_per_100g_values(analysis: AnalysisResult, fallback_weight: Optional[float] = None) -> Optional[Dict[str, float]]:
+    """Калории и БЖУ на 100г; при отсутствии блока на 100г пересчитывает итог по весу"""
+    calories, protein, fat, carbs = analysis.macros
+    # База для пересчета - вес, на который ИИ посчитал итог
+    weight = analysis.weight or fallback_weight
+    if not weight:
+        return None
+
+    calories_100g = analysis.calories_per_100g
+    if not calories_100g:
+        if not calories:
+            return None
+        calories_100g = calories * 100 / weight
+
+    per_100g = analysis.macros_per_100g
+    if per_100g is None:
+        per_100g = tuple(round(value * 100 / weight, 1) for value in (protein, fat, carbs))
+
+    return {
+        'calories_100g': calories_100g,
+        'protein_100g': per_100g[0],
+        'fat_100g': per_100g[1],
+        'carbs_100g': per_100g[2],
+    }
+
+def _storage_key(canonical_key: str) -> str:
+    """Ключ хранилища с версией промпта анализа текста - смена промпта сбрасывает кэш"""
+    return f"{prompt_registry.analysis('text', ANALYSIS_OUTPUT_FORMAT).cache_tag}:{canonical_key}"
+
+class TextAnalysisCache:
+    """Кэш значений на 100г по каноническому описанию блюда"""
+
+    def __init__(self, default_ttl: int = 86400, max_size: int = 1000):
+        self.storage = TwoTierCache(
+            'text_analysis', CacheManager(default_ttl=default_ttl, max_size=max_size), shared_cache_backend
+        )
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, description: str) -> Optional[AnalysisResult]:
+        """Возвращает анализ, пересчитанный на количество из описания, или None"""
+        canonical = canonicalize_food_description(description)
+        if canonical is None:
+            return None
+        key, amount = canonical
+
+        entry = await self.storage.aget(_storage_key(key))
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        logger.info(f"Text analysis served from cache: '{key}' scaled to {amount:g}")
+        return build_analysis_result(
+            entry['dish_name'],
+            amount,
+            round(entry['calories_100g'] * amount / 100),
+            entry['protein_100g'],
+            entry['fat_100g'],
+            entry['carbs_100g'],
+        )
+
+    def store(self, description: str, analysis: AnalysisResult) -> bool:
+        """Сохраняет значения на 100г из ответа ИИ"""
+        canonical = canonicalize_food_description(description)
+        if canonical is None:
+            return False
+        key, amount = canonical
+
+        values = extract_per_100g_values(analysis, amount)
+        if values is None:
+            return False
+        values['dish_name'] = analysis.dish_name or description[:50]
+        self.storage.set(_storage_key(key), values)
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику попаданий"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.storage.local.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# Глобальный экземпляр кэша текстовых анализов
+text_analysis_cache = TextAnalysisCache()
@@ -0,0 +1,150 @@
+"""
+Перцептивное хэширование изображений для поиска почти одинаковых фото еды
+"""
+import io
+from typing import Optional, Dict, Any, List, Tuple
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Pillow нужен только для декодирования изображения, без него индекс просто не используется
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def is_available() -> bool:
+    """Проверяет, доступно ли перцептивное хэширование (установлен ли Pillow)"""
+    return Image is not None
+
+def compute_dhash(image_data: bytes, hash_size: int = 8) -> Optional[int]:
+    """Вычисляет dHash изображения по уменьшенной копии в оттенках серого"""
+    if Image is None or not image_data:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            # draft() позволяет JPEG-декодеру сразу отдать уменьшенную копию
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            thumbnail = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+            pixels = list(thumbnail.getdata())
+    except Exception as e:
+        logger.warning(f"Failed to compute perceptual hash: {e}")
+        return None
+
+    # Сравниваем соседние пиксели в каждой строке
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming_distance(first: int, second: int) -> int:
+    """Расстояние Хэмминга между двумя хэшами"""
+    return bin(first ^ second).count('1')
+
+class BKTree:
+    """BK-дерево для поиска хэшей в пределах заданного расстояния Хэмминга"""
+
+    def __init__(self):
+        # Узел: [хэш, значение, {расстояние: дочерний узел}]
+        self.root: Optional[list] = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, hash_value: int, value: Any):
+        """Добавляет хэш в дерево (для существующего хэша обновляет значение)"""
+        if self.root is None:
+            self.root = [hash_value, value, {}]
+            self.size = 1
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1] = value
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """Возвращает пары (расстояние, значение) в пределах max_distance, ближайшие первыми"""
+        if self.root is None:
+            return []
+
+        results = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                results.append((distance, node[1]))
+            # По неравенству треугольника подходят только ветви в диапазоне [d - max, d + max]
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in node[2].items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        results.sort(key=lambda item: item[0])
+        return results
+
+class PerceptualHashIndex:
+    """Индекс почти одинаковых изображений: перцептивный хэш -> ключ кэша анализа"""
+
+    def __init__(self, max_distance: int = 2, max_size: int = 1000):
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.tree = BKTree()
+        # Хэши в порядке добавления - нужны для вытеснения самых старых записей
+        self.entries: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, hash_value: Optional[int], is_alive=None) -> Optional[Tuple[int, str]]:
+        """Ищет ближайший сохраненный ключ; is_alive отсекает ключи, вытесненные из кэша"""
+        if hash_value is None:
+            return None
+        for distance, cache_key in self.tree.search(hash_value, self.max_distance):
+            if is_alive is None or is_alive(cache_key):
+                self.hits += 1
+                return distance, cache_key
+        self.misses += 1
+        return None
+
+    def add(self, hash_value: Optional[int], cache_key: str, is_alive=None):
+        """Добавляет хэш; при переполнении перестраивает дерево без устаревших записей"""
+        if hash_value is None:
+            return
+        self.entries.pop(hash_value, None)
+        self.entries[hash_value] = cache_key
+        if len(self.entries) > self.max_size:
+            # Из BK-дерева нельзя удалить узел, поэтому пересобираем его
+            if is_alive is not None:
+                self.entries = {h: k for h, k in self.entries.items() if is_alive(k)}
+            if len(self.entries) > self.max_size:
+                # Все записи живые - отбрасываем самую старую четверть
+                keep = list(self.entries.items())[len(self.entries) // 4:]
+                self.entries = dict(keep)
+            self.tree = BKTree()
+            for entry_hash, entry_key in self.entries.items():
+                self.tree.add(entry_hash, entry_key)
+        else:
+            self.tree.add(hash_value, cache_key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику попаданий"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.tree),
+            'max_distance': self.max_distance,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,154 @@
+"""
+Подготовка фото еды к отправке в vision-модель
+Уменьшает изображение до полезного для модели разрешения, пересжимает в JPEG
+без метаданных и выбирает режим detail (low/high)
+"""
+import io
+import math
+import time
+from typing import Dict, Any, Tuple
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Pillow необязателен: без него изображение уходит как есть
+try:
+    from PIL import Image, ImageFilter, ImageOps, ImageStat
+except ImportError:
+    Image = None
+
+# В режиме high модель вписывает изображение в 2048x2048 и уменьшает короткую сторону до 768,
+# а в режиме low смотрит на копию 512x512 - больший размер не дает модели новой информации
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+LOW_DETAIL_SIDE = 512
+
+# Токены vision-модели: фиксированная часть и стоимость одной плитки 512x512 в режиме high
+BASE_IMAGE_TOKENS = 85
+TILE_TOKENS = 170
+
+
+def detect_mime_type(image_data: bytes) -> str:
+    """Определяет MIME-тип изображения по сигнатуре файла"""
+    if image_data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'image/webp'
+    if image_data.startswith(b'GIF'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str) -> int:
+    """Оценивает число токенов изображения по правилам тарификации vision-моделей"""
+    if detail == 'low' or not width or not height:
+        return BASE_IMAGE_TOKENS
+    scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return BASE_IMAGE_TOKENS + TILE_TOKENS * tiles
+
+
+def _target_size(width: int, height: int, detail: str) -> Tuple[int, int]:
+    """Размер, до которого имеет смысл уменьшить изображение для выбранного detail"""
+    if detail == 'low':
+        scale = min(1.0, LOW_DETAIL_SIDE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height), HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _edge_density(image) -> float:
+    """Средняя яркость карты границ уменьшенной копии - мера детализации сцены"""
+    thumbnail = image.convert('L').resize((64, 64))
+    return ImageStat.Stat(thumbnail.filter(ImageFilter.FIND_EDGES)).mean[0]
+
+
+def _choose_detail(image, original_size: Tuple[int, int], mode: str, low_detail_edge_threshold: float) -> str:
+    """Выбирает detail: маленькие и простые сцены (одна тарелка) не требуют режима high"""
+    if mode in ('low', 'high'):
+        return mode
+    if max(original_size) <= LOW_DETAIL_SIDE:
+        return 'low'
+    if low_detail_edge_threshold > 0 and _edge_density(image) < low_detail_edge_threshold:
+        return 'low'
+    return 'high'
+
+
+def prepare_image_for_vision(image_data: bytes, detail_mode: str = 'auto', jpeg_quality: int = 85,
+                             low_detail_edge_threshold: float = 0.0) -> Dict[str, Any]:
+    """
+    Готовит изображение к отправке в vision-модель (синхронно - вызывать через asyncio.to_thread)
+
+    Args:
+        image_data: Исходные байты фото
+        detail_mode: auto, low или high
+        jpeg_quality: Качество JPEG при пересжатии
+        low_detail_edge_threshold: Порог детализации сцены для режима low в auto (0 - не использовать)
+
+    Returns:
+        Словарь с данными для запроса (data, mime_type, detail) и метриками:
+        размеры до/после, оценка токенов до/после, время обработки
+    """
+    started = time.perf_counter()
+    original_mime = detect_mime_type(image_data)
+    result = {
+        'data': image_data,
+        'mime_type': original_mime,
+        'detail': detail_mode,
+        'original_bytes': len(image_data),
+        'bytes': len(image_data),
+        'original_size': None,
+        'size': None,
+        'original_tokens': None,
+        'tokens': None,
+        'elapsed': 0.0,
+    }
+    if Image is None:
+        return result
+
+    try:
+        with Image.open(io.BytesIO(image_data)) as source:
+            original_size = source.size
+            # draft() позволяет JPEG-декодеру сразу отдать уменьшенную копию (до первого чтения пикселей)
+            source.draft('RGB', _target_size(*original_size, 'low' if detail_mode == 'low' else 'high'))
+            detail = _choose_detail(source, original_size, detail_mode, low_detail_edge_threshold)
+            # Поворот по EXIF применяем до удаления метаданных
+            image = ImageOps.exif_transpose(source)
+            if image.mode not in ('RGB', 'L'):
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                rgba = image.convert('RGBA')
+                background.paste(rgba, mask=rgba.split()[3])
+                image = background
+            target = _target_size(*image.size, detail)
+            if image.size != target:
+                image = image.resize(target, Image.LANCZOS)
+
+            output = io.BytesIO()
+            # Метаданные (EXIF, геолокация) не передаются в save и отбрасываются
+            image.save(output, format='JPEG', quality=jpeg_quality, optimize=True)
+            processed = output.getvalue()
+            has_metadata = bool(source.info.get('exif'))
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed, sending original: {e}")
+        result['elapsed'] = time.perf_counter() - started
+        return result
+
+    result.update({
+        'detail': detail,
+        'original_size': original_size,
+        'size': image.size,
+        'original_tokens': estimate_vision_tokens(*original_size, 'high'),
+        'tokens': estimate_vision_tokens(*image.size, detail),
+    })
+    # Пересжатый файл может оказаться больше исходного, тогда без метаданных
+    # и без уменьшения выгоднее отправить оригинал
+    if len(processed) < len(image_data) or has_metadata or image.size != original_size \
+            or original_mime != 'image/jpeg':
+        result['data'] = processed
+        result['mime_type'] = 'image/jpeg'
+        result['bytes'] = len(processed)
+    result['elapsed'] = time.perf_counter() - started
+    return result
@@ -4,6 +4,7 @@
 """
 from typing import Dict, Tuple
 from logging_config import get_logger
+from services.analysis_parser import parse_analysis
 
 logger = get_logger(__name__)
 
@@ -98,28 +99,8 @@ def extract_macros_from_analysis(analysis_text: str) -> Tuple[int, float, float,
     Returns:
         Кортеж (калории, белки, жиры, углеводы)
     """
-    try:
-        import re
-        
-        # Извлекаем калории
-        calories_match = re.search(r'Калорийность:\s*(\d+)\s*ккал', analysis_text)
-        calories = int(calories_match.group(1)) if calories_match else 0
-        
-        # Извлекаем БЖУ из раздела "Общее БЖУ в блюде"
-        protein_match = re.search(r'Белки:\s*([\d,]+)г', analysis_text)
-        fat_match = re.search(r'Жиры:\s*([\d,]+)г', analysis_text)
-        carbs_match = re.search(r'Углеводы:\s*([\d,]+)г', analysis_text)
-        
-        protein = float(protein_match.group(1).replace(',', '.')) if protein_match else 0.0
-        fat = float(fat_match.group(1).replace(',', '.')) if fat_match else 0.0
-        carbs = float(carbs_match.group(1).replace(',', '.')) if carbs_match else 0.0
-        
-        logger.info(f"Extracted macros from analysis: {calories} kcal, {protein}g protein, {fat}g fat, {carbs}g carbs")
-        return calories, protein, fat, carbs
-        
-    except Exception as e:
-        logger.error(f"Error extracting macros from analysis: {e}")
-        return 0, 0.0, 0.0, 0.0
+    parsed = parse_analysis(analysis_text)
+    return parsed.macros if parsed else (0, 0.0, 0.0, 0.0)
 
 
 def get_macro_recommendations(current: Dict[str, float], target: Dict[str, float]) -> str:
@@ -0,0 +1,106 @@
+"""
+Постепенное обновление сообщения Telegram по мере генерации ответа ИИ
+Правки сообщения ограничены по частоте, чтобы не упираться в лимиты Telegram
+
+DeferredMessage - сообщение об обработке, которое отправляется параллельно с работой
+обработчика: правки дожидаются отправки, а сама обработка - нет.
+"""
+import asyncio
+import time
+from typing import Optional, Awaitable
+from telegram.error import RetryAfter, TelegramError
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Telegram допускает примерно одну правку сообщения в секунду на чат
+DEFAULT_EDIT_INTERVAL = 1.5
+# Запас до лимита длины сообщения (4096 символов)
+MAX_PREVIEW_LENGTH = 3500
+
+
+class ProgressiveMessageEditor:
+    """
+    Показывает частичный ответ ИИ в сообщении об обработке
+
+    update() можно вызывать на каждый фрагмент потока - он не ждет Telegram,
+    а лишь планирует правку не чаще одного раза в min_interval секунд.
+    Перед финальной правкой сообщения нужно вызвать finish().
+    """
+
+    def __init__(self, message, header: str, min_interval: float = DEFAULT_EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self.latest_text = ""
+        self.shown_text = ""
+        self.next_edit_at = 0.0
+        self.edits = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._finished = False
+
+    def update(self, text: str):
+        """Запоминает накопленный текст и планирует правку сообщения"""
+        if self._finished:
+            return
+        self.latest_text = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        """Ждет окончания интервала и показывает самый свежий текст"""
+        delay = self.next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._finished or self.latest_text == self.shown_text:
+            return
+
+        text = self.latest_text
+        preview = text if len(text) <= MAX_PREVIEW_LENGTH else "…" + text[-MAX_PREVIEW_LENGTH:]
+        try:
+            # Без parse_mode: незакрытая разметка в середине потока ломает Markdown
+            await self.message.edit_text(f"{self.header}\n\n{preview} ▌")
+            self.shown_text = text
+            self.edits += 1
+            self.next_edit_at = time.monotonic() + self.min_interval
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.debug(f"Streaming edit throttled by Telegram for {retry_after}s")
+            self.next_edit_at = time.monotonic() + float(retry_after)
+        except TelegramError as e:
+            logger.debug(f"Failed to update streaming message: {e}")
+            self.next_edit_at = time.monotonic() + self.min_interval
+
+        # Пока шла правка, мог прийти новый текст
+        if not self._finished and self.latest_text != self.shown_text:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def finish(self):
+        """Останавливает промежуточные правки, чтобы они не перезаписали итоговое сообщение"""
+        self._finished = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+
+
+class DeferredMessage:
+    """
+    Сообщение, отправка которого еще может идти
+
+    Поддерживает edit_text, как обычное сообщение: правка ждет окончания отправки.
+    Обработчик тем временем скачивает файл и проверяет пользователя.
+    """
+
+    def __init__(self, send: Awaitable):
+        self._task = asyncio.ensure_future(send)
+
+    async def get(self):
+        """Отправленное сообщение (ждет окончания отправки)"""
+        return await self._task
+
+    async def edit_text(self, *args, **kwargs):
+        message = await self._task
+        return await message.edit_text(*args, **kwargs)
@@ -1,20 +1,183 @@
 """
 Обработчик голосовых сообщений для распознавания речи
 Использует внешний сервис для конвертации голоса в текст
+
+Сервисы распознавания (OpenAI Whisper и резервный AssemblyAI) вызываются через
+TranscriptionOrchestrator: по очереди, одновременно (первый результат побеждает,
+остальные запросы отменяются) или с запуском резервного сервиса после порога задержки.
+
+transcribe_and_analyze - весь путь голос → текст → анализ одним вызовом: возвращает и
+распознанный текст, и анализ. Распознанный текст кэшируется по хэшу аудио и file_unique_id,
+поэтому повторная отправка того же голосового не скачивается и не распознается заново.
 """
 import asyncio
+import time
 import aiohttp
-import aiofiles
-import tempfile
-import os
-from typing import Optional
+import hashlib
+from collections import deque
+from typing import Optional, List, Tuple, Callable, Awaitable, Dict, Any, Deque
 from logging_config import get_logger
-from config import API_KEYS, MAX_AUDIO_SIZE, OPENAI_WHISPER_MODEL
+from models.analysis import AnalysisResult
+from config import API_KEYS, MAX_AUDIO_SIZE, OPENAI_WHISPER_MODEL, AI_REQUEST_DEADLINE
+from config import TRANSCRIPTION_STRATEGY, TRANSCRIPTION_HEDGE_DELAY
+from cache_manager import transcription_cache
+from api_client import api_client
+from services.telegram_files import telegram_files, FileDownloadError
+from performance_optimizations import ai_rate_limiter, PRIORITY_DEFAULT
+from resilience import circuit_breakers, retry_policy, call_with_retries, error_for_status, Deadline, percentile
 from telegram import Update
 from telegram.ext import ContextTypes
 
 logger = get_logger(__name__)
 
+# Опрос статуса AssemblyAI: пауза растет от первой до предельной (секунды)
+ASSEMBLYAI_POLL_INITIAL_DELAY = 0.25
+ASSEMBLYAI_POLL_MAX_DELAY = 1.0
+ASSEMBLYAI_POLL_BACKOFF = 1.5
+
+TranscriptionProvider = Tuple[str, Callable[[bytes], Awaitable[Optional[str]]]]
+
+# Маркер: ни один сервис распознавания не настроен
+TRANSCRIPTION_UNAVAILABLE = "VOICE_TRANSCRIPTION_UNAVAILABLE"
+
+
+class VoicePipelineResult:
+    """Результат обработки голосового: распознанный текст и анализ блюда"""
+
+    __slots__ = ('transcript', 'analysis', 'transcript_cached', 'unavailable')
+
+    def __init__(self, transcript: Optional[str] = None, analysis: Optional[AnalysisResult] = None,
+                 transcript_cached: bool = False, unavailable: bool = False):
+        self.transcript = transcript
+        self.analysis = analysis
+        # transcript_cached - текст взят из кэша, без скачивания и распознавания
+        self.transcript_cached = transcript_cached
+        self.unavailable = unavailable
+
+    def __repr__(self) -> str:
+        return (f"VoicePipelineResult(transcript={self.transcript!r}, has_analysis={self.analysis is not None}, "
+                f"transcript_cached={self.transcript_cached}, unavailable={self.unavailable})")
+
+
+
+class ProviderStats:
+    """Счетчики сервиса распознавания: запуски, победы, неудачи и задержка успешных ответов"""
+
+    def __init__(self, window: int = 200):
+        self.requests = 0
+        self.wins = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'wins': self.wins,
+            'win_rate': self.wins / self.requests if self.requests else 0.0,
+            'failures': self.failures,
+            'cancelled': self.cancelled,
+            'p50': percentile(self.latencies, 0.5),
+            'p95': percentile(self.latencies, 0.95)
+        }
+
+
+class TranscriptionOrchestrator:
+    """
+    Выбор результата среди нескольких сервисов распознавания
+
+    Стратегии:
+    - sequential: следующий сервис запускается, только если предыдущий не справился;
+    - race: все сервисы запускаются сразу;
+    - hedge: следующий сервис запускается, если предыдущий не ответил за hedge_delay секунд.
+    Побеждает первый непустой результат, незавершенные запросы отменяются.
+    """
+
+    STRATEGIES = ('sequential', 'race', 'hedge')
+
+    def __init__(self, strategy: str = 'hedge', hedge_delay: float = 4.0):
+        if strategy not in self.STRATEGIES:
+            logger.warning(f"Unknown transcription strategy '{strategy}', using sequential")
+            strategy = 'sequential'
+        self.strategy = strategy
+        self.hedge_delay = hedge_delay
+        self.providers: Dict[str, ProviderStats] = {}
+        self.latencies: Deque[float] = deque(maxlen=200)
+
+    def _provider_stats(self, name: str) -> ProviderStats:
+        if name not in self.providers:
+            self.providers[name] = ProviderStats()
+        return self.providers[name]
+
+    def _launch_interval(self) -> Optional[float]:
+        """Пауза между запусками сервисов (None - только после неудачи предыдущего)"""
+        if self.strategy == 'race':
+            return 0.0
+        if self.strategy == 'hedge':
+            return self.hedge_delay
+        return None
+
+    async def transcribe(self, audio_data: bytes, providers: List[TranscriptionProvider]) -> Optional[str]:
+        """Распознает аудио доступными сервисами (в порядке приоритета); None - если все не справились"""
+        queue = list(providers)
+        running: Dict[asyncio.Future, Tuple[str, float]] = {}
+        interval = self._launch_interval()
+        started = time.monotonic()
+        last_launch = started
+
+        def launch():
+            nonlocal last_launch
+            name, transcribe = queue.pop(0)
+            last_launch = time.monotonic()
+            running[asyncio.ensure_future(transcribe(audio_data))] = (name, last_launch)
+            self._provider_stats(name).requests += 1
+
+        try:
+            if queue:
+                launch()
+            while running:
+                timeout = None
+                if queue and interval is not None:
+                    timeout = max(0.0, last_launch + interval - time.monotonic())
+                done, _ = await asyncio.wait(set(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"Transcription still running after {time.monotonic() - started:.1f}s, "
+                                f"starting {queue[0][0]}")
+                    launch()
+                    continue
+
+                for task in done:
+                    name, task_started = running.pop(task)
+                    stats = self._provider_stats(name)
+                    result = task.result() if not task.cancelled() and task.exception() is None else None
+                    if result:
+                        finished = time.monotonic()
+                        stats.wins += 1
+                        stats.latencies.append(finished - task_started)
+                        self.latencies.append(finished - started)
+                        return result
+                    stats.failures += 1
+                    if task.exception() is not None:
+                        logger.error(f"Transcription with {name} failed: {task.exception()}")
+
+                # Все запущенные сервисы не справились - следующий запускается сразу
+                if queue and not running:
+                    launch()
+            return None
+        finally:
+            for task, (name, _) in running.items():
+                task.cancel()
+                self._provider_stats(name).cancelled += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'strategy': self.strategy,
+            'hedge_delay': self.hedge_delay,
+            'p50': percentile(self.latencies, 0.5),
+            'p95': percentile(self.latencies, 0.95),
+            'providers': {name: stats.get_stats() for name, stats in self.providers.items()}
+        }
+
 class VoiceHandler:
     """Класс для обработки голосовых сообщений"""
     
@@ -27,8 +190,53 @@ class VoiceHandler:
         self.assemblyai_api_key = API_KEYS.get("assemblyai_api")
         self.assemblyai_base_url = "https://api.assemblyai.com/v2"
     
+    def _audio_cache_key(self, audio_data: bytes) -> str:
+        """Ключ кэша распознавания по содержимому аудио"""
+        return f"audio:{hashlib.md5(audio_data).hexdigest()}"
+    
+    async def _get_cached_transcription(self, file_unique_id: Optional[str]) -> Optional[str]:
+        """Возвращает распознанный текст по file_unique_id, если голосовое уже обрабатывалось"""
+        if not file_unique_id:
+            return None
+        audio_key = await transcription_cache.aget(f"file:{file_unique_id}")
+        if audio_key is None:
+            return None
+        return await transcription_cache.aget(audio_key)
+    
+    def _cache_transcription(self, file_unique_id: Optional[str], audio_data: bytes, text: str):
+        """Сохраняет распознанный текст по хэшу аудио и ссылку на него по file_unique_id"""
+        audio_key = self._audio_cache_key(audio_data)
+        transcription_cache.set(audio_key, text)
+        if file_unique_id:
+            transcription_cache.set(f"file:{file_unique_id}", audio_key)
+    
     async def process_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
         """Обрабатывает голосовое сообщение и возвращает распознанный текст"""
+        text, _ = await self._recognize(update, context)
+        return text
+    
+    async def transcribe_and_analyze(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                     priority: int = PRIORITY_DEFAULT) -> VoicePipelineResult:
+        """
+        Распознает голосовое и анализирует распознанный текст
+        
+        Повтор того же голосового берет текст из кэша распознавания - без скачивания
+        и запросов к сервисам распознавания. Анализ идет тем же путем, что и текстовое
+        описание: кэш текстовых анализов, локальная база продуктов, затем ИИ.
+        """
+        text, cached = await self._recognize(update, context)
+        if text == TRANSCRIPTION_UNAVAILABLE:
+            return VoicePipelineResult(unavailable=True)
+        if not text:
+            return VoicePipelineResult()
+        
+        logger.info(f"Voice recognition successful (cached={cached}): '{text[:100]}'")
+        from services.food_analysis_service import analyze_food_text
+        analysis = await analyze_food_text(text, user_id=update.effective_user.id, priority=priority)
+        return VoicePipelineResult(text, analysis, cached)
+    
+    async def _recognize(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Tuple[Optional[str], bool]:
+        """Распознает голосовое сообщение; возвращает (текст, взят ли текст из кэша)"""
         try:
             user = update.effective_user
             voice = update.message.voice
@@ -38,48 +246,66 @@ class VoiceHandler:
             # Проверяем длительность голосового сообщения
             if voice.duration > 60:  # Максимум 60 секунд
                 logger.warning(f"Voice message too long: {voice.duration}s")
-                return None
+                return None, False
             
-            # Получаем файл голосового сообщения
-            voice_file = await context.bot.get_file(voice.file_id)
+            # Повторно отправленное голосовое уже распознавалось - не скачиваем его снова
+            cached_text = await self._get_cached_transcription(voice.file_unique_id)
+            if cached_text:
+                logger.info(f"Voice {voice.file_unique_id} served from file_unique_id cache")
+                return cached_text, True
             
-            # Скачиваем аудиофайл
-            async with aiohttp.ClientSession() as session:
-                async with session.get(voice_file.file_path) as response:
-                    if response.status != 200:
-                        logger.error(f"Failed to download voice file: {response.status}")
-                        return None
-                    
-                    audio_data = await response.read()
-                    
-                    # Проверяем размер файла
-                    if len(audio_data) > MAX_AUDIO_SIZE:
-                        logger.error(f"Audio file too large: {len(audio_data)} bytes")
-                        return None
-                    
-                    # Распознаем речь
-                    return await self._transcribe_audio(audio_data)
+            # Скачиваем аудиофайл в память через общий сервис загрузок
+            # (слишком большой по данным Telegram файл не скачивается вовсе)
+            try:
+                audio_data = await telegram_files.download(
+                    context.bot, voice.file_id, 'voice', MAX_AUDIO_SIZE, file_size=voice.file_size
+                )
+            except FileDownloadError:
+                return None, False
+            
+            # Тот же аудиофайл мог прийти с другим file_unique_id
+            cached_text = await transcription_cache.aget(self._audio_cache_key(audio_data))
+            if cached_text:
+                self._cache_transcription(voice.file_unique_id, audio_data, cached_text)
+                return cached_text, True
+            
+            # Распознаем речь
+            text = await self._transcribe_audio(audio_data)
+            if text and text != TRANSCRIPTION_UNAVAILABLE:
+                self._cache_transcription(voice.file_unique_id, audio_data, text)
+            return text, False
                     
         except Exception as e:
             logger.error(f"Error processing voice message: {e}")
-            return None
+            return None, False
+    
+    def _whisper_form(self, audio_data: bytes) -> aiohttp.FormData:
+        """multipart-тело запроса к Whisper из байтов в памяти (FormData одноразовая - на каждую попытку своя)"""
+        form = aiohttp.FormData()
+        form.add_field('file', audio_data, filename='audio.ogg', content_type='audio/ogg')
+        form.add_field('model', OPENAI_WHISPER_MODEL)
+        form.add_field('language', 'ru')  # Указываем русский язык
+        form.add_field('response_format', 'text')
+        return form
+    
+    def _available_providers(self) -> List[TranscriptionProvider]:
+        """Сервисы распознавания в порядке приоритета (без ключа или с разомкнутым circuit breaker - пропускаются)"""
+        providers = []
+        if self.openai_api_key:
+            if circuit_breakers.get('whisper').is_open():
+                logger.warning("OpenAI transcription circuit is open, trying fallback")
+            else:
+                providers.append(('whisper', self._transcribe_with_openai))
+        if self.assemblyai_api_key and not circuit_breakers.get('assemblyai').is_open():
+            providers.append(('assemblyai', self._transcribe_with_assemblyai))
+        return providers
     
     async def _transcribe_audio(self, audio_data: bytes) -> Optional[str]:
         """Распознает речь из аудиоданных используя различные сервисы"""
         try:
-            # Пробуем OpenAI Whisper API
-            if self.openai_api_key:
-                result = await self._transcribe_with_openai(audio_data)
-                if result:
-                    return result
-                logger.warning("OpenAI transcription failed, trying fallback")
-            
-            # Fallback на AssemblyAI
-            if self.assemblyai_api_key:
-                result = await self._transcribe_with_assemblyai(audio_data)
-                if result:
-                    return result
-                logger.warning("AssemblyAI transcription failed")
+            result = await transcription_orchestrator.transcribe(audio_data, self._available_providers())
+            if result:
+                return result
             
             # Если все сервисы недоступны, используем простой fallback
             logger.error("All transcription services failed")
@@ -92,48 +318,36 @@ class VoiceHandler:
     async def _transcribe_with_openai(self, audio_data: bytes) -> Optional[str]:
         """Распознает речь используя OpenAI Whisper API"""
         try:
-            # Создаем временный файл
-            with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_file:
-                temp_file.write(audio_data)
-                temp_file_path = temp_file.name
+            headers = {
+                "Authorization": f"Bearer {self.openai_api_key}"
+            }
             
-            try:
-                # Используем OpenAI API для транскрипции
-                headers = {
-                    "Authorization": f"Bearer {self.openai_api_key}"
-                }
+            deadline = Deadline(AI_REQUEST_DEADLINE)
+            # Лимит запросов к Whisper общий для всех обработчиков
+            await ai_rate_limiter.acquire('whisper')
+            async with api_client:
+                session = api_client.session
                 
-                with open(temp_file_path, 'rb') as audio_file:
-                    files = {
-                        'file': ('audio.ogg', audio_file, 'audio/ogg')
-                    }
-                    data = {
-                        'model': OPENAI_WHISPER_MODEL,
-                        'language': 'ru',  # Указываем русский язык
-                        'response_format': 'text'
-                    }
-                    
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(
-                            f"{self.openai_base_url}/audio/transcriptions",
-                            headers=headers,
-                            data=data,
-                            files=files
-                        ) as response:
-                            if response.status == 200:
-                                transcribed_text = await response.text()
-                                logger.info(f"OpenAI transcription successful: '{transcribed_text[:100]}...'")
-                                return transcribed_text.strip()
-                            else:
-                                error_text = await response.text()
-                                logger.error(f"OpenAI API error: {response.status} - {error_text}")
-                                return None
-            finally:
-                # Удаляем временный файл
-                try:
-                    os.unlink(temp_file_path)
-                except OSError as e:
-                    logger.warning(f"Failed to delete temporary file {temp_file_path}: {e}")
+                async def attempt(timeout: float) -> Optional[str]:
+                    async with session.post(
+                        f"{self.openai_base_url}/audio/transcriptions",
+                        headers=headers,
+                        data=self._whisper_form(audio_data),
+                        timeout=aiohttp.ClientTimeout(total=timeout)
+                    ) as response:
+                        if response.status == 200:
+                            transcribed_text = await response.text()
+                            logger.info(f"OpenAI transcription successful: '{transcribed_text[:100]}...'")
+                            return transcribed_text.strip()
+                        error = error_for_status(response.status, response.headers)
+                        if error is not None:
+                            raise error
+                        error_text = await response.text()
+                        logger.error(f"OpenAI API error: {response.status} - {error_text}")
+                        return None
+                
+                return await call_with_retries(attempt, circuit_breakers.get('whisper'), retry_policy,
+                                               deadline, "OpenAI transcription")
                     
         except Exception as e:
             logger.error(f"Error with OpenAI transcription: {e}")
@@ -146,23 +360,31 @@ class VoiceHandler:
                 "authorization": self.assemblyai_api_key
             }
             
-            # Загружаем аудио
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.assemblyai_base_url}/upload",
-                    headers=headers,
-                    data=audio_data
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"AssemblyAI upload error: {response.status}")
-                        return None
-                    
-                    upload_result = await response.json()
-                    upload_url = upload_result.get('upload_url')
-                    
-                    if not upload_url:
-                        logger.error("No upload URL from AssemblyAI")
-                        return None
+            breaker = circuit_breakers.get('assemblyai')
+            deadline = Deadline(AI_REQUEST_DEADLINE)
+            
+            async with api_client:
+                session = api_client.session
+                
+                async def post_json(url: str, description: str, **kwargs) -> Optional[dict]:
+                    async def attempt(timeout: float) -> Optional[dict]:
+                        async with session.post(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout),
+                                                **kwargs) as response:
+                            if response.status == 200:
+                                return await response.json()
+                            error = error_for_status(response.status, response.headers)
+                            if error is not None:
+                                raise error
+                            logger.error(f"AssemblyAI {description} error: {response.status}")
+                            return None
+                    return await call_with_retries(attempt, breaker, retry_policy, deadline, f"AssemblyAI {description}")
+                
+                # Загружаем аудио
+                upload_result = await post_json(f"{self.assemblyai_base_url}/upload", "upload", data=audio_data)
+                upload_url = (upload_result or {}).get('upload_url')
+                if not upload_url:
+                    logger.error("No upload URL from AssemblyAI")
+                    return None
                 
                 # Запускаем транскрипцию
                 transcript_data = {
@@ -170,48 +392,44 @@ class VoiceHandler:
                     "language_code": "ru"  # Русский язык
                 }
                 
-                async with session.post(
-                    f"{self.assemblyai_base_url}/transcript",
-                    headers=headers,
-                    json=transcript_data
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"AssemblyAI transcript error: {response.status}")
-                        return None
-                    
-                    transcript_result = await response.json()
-                    transcript_id = transcript_result.get('id')
-                    
-                    if not transcript_id:
-                        logger.error("No transcript ID from AssemblyAI")
-                        return None
+                transcript_result = await post_json(f"{self.assemblyai_base_url}/transcript", "transcript",
+                                                    json=transcript_data)
+                transcript_id = (transcript_result or {}).get('id')
+                if not transcript_id:
+                    logger.error("No transcript ID from AssemblyAI")
+                    return None
                 
-                # Ждем завершения транскрипции
-                max_attempts = 30  # Максимум 30 попыток (30 секунд)
-                for attempt in range(max_attempts):
-                    await asyncio.sleep(1)  # Ждем 1 секунду
+                # Ждем завершения транскрипции: пауза между опросами растет, общий предел - deadline
+                poll_delay = ASSEMBLYAI_POLL_INITIAL_DELAY
+                while deadline.remaining() > poll_delay:
+                    await asyncio.sleep(poll_delay)
+                    poll_delay = min(poll_delay * ASSEMBLYAI_POLL_BACKOFF, ASSEMBLYAI_POLL_MAX_DELAY)
                     
-                    async with session.get(
-                        f"{self.assemblyai_base_url}/transcript/{transcript_id}",
-                        headers=headers
-                    ) as response:
-                        if response.status != 200:
-                            continue
-                        
-                        result = await response.json()
-                        status = result.get('status')
-                        
-                        if status == 'completed':
-                            transcribed_text = result.get('text', '')
-                            if transcribed_text:
-                                logger.info(f"AssemblyAI transcription successful: '{transcribed_text[:100]}...'")
-                                return transcribed_text.strip()
-                            else:
-                                logger.error("Empty transcription result from AssemblyAI")
-                                return None
-                        elif status == 'error':
-                            logger.error(f"AssemblyAI transcription error: {result.get('error', 'Unknown error')}")
+                    try:
+                        async with session.get(
+                            f"{self.assemblyai_base_url}/transcript/{transcript_id}",
+                            headers=headers,
+                            timeout=aiohttp.ClientTimeout(total=deadline.remaining())
+                        ) as response:
+                            if response.status != 200:
+                                continue
+                            result = await response.json()
+                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                        logger.warning(f"AssemblyAI status poll failed: {type(e).__name__} {e}")
+                        continue
+                    
+                    status = result.get('status')
+                    if status == 'completed':
+                        transcribed_text = result.get('text', '')
+                        if transcribed_text:
+                            logger.info(f"AssemblyAI transcription successful: '{transcribed_text[:100]}...'")
+                            return transcribed_text.strip()
+                        else:
+                            logger.error("Empty transcription result from AssemblyAI")
                             return None
+                    elif status == 'error':
+                        logger.error(f"AssemblyAI transcription error: {result.get('error', 'Unknown error')}")
+                        return None
                 
                 logger.error("AssemblyAI transcription timeout")
                 return None
@@ -224,7 +442,8 @@ class VoiceHandler:
         """Fallback функция когда все сервисы недоступны"""
         logger.warning("Using fallback transcription - no API keys available")
         # Возвращаем специальный маркер, который будет обработан в handle_voice
-        return "VOICE_TRANSCRIPTION_UNAVAILABLE"
+        return TRANSCRIPTION_UNAVAILABLE
 
-# Глобальный экземпляр обработчика
+# Глобальные экземпляры оркестратора распознавания и обработчика
+transcription_orchestrator = TranscriptionOrchestrator(TRANSCRIPTION_STRATEGY, TRANSCRIPTION_HEDGE_DELAY)
 voice_handler = VoiceHandler()